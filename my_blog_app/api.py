@@ -0,0 +1,203 @@
+# api.py
+
+import json
+import zlib
+import datetime
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+from werkzeug.exceptions import HTTPException
+import db
+
+# Brotli is optional: without it responses are only offered gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# --- Read-only JSON API ---
+# A machine-readable view of the same data the HTML pages show, built on the
+# db.py loaders. Clients pick the fields they need with ?fields=a,b,c; list
+# endpoints stream their JSON array item by item, and responses are
+# compressed when the client accepts it.
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Fields clients may ask for; those that are also post columns are the only
+# columns read from SQLite
+POST_FIELDS = ('id', 'title', 'excerpt', 'content', 'published_date', 'updated_at', 'image_filename',
+               'comment_count', 'tags')
+POST_DETAIL_FIELDS = POST_FIELDS + ('comments',)
+DEFAULT_LIST_FIELDS = ('id', 'title', 'excerpt', 'published_date', 'image_filename', 'comment_count', 'tags')
+DEFAULT_DETAIL_FIELDS = ('id', 'title', 'content', 'published_date', 'image_filename', 'tags', 'comments')
+COMMENT_FIELDS = ('id', 'author', 'content', 'published_date')
+
+COMPRESS_MIN_BYTES = 512 # Smaller bodies aren't worth compressing
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # Fast enough to run per request
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def dumps(obj):
+    """Compact JSON: no whitespace, UTF-8 left unescaped, datetimes as ISO 8601."""
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=_json_default)
+
+def selected_fields(allowed, default):
+    """Reads ?fields=, aborting with 400 on unknown names."""
+    raw = request.args.get('fields')
+    if not raw:
+        return default
+    fields = tuple(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = set(fields) - set(allowed)
+    if unknown or not fields:
+        abort(400, description=f"Unknown fields: {', '.join(sorted(unknown)) or '(none given)'}. "
+                               f"Available: {', '.join(allowed)}")
+    return fields
+
+def _post_columns(fields):
+    """The post columns needed to produce `fields`."""
+    return tuple(field for field in fields if field in db.POST_COLUMNS)
+
+def _project(row, fields):
+    """Keeps only the selected fields of a post, with tags as a list of names."""
+    item = {}
+    for field in fields:
+        if field == 'tags':
+            item['tags'] = [tag['name'] for tag in row['tags']]
+        elif field == 'comments':
+            item['comments'] = [{key: comment[key] for key in COMMENT_FIELDS} for comment in row['comments']]
+        else:
+            item[field] = row[field]
+    return item
+
+def _page_args():
+    """Reads the ?before=/?after=/?limit= keyset pagination parameters."""
+    cursors = {}
+    for name in ('before', 'after'):
+        raw = request.args.get(name)
+        if raw:
+            cursors[name] = db.decode_cursor(raw)
+            if cursors[name] is None:
+                abort(400, description=f"Malformed '{name}' cursor")
+    limit = request.args.get('limit', default=db.DEFAULT_PAGE_SIZE, type=int)
+    return cursors.get('before'), cursors.get('after'), limit
+
+def stream_array(key, items, extra=None):
+    """Streams {"<key>":[item,...],<extra>} one serialized item at a time."""
+    def generate():
+        yield f'{{{dumps(key)}:['
+        for index, item in enumerate(items):
+            yield (',' if index else '') + dumps(item)
+        yield ']' + (',' + dumps(extra)[1:] if extra else '}')
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# --- Endpoints ---
+
+def _posts_listing(tag_name=None):
+    fields = selected_fields(POST_FIELDS, DEFAULT_LIST_FIELDS)
+    before, after, limit = _page_args()
+    page = db.get_posts_page(tag_name=tag_name, before=before, after=after, limit=limit,
+                             columns=_post_columns(fields), with_tags='tags' in fields)
+    items = (_project(post, fields) for post in page['posts'])
+    return stream_array('posts', items, {'next_cursor': page['next_cursor'], 'prev_cursor': page['prev_cursor']})
+
+@api_bp.route('/posts')
+def list_posts():
+    """One page of posts, newest first (?before=/?after= cursors, ?limit=, ?tag=, ?fields=)."""
+    return _posts_listing(tag_name=request.args.get('tag') or None)
+
+@api_bp.route('/tags/<string:tag_name>/posts')
+def list_tag_posts(tag_name):
+    """One page of the posts with a tag; same parameters as /posts."""
+    return _posts_listing(tag_name=tag_name)
+
+@api_bp.route('/posts/<int:post_id>')
+def get_post(post_id):
+    """A single post, with its tags and comments embedded unless ?fields= leaves them out."""
+    fields = selected_fields(POST_DETAIL_FIELDS, DEFAULT_DETAIL_FIELDS)
+    # One statement, aggregating only the parts that were asked for; comments
+    # are the first page only, the rest come from /posts/<id>/comments?after=
+    bundle = db.load_post_bundle(post_id, columns=_post_columns(fields) or ('id',),
+                                 with_tags='tags' in fields, with_comments='comments' in fields)
+    if bundle is None:
+        abort(404, description=f"No post with id {post_id}")
+    post = dict(bundle.post, tags=bundle.tags, comments=bundle.comments)
+    item = _project(post, fields)
+    if 'comments' in fields:
+        item['comments_next_cursor'] = bundle.next_cursor
+    return Response(dumps(item), mimetype='application/json')
+
+@api_bp.route('/posts/<int:post_id>/comments')
+def list_post_comments(post_id):
+    """One page of a post's comments, oldest first (?after= cursor, ?limit=)."""
+    raw_cursor = request.args.get('after')
+    after = db.decode_cursor(raw_cursor) if raw_cursor else None
+    if raw_cursor and after is None:
+        abort(400, description="Malformed 'after' cursor")
+    limit = request.args.get('limit', default=db.COMMENT_PAGE_SIZE, type=int)
+    page = db.get_comments_page(post_id, after=after, limit=limit)
+    if not page['comments'] and db.get_post_stamp(post_id) is None:
+        abort(404, description=f"No post with id {post_id}")
+    items = ({key: comment[key] for key in COMMENT_FIELDS} for comment in page['comments'])
+    return stream_array('comments', items, {'next_cursor': page['next_cursor']})
+
+@api_bp.route('/tags')
+def list_tags():
+    """Every tag with its number of posts, streamed straight from the database."""
+    return stream_array('tags', ({'name': row['name'], 'post_count': row['post_count']}
+                                 for row in db.iter_tags_with_counts()))
+
+
+@api_bp.errorhandler(HTTPException)
+def json_error(error):
+    """API errors are JSON too, not HTML error pages."""
+    response = jsonify(error=error.description, status=error.code)
+    response.status_code = error.code
+    return response
+
+
+# --- Response compression ---
+
+def _negotiate_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+def _compressor(encoding):
+    """Returns (compress, finish) callables for an encoding."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # 31 = gzip container
+    return compressor.compress, compressor.flush
+
+def _compress_stream(chunks, encoding):
+    compress, finish = _compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+@api_bp.after_request
+def compress_response(response):
+    """Compresses API responses with brotli or gzip, as the client accepts."""
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        compress, finish = _compressor(encoding)
+        response.set_data(compress(data) + finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
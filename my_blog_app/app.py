@@ -2,13 +2,25 @@ import os
 import sqlite3 # Import sqlite3 to catch its specific errors if needed
 import click   # Import click for CLI commands
 import datetime
+import re
+import math
 from datetime import timezone
 
 # Make sure request, redirect, url_for, flash are imported
 from flask import Flask, render_template, abort, request, redirect, url_for, flash, current_app
+from markupsafe import Markup, escape
 from dotenv import load_dotenv
 import db
-from faker import Faker
+import images
+import bulk
+import synthetic
+import querylog
+import metrics
+import comment_queue
+import templating
+import uploads_gc
+from cache import page_cache, conditional
+from api import api_bp
 # Optional: For secure filenames if choosen to use it alongside UUID
 # from werkzeug.utils import secure_filename
 
@@ -22,9 +34,20 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a_default_secret_key_for_dev')
 # Add the database path to the config
 app.config['DATABASE'] = db.DEFAULT_DATABASE_PATH
+# Where compiled templates are cached (default: instance/jinja-cache)
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR')
 
 # --- Initialize database functions and commands with the app ---
 db.init_app(app)
+querylog.init_app(app)
+metrics.init_app(app)
+comment_queue.init_app(app)
+templating.init_app(app)
+images.init_app(app)
+bulk.init_app(app)
+uploads_gc.init_app(app)
+page_cache.init_app(app)
+app.register_blueprint(api_bp)
 
 @app.context_processor
 def inject_now():
@@ -32,11 +55,48 @@ def inject_now():
     # Using utcnow() is generally recommended for server-side time
     return {'now': datetime.datetime.now(timezone.utc)}
 
+@app.template_filter('highlight')
+def highlight_filter(snippet):
+    """Renders a search snippet as safe HTML with matched terms in <mark> tags."""
+    # Post bodies may contain markup; drop tags (and tag fragments cut off by the snippet)
+    text = re.sub(r'<[^>]*>?', '', snippet or '')
+    text = str(escape(text))
+    text = text.replace(db.HIGHLIGHT_START, '<mark>').replace(db.HIGHLIGHT_END, '</mark>')
+    return Markup(text)
+
 # --- Database Seeding Command ---
+def seed_synthetic_posts(count, seed, workers, batch_size, tag_count):
+    """Runs `seed-db --synthetic`: bulk-generates posts for load testing."""
+    click.echo(f"Generating {count} synthetic posts ({tag_count} tags, seed {seed if seed is not None else 'random'})...")
+    step = max(count // 20, batch_size) # Report roughly every 5%
+    reported = [0]
+    def progress(done):
+        if done - reported[0] >= step or done == count:
+            reported[0] = done
+            click.echo(f"  {done}/{count} posts written")
+    try:
+        totals = synthetic.seed_synthetic(count, seed=seed, tag_count=tag_count, batch_size=batch_size,
+                                          workers=workers, progress=progress)
+    except sqlite3.Error as e:
+        raise click.ClickException(f"Synthetic seeding failed: {e}")
+    click.echo(f"Added {totals['posts']} posts, {totals['post_tags']} tag links and {totals['comments']} comments.")
+
 @app.cli.command('seed-db')
 @click.option('--posts', default=25, help='Number of posts to create (max based on static data).')
-def seed_db_command(posts):
+@click.option('--synthetic', 'synthetic_count', type=int, default=None, metavar='N',
+              help='Generate N synthetic posts (with tags and comments) instead, for load testing.')
+@click.option('--seed', type=int, default=None, help='With --synthetic: seed for reproducible data.')
+@click.option('--workers', default=0, help='With --synthetic: processes generating content (0 = none).')
+@click.option('--batch-size', default=synthetic.DEFAULT_BATCH_SIZE, show_default=True,
+              help='With --synthetic: posts per transaction.')
+@click.option('--tags', 'tag_count', default=synthetic.DEFAULT_TAG_COUNT, show_default=True,
+              help='With --synthetic: number of distinct tags.')
+def seed_db_command(posts, synthetic_count=None, **synthetic_options):
     """Seeds the database with sample blog posts, tags, and placeholder images."""
+    if synthetic_count is not None:
+        seed_synthetic_posts(synthetic_count, **synthetic_options)
+        return
+    from faker import Faker # CLI-only dependency: imported here, not at app startup
     fake = Faker()
 
     # static data 
@@ -327,26 +387,17 @@ def seed_db_command(posts):
             # Get the image filename from static data
             image_filename = post_data.get("image_filename", None)
 
-            # Add the post to the database, including the image filename
-            post_id = db.add_post(title, content, image_filename=image_filename) # Pass image_filename
+            # Add the post and its tags to the database in one transaction
+            post_id = db.add_post(title, content, image_filename=image_filename, tags=tag_names)
 
             if post_id:
                 click.echo(f"  Added post '{title}' (ID: {post_id})")
                 if image_filename:
                     click.echo(f"    - Associated image: {image_filename}")
-                if not tag_names:
+                if tag_names:
+                    click.echo(f"    - Linked tags: {', '.join(tag_names)}")
+                else:
                     click.echo(f"    - No static tags defined for this post.")
-
-                for tag_name in tag_names:
-                    tag_id = db.add_or_get_tag(tag_name)
-                    if tag_id:
-                        linked = db.link_post_tag(post_id, tag_id)
-                        if linked:
-                             click.echo(f"    - Linked tag '{tag_name}' (ID: {tag_id})")
-                        else:
-                             click.echo(f"    - Failed to link tag '{tag_name}' (ID: {tag_id})", err=True)
-                    else:
-                        click.echo(f"    - Failed to add/get tag '{tag_name}'", err=True)
             else:
                 click.echo(f"  Failed to add post '{title}'", err=True)
 
@@ -357,68 +408,168 @@ def seed_db_command(posts):
 
 
 # --- Routes ---
+PAGE_QUERY_ARGS = ('before', 'after', 'limit') # Read by page_args(), so part of list pages' cache keys
+
+def page_args():
+    """Reads the ?before=/?after=/?limit= keyset pagination parameters.
+
+    Aborts with 400 if a cursor is malformed.
+    """
+    cursors = {}
+    for name in ('before', 'after'):
+        raw = request.args.get(name)
+        if raw:
+            cursors[name] = db.decode_cursor(raw)
+            if cursors[name] is None:
+                abort(400)
+    limit = request.args.get('limit', default=db.DEFAULT_PAGE_SIZE, type=int)
+    return cursors.get('before'), cursors.get('after'), limit
+
+def list_stamp(**view_args):
+    """Version stamp of the index (and tag cloud): moves with every write to any post."""
+    counter = db.get_change_counter('posts')
+    return (f"posts:{counter['version']}", counter['changed_at']) if counter else None
+
+def tag_stamp(tag_name):
+    """Version stamp of a tag page: moves only with writes to that tag's posts.
+
+    Other writes move list_stamp (and so Last-Modified) too, but not the
+    token, so the cached page is still served and ETags still match.
+    """
+    row = db.get_tag_stamp(tag_name)
+    if row is None or row['changed_at'] is None:
+        return None
+    return f"tag:{row['tag_id']}:{row['posts']}:{row['updated_at']}", row['changed_at']
+
+def post_stamp(post_id):
+    """Version stamp of a post page; None (so the view 404s) if there is no such post."""
+    updated_at = db.get_post_stamp(post_id)
+    return (f"post:{post_id}:{updated_at.isoformat()}", updated_at) if updated_at else None
+
 @app.route('/')
+@conditional(list_stamp)
+@page_cache.cached(lambda: {'index'}, query_args=PAGE_QUERY_ARGS, version=list_stamp)
 def index():
-    """Renders the homepage, listing all blog posts with their tags."""
+    """Renders the homepage, listing one page of blog posts with their tags."""
+    before, after, limit = page_args()
     try:
-        # get_all_posts now includes image_filename
-        posts_raw = db.get_all_posts()
-        posts_with_tags = []
-        for post in posts_raw:
-            tags = db.get_tags_for_post(post['id'])
-            post_dict = dict(post)
-            post_dict['tags'] = tags
-            posts_with_tags.append(post_dict)
-
-        return render_template('index.html', posts=posts_with_tags)
+        # Posts and all their tags are loaded in two queries, not one per post
+        page = db.get_posts_page(before=before, after=after, limit=limit)
+
+        return render_template('index.html', posts=page['posts'], page=page,
+                               limit=request.args.get('limit', type=int))
     except Exception as e:
         app.logger.error(f"Error fetching posts/tags for index page: {e}")
         return "<h1>An error occurred fetching posts.</h1>", 500
 
 @app.route('/post/<int:post_id>', methods=('GET', 'POST'))
+@conditional(post_stamp)
+@page_cache.cached(lambda post_id: {f"post:{post_id}"}, version=post_stamp) # Comment POSTs are never cached
 def post(post_id):
     """Shows a single blog post and handles comment submission."""
-    # get_post_by_id now includes image_filename
-    post_data = db.get_post_by_id(post_id)
-    if post_data is None:
-        abort(404)
-
     if request.method == 'POST':
+        if db.get_post_by_id(post_id, columns=('id',)) is None:
+            abort(404)
         author = request.form.get('author')
         content = request.form.get('content')
 
         if not author or not content:
             flash('Author Name and Comment content are required!', 'error')
         else:
-            comment_id = db.add_comment(post_id, author, content)
-            if comment_id:
-                flash('Comment added successfully!', 'success')
+            try:
+                # Written now, or queued for the background writer (COMMENT_WRITE_BEHIND)
+                comment_id = comment_queue.add_comment(post_id, author, content)
+            except comment_queue.QueueFull:
+                flash('Too many comments are being posted right now. Please try again in a moment.', 'error')
             else:
-                flash('Failed to add comment.', 'error')
+                if comment_id and app.config.get('COMMENT_WRITE_BEHIND'):
+                    # Only queued so far; the writer may still fail (it logs when it does)
+                    flash('Comment received! It will appear in a moment.', 'success')
+                elif comment_id:
+                    flash('Comment added successfully!', 'success')
+                else:
+                    flash('Failed to add comment.', 'error')
             return redirect(url_for('post', post_id=post_id))
 
     # --- Handle GET request ---
-    tags_data = db.get_tags_for_post(post_id)
-    comments_data = db.get_comments_for_post(post_id)
+    # The post, its tags and the first page of comments in one statement;
+    # the rest of the comments load on demand from post_comments
+    bundle = db.load_post_bundle(post_id)
+    if bundle is None:
+        abort(404)
 
     return render_template('post.html',
-                           post=post_data,
-                           tags=tags_data,
-                           comments=comments_data)
+                           post=bundle.post,
+                           tags=bundle.tags,
+                           comments=bundle.comments,
+                           next_cursor=bundle.next_cursor)
+
+
+@app.route('/post/<int:post_id>/comments')
+@conditional(post_stamp)
+@page_cache.cached(lambda post_id: {f"post:{post_id}"}, query_args=('after', 'limit'), version=post_stamp)
+def post_comments(post_id):
+    """Renders the page of a post's comments after the ?after= cursor, as an HTML fragment."""
+    raw_cursor = request.args.get('after')
+    after = db.decode_cursor(raw_cursor) if raw_cursor else None
+    if raw_cursor and after is None:
+        abort(400)
+    limit = request.args.get('limit', default=db.COMMENT_PAGE_SIZE, type=int)
+    page = db.get_comments_page(post_id, after=after, limit=limit)
+    if not page['comments'] and db.get_post_stamp(post_id) is None:
+        abort(404)
+    return render_template('_comments.html', post_id=post_id, **page)
 
 
 @app.route('/tag/<string:tag_name>')
+@conditional(tag_stamp)
+@page_cache.cached(lambda tag_name: {f"tag:{tag_name}"}, query_args=PAGE_QUERY_ARGS, version=tag_stamp)
 def posts_by_tag(tag_name):
-    """Shows all posts associated with a specific tag."""
+    """Shows one page of the posts associated with a specific tag."""
+    before, after, limit = page_args()
     try:
-        # get_posts_by_tag now includes image_filename
-        posts = db.get_posts_by_tag(tag_name)
-        return render_template('tag_posts.html', tag_name=tag_name, posts=posts)
+        # Same batched, paginated loader as the index page, filtered to this tag
+        page = db.get_posts_page(tag_name=tag_name, before=before, after=after, limit=limit)
+        return render_template('tag_posts.html', tag_name=tag_name, posts=page['posts'], page=page,
+                               limit=request.args.get('limit', type=int))
     except Exception as e:
         app.logger.error(f"Error fetching posts for tag '{tag_name}': {e}")
         return "<h1>An error occurred fetching posts for this tag.</h1>", 500
 
 
+TAG_CLOUD_WEIGHTS = 5 # Font size steps, see .tag-weight-N in style.css
+
+@app.route('/tags')
+@conditional(list_stamp)
+@page_cache.cached(lambda: {'index'}, version=list_stamp) # Tag links only change in writes that also evict the index
+def tag_cloud():
+    """Shows every tag in use, sized by its number of posts."""
+    try:
+        # One pass over tags: the counts are kept in tags.post_count by triggers
+        tags = [dict(tag) for tag in db.iter_tags_with_counts() if tag['post_count']]
+    except Exception as e:
+        app.logger.error(f"Error fetching tags for tag cloud: {e}")
+        return "<h1>An error occurred fetching tags.</h1>", 500
+    most = max((tag['post_count'] for tag in tags), default=1)
+    for tag in tags:
+        # Logarithmic, so a few very popular tags don't flatten the rest
+        tag['weight'] = 1 + round((TAG_CLOUD_WEIGHTS - 1) * math.log(tag['post_count']) / math.log(most)) if most > 1 else 1
+    return render_template('tags.html', tags=tags)
+
+
+@app.route('/search')
+def search():
+    """Full-text search over post titles, content and tags, ranked by relevance."""
+    query_text = request.args.get('q', '').strip()
+    page_number = request.args.get('page', default=1, type=int)
+    try:
+        results = db.search_posts(query_text, page=page_number)
+        return render_template('search.html', q=query_text, **results)
+    except Exception as e:
+        app.logger.error(f"Error searching posts for '{query_text}': {e}")
+        return "<h1>An error occurred while searching.</h1>", 500
+
+
 def process_tags(tags_string):
     """Helper function to process a comma-separated tag string."""
     if not tags_string:
@@ -440,7 +591,7 @@ def create_post():
             flash('Title and Content are required!', 'error')
             # Pass back entered data
             return render_template('create_edit_post.html',
-                                   post={'title': title, 'content': content, 'tags_string': tags_string})
+                                   post={'title': title, 'content': content}, tags_string=tags_string)
         else:
             saved_image_filename = None # Initialize filename as None
             if image_file:
@@ -448,22 +599,14 @@ def create_post():
                 saved_image_filename = db.save_image(image_file)
                 if not saved_image_filename:
                     # save_image returns None on failure (e.g., wrong file type)
-                    flash('Image upload failed. Allowed types: png, jpg, jpeg, gif.', 'warning')
+                    flash('Image upload failed. Allowed types: png, jpg, jpeg, gif (max size applies).', 'warning')
                     pass # saved_image_filename remains None
 
-            # Add post to DB, passing the saved filename (or None)
-            post_id = db.add_post(title, content, image_filename=saved_image_filename)
+            # Add post and its tags to DB in one transaction, passing the saved filename (or None)
+            post_id = db.add_post(title, content, image_filename=saved_image_filename,
+                                  tags=process_tags(tags_string))
 
             if post_id:
-                # Process and link tags (existing logic)
-                tag_names = process_tags(tags_string)
-                for tag_name in tag_names:
-                    tag_id = db.add_or_get_tag(tag_name)
-                    if tag_id:
-                        db.link_post_tag(post_id, tag_id)
-                    else:
-                        flash(f"Failed to add or find tag '{tag_name}'.", 'warning')
-
                 flash('Post created successfully!', 'success')
                 return redirect(url_for('post', post_id=post_id))
             else:
@@ -472,7 +615,7 @@ def create_post():
                 if saved_image_filename:
                      db.delete_image_file(saved_image_filename) # Attempt to clean up
                 return render_template('create_edit_post.html',
-                                       post={'title': title, 'content': content, 'tags_string': tags_string})
+                                       post={'title': title, 'content': content}, tags_string=tags_string)
 
     # --- Handle GET request ---
     return render_template('create_edit_post.html')
@@ -482,10 +625,12 @@ def create_post():
 @app.route('/post/<int:post_id>/edit', methods=('GET', 'POST'))
 def edit_post(post_id):
     """Handles editing of an existing blog post, including image update."""
-    # Fetch the existing post (needed for both GET and POST)
-    post_data = db.get_post_by_id(post_id)
-    if post_data is None:
+    # Fetch the existing post and its tags in one read (needed for both GET and POST)
+    bundle = db.load_post_bundle(post_id, with_comments=False)
+    if bundle is None:
         abort(404)
+    post_data = bundle.post
+    current_tags_string = ', '.join(tag['name'] for tag in bundle.tags)
 
     if request.method == 'POST':
         title = request.form.get('title')
@@ -496,51 +641,39 @@ def edit_post(post_id):
         # Basic validation
         if not title or not content:
             flash('Title and Content are required!', 'error')
-            # Re-render form with existing post_id and entered data
-            # Need to reconstruct the 'post' dict for the template, including original image
-            current_tags = db.get_tags_for_post(post_id)
-            tags_string_orig = ', '.join([t['name'] for t in current_tags])
-            post_for_template = dict(post_data) # Start with original data
-            post_for_template['title'] = title # Overwrite with user input
-            post_for_template['content'] = content # Overwrite with user input
-            post_for_template['tags_string'] = tags_string or tags_string_orig
-            return render_template('create_edit_post.html', post=post_for_template)
+            # Re-render the form with exactly what was entered (an emptied tags
+            # field stays empty); the post supplies its id and original image
+            return render_template('create_edit_post.html', post=post_data,
+                                   tags_string=tags_string)
 
         # --- Handle Image Update Logic ---
         new_image_filename = None
         update_image_flag = False # Flag to tell update_post whether to change image field
 
+        old_image_filename = post_data['image_filename'] # Get current image path
         if image_file: # If a new file was uploaded
-            old_image_filename = post_data['image_filename'] # Get current image path
             # Attempt to save the new image
             saved_path = db.save_image(image_file)
             if saved_path:
                 new_image_filename = saved_path
                 update_image_flag = True #new image, so updates the DB field
-                # Delete the old image *after* successfully saving the new one
-                if old_image_filename:
-                    db.delete_image_file(old_image_filename)
             else:
                 # Failed to save new image (e.g., wrong type)
-                flash('New image upload failed. Allowed types: png, jpg, jpeg, gif. Image not updated.', 'warning')
+                flash('New image upload failed. Allowed types: png, jpg, jpeg, gif (max size applies). Image not updated.', 'warning')
 
         # --- Update Post in Database ---
-        # Pass the new filename (or None) and the update flag
+        # Pass the new filename (or None), the update flag and the new tags;
+        # the post and its tag changes are written in one transaction
         updated = db.update_post(post_id, title, content,
                                  image_filename=new_image_filename,
-                                 update_image=update_image_flag)
+                                 update_image=update_image_flag,
+                                 tags=process_tags(tags_string))
 
         if updated:
-            # Update tags
-            db.unlink_all_tags_for_post(post_id)
-            tag_names = process_tags(tags_string)
-            for tag_name in tag_names:
-                tag_id = db.add_or_get_tag(tag_name)
-                if tag_id:
-                    db.link_post_tag(post_id, tag_id)
-                else:
-                    flash(f"Failed to add or find tag '{tag_name}'.", 'warning')
-
+            # Release the old image only once the post no longer points at it;
+            # the file is kept if other posts still use the same image
+            if update_image_flag and old_image_filename and old_image_filename != new_image_filename:
+                db.delete_image_file(old_image_filename)
             flash('Post updated successfully!', 'success')
             return redirect(url_for('post', post_id=post_id))
         else:
@@ -548,27 +681,13 @@ def edit_post(post_id):
             # If update failed, deletes the newly uploaded image if it exists
             if update_image_flag and new_image_filename:
                  db.delete_image_file(new_image_filename) # Attempt cleanup
-            # Re-render form with entered data
-            current_tags = db.get_tags_for_post(post_id)
-            tags_string_orig = ', '.join([t['name'] for t in current_tags])
-            post_for_template = dict(post_data) # Start with original data
-            post_for_template['title'] = title
-            post_for_template['content'] = content
-            post_for_template['tags_string'] = tags_string or tags_string_orig
-            # Keep original image if update failed
-            return render_template('create_edit_post.html', post=post_for_template)
+            # Re-render form with entered data; keep original image if update failed
+            return render_template('create_edit_post.html', post=post_data,
+                                   tags_string=tags_string)
 
     # --- Handle GET request ---
-    # Fetch current tags and format them as a string for the input field
-    current_tags = db.get_tags_for_post(post_id)
-    tags_string = ', '.join([tag['name'] for tag in current_tags])
-
-    # Convert Row to dict and add tags_string for template consistency
-    # post_data already includes 'image_filename' from get_post_by_id
-    post_for_template = dict(post_data)
-    post_for_template['tags_string'] = tags_string
-
-    return render_template('create_edit_post.html', post=post_for_template)
+    # The current tags, formatted for the input field
+    return render_template('create_edit_post.html', post=post_data, tags_string=current_tags_string)
 
 
 # --- Optional: Add a Delete Route ---
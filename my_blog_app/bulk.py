@@ -0,0 +1,183 @@
+# bulk.py
+
+import json
+import sqlite3
+import contextlib
+import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import db
+
+# --- Bulk export / import (NDJSON) ---
+# One JSON object per line, each with a "type". Records are written in
+# dependency order (tags and posts before the links and comments that point
+# at them) and keep their ids, so post URLs survive a round trip. Both
+# directions stream rows through generators: memory use does not grow with
+# the size of the database.
+
+# record type -> (table, columns), in export/import order
+RECORD_TYPES = {
+    'tag': ('tags', ('id', 'name')),
+    'post': ('posts', ('id', 'title', 'content', 'excerpt', 'published_date', 'updated_at', 'image_filename')),
+    'post_tag': ('post_tags', ('post_id', 'tag_id')),
+    'comment': ('comments', ('id', 'post_id', 'author', 'content', 'published_date')),
+    'image': ('images', ('filename', 'size_bytes', 'created_at')),
+}
+TABLE_NAMES = {table for table, _ in RECORD_TYPES.values()}
+# Exported as stored ('YYYY-MM-DD HH:MM:SS[.fff]'), not as parsed datetimes
+TIMESTAMP_COLUMNS = {'published_date', 'updated_at', 'created_at'}
+DEFAULT_BATCH_SIZE = 20000
+FORMAT_VERSION = 1
+
+
+def iter_export_records(conn):
+    """Yields every row of the blog tables as an export record dict."""
+    yield {'type': 'meta', 'format': FORMAT_VERSION, 'schema_version': db.SCHEMA_VERSION,
+           'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+           # AUTOINCREMENT high-water marks, so ids of deleted rows are never reused
+           'sequences': {row['name']: row['seq'] for row in conn.execute("SELECT name, seq FROM sqlite_sequence")}}
+    for record_type, (table, columns) in RECORD_TYPES.items():
+        # CAST keeps timestamps as text: the declared type would turn them into datetimes
+        select_list = ', '.join(f"CAST({column} AS TEXT) AS {column}" if column in TIMESTAMP_COLUMNS else column
+                                for column in columns)
+        order_by = 'post_id, tag_id' if table == 'post_tags' else columns[0]
+        for row in conn.execute(f"SELECT {select_list} FROM {table} ORDER BY {order_by}"):
+            record = {'type': record_type}
+            record.update(zip(columns, row))
+            yield record
+
+def iter_import_batches(lines, batch_size):
+    """Groups NDJSON lines into (record type, list of row tuples) batches.
+
+    A batch holds at most `batch_size` rows of a single type. The meta
+    record is passed through as ('meta', record dict).
+    """
+    batch_type, batch = None, []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            record_type = record.pop('type')
+        except (ValueError, KeyError, AttributeError):
+            raise click.ClickException(f"Line {line_number}: not an export record")
+        if record_type == 'meta':
+            if record.get('format') != FORMAT_VERSION:
+                raise click.ClickException(f"Unsupported export format {record.get('format')!r}")
+            yield 'meta', record
+            continue
+        if record_type not in RECORD_TYPES:
+            raise click.ClickException(f"Line {line_number}: unknown record type {record_type!r}")
+        if batch and (record_type != batch_type or len(batch) >= batch_size):
+            yield batch_type, batch
+            batch = []
+        batch_type = record_type
+        # Columns missing from older exports are filled in by rebuild_derived_data
+        batch.append(tuple(record.get(column) for column in RECORD_TYPES[record_type][1]))
+    if batch:
+        yield batch_type, batch
+
+@contextlib.contextmanager
+def deferred_indexes_and_triggers(conn):
+    """Drops the secondary indexes and triggers of the blog tables for a bulk load.
+
+    Maintaining indexes, the FTS table and the counters row by row is what
+    makes a large import slow; instead they are recreated once at the end
+    and the derived data is rebuilt in a single pass.
+
+    The dropped definitions are recorded in deferred_objects in the same
+    transaction as the drops. If the process dies before the end, the next
+    bulk load or `flask migrate-db` recreates them (see
+    db.restore_deferred_objects).
+    """
+    db.restore_deferred_objects(conn) # Finish an earlier load that was interrupted
+    tables = sorted(TABLE_NAMES)
+    placeholders = ', '.join('?' for _ in tables)
+    definitions = conn.execute(f"""
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN ({placeholders})
+    """, tables).fetchall()
+    with db.write_transaction(conn):
+        conn.executemany("INSERT INTO deferred_objects (type, name, sql) VALUES (?, ?, ?)", definitions)
+        for row in definitions:
+            conn.execute(f"DROP {row['type'].upper()} {row['name']}")
+    try:
+        yield
+    finally:
+        db.restore_deferred_objects(conn)
+        conn.execute("PRAGMA optimize")
+
+def import_records(conn, lines, batch_size=DEFAULT_BATCH_SIZE):
+    """Loads export records into the database with batched executemany calls.
+
+    Returns:
+        A dict of record type -> number of rows imported.
+    """
+    counts = dict.fromkeys(RECORD_TYPES, 0)
+    sequences = {}
+    with deferred_indexes_and_triggers(conn):
+        for record_type, rows in iter_import_batches(lines, batch_size):
+            if record_type == 'meta':
+                sequences = rows.get('sequences') or {}
+                continue
+            table, columns = RECORD_TYPES[record_type]
+            sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+            if record_type == 'image':
+                sql += " ON CONFLICT (filename) DO NOTHING"
+            with db.write_transaction(conn):
+                conn.executemany(sql, rows)
+            counts[record_type] += len(rows)
+        with db.write_transaction(conn):
+            conn.executemany(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?",
+                [(seq, name) for name, seq in sequences.items() if name in TABLE_NAMES]
+            )
+    return counts
+
+
+@click.command('export-db')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@with_appcontext
+def export_db_command(output):
+    """Write all posts, tags, comments and image references as NDJSON (default: stdout)."""
+    counts = dict.fromkeys(RECORD_TYPES, 0)
+    for record in iter_export_records(db.get_db()):
+        output.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        if record['type'] in counts:
+            counts[record['type']] += 1
+    summary = ', '.join(f"{count} {record_type}s" for record_type, count in counts.items())
+    click.echo(f"Exported {summary}.", err=True) # stderr, so stdout stays pure NDJSON
+
+@click.command('import-db')
+@click.argument('source', type=click.File('r', encoding='utf-8'), default='-')
+@click.option('--replace', is_flag=True, help='Re-initialize the database before importing (deletes all data).')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Rows per transaction.')
+@with_appcontext
+def import_db_command(source, replace, batch_size):
+    """Load an NDJSON export (from export-db) into an empty database."""
+    if replace and not db.init_db_logic():
+        raise click.ClickException('Database initialization failed. Check logs or console output.')
+    conn = db.get_db()
+    if db.get_schema_version() != db.SCHEMA_VERSION:
+        raise click.ClickException('Database schema is out of date; run `flask migrate-db` first.')
+    try:
+        db.restore_deferred_objects(conn)
+    except sqlite3.Error as e:
+        raise click.ClickException(f"Restoring indexes and triggers from an interrupted import failed: {e}")
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM posts)").fetchone()[0]:
+        raise click.ClickException('Database is not empty; use --replace to overwrite it.')
+    try:
+        counts = import_records(conn, source, batch_size=max(1, batch_size))
+    except (ValueError, sqlite3.Error) as e:
+        current_app.logger.error(f"Import failed: {e}")
+        raise click.ClickException(f"Import failed: {e}")
+    db.notify_change({'*'})
+    summary = ', '.join(f"{count} {record_type}s" for record_type, count in counts.items())
+    click.echo(f"Imported {summary}.")
+
+
+def init_app(app):
+    """Register the bulk export/import commands with the Flask app."""
+    app.cli.add_command(export_db_command)
+    app.cli.add_command(import_db_command)
@@ -0,0 +1,455 @@
+# cache.py
+
+import os
+import json
+import time
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from flask import current_app, g, request, session, make_response
+from werkzeug.http import is_resource_modified
+import db
+
+# --- Rendered-page cache ---
+# Pages are stored under a key built from the endpoint, its arguments and
+# the query arguments it reads, and tagged with the content they show
+# ('index', 'post:<id>', 'tag:<name>'). db.py sends db.content_changed after
+# every committed write, naming the pages it affected; those entries, and
+# only those, are evicted. Those events only reach the process that made
+# the write, so views also give a version stamp: each entry is stored with
+# the stamp it was rendered at, and a hit whose stamp no longer matches the
+# database (a write by another worker) is treated as a miss. A page whose
+# stamp moved while it rendered isn't stored at all.
+
+# Defaults, overridable through app.config
+PAGE_CACHE_DEFAULTS = {
+    'PAGE_CACHE_ENABLED': True,
+    'PAGE_CACHE_TTL': 300,                      # Seconds an entry may be served
+    'PAGE_CACHE_MAX_BYTES': 32 * 1024 * 1024,   # Store size budget
+    'PAGE_CACHE_MAX_ENTRIES': 10000,            # File store entry limit
+    'PAGE_CACHE_DIR': None,                     # Set to use the file store instead
+    'ETAG_SALT': None,                          # Defaults to a hash of the templates
+}
+
+
+def _token(stamp):
+    """The version token of a (token, last-modified) stamp, or None."""
+    return stamp[0] if stamp else None
+
+
+class MemoryStore:
+    """An in-process LRU store with a per-entry TTL and a total size budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (body, content_type, expires_at, deps, version)
+        self._keys_by_dep = {}        # dep -> set of keys
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1], entry[4]
+
+    def set(self, key, body, content_type, deps, ttl, version=None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, content_type, time.monotonic() + ttl, deps, version)
+            self.size_bytes += len(body)
+            for dep in deps:
+                self._keys_by_dep.setdefault(dep, set()).add(key)
+            while self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries))) # Least recently used first
+
+    def invalidate(self, deps):
+        with self._lock:
+            keys = set()
+            for dep in deps:
+                keys |= self._keys_by_dep.get(dep, set())
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_dep.clear()
+            self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        body, _, _, deps, _ = self._entries.pop(key)
+        self.size_bytes -= len(body)
+        for dep in deps:
+            keys = self._keys_by_dep.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_dep[dep]
+
+
+class FileStore:
+    """A store that keeps pages as files, shared by every worker process.
+
+    Each entry is one file named after the hash of its key, with its expiry
+    time as its modification time; an empty marker file per dependency
+    (deps/<dep hash>/<key hash>) lets a write in any process find and evict
+    exactly the pages it affected.
+
+    Every max_entries / 10 writes (per process), expired pages and markers
+    of removed pages are deleted, then the pages closest to expiry until
+    the store is back within max_entries and max_bytes.
+    """
+    MARKER_GRACE = 60 # Seconds before a marker without a page is stale (set() writes markers first)
+
+    def __init__(self, directory, max_entries, max_bytes):
+        self.directory = directory
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self._prune_every = max(1, self.max_entries // 10)
+        self._sets_since_prune = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'deps'), exist_ok=True)
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key_hash):
+        return os.path.join(self.directory, f"{key_hash}.page")
+
+    def get(self, key):
+        path = self._entry_path(self._hash(key))
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta['expires_at'] <= time.time():
+            self._unlink(path)
+            return None
+        return body, meta['content_type'], meta.get('version')
+
+    def set(self, key, body, content_type, deps, ttl, version=None):
+        key_hash = self._hash(key)
+        for dep in deps:
+            dep_folder = os.path.join(self.directory, 'deps', self._hash(dep))
+            os.makedirs(dep_folder, exist_ok=True)
+            try:
+                open(os.path.join(dep_folder, key_hash), 'wb').close()
+            except FileNotFoundError: # Removed as empty by another process in between
+                os.makedirs(dep_folder, exist_ok=True)
+                open(os.path.join(dep_folder, key_hash), 'wb').close()
+        now = time.time()
+        meta = {'key': key, 'content_type': content_type, 'expires_at': now + ttl, 'version': version}
+        path = self._entry_path(key_hash)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(body)
+        os.utime(tmp_path, (now, meta['expires_at']))
+        os.replace(tmp_path, path) # Readers never see a partial page
+        with self._lock:
+            self._sets_since_prune += 1
+            if self._sets_since_prune < self._prune_every:
+                return
+            self._sets_since_prune = 0
+        self.prune()
+
+    def prune(self):
+        """Deletes expired pages and stale markers, then pages over the limits (soonest to expire first).
+
+        Returns:
+            The number of pages deleted.
+        """
+        now = time.time()
+        removed = 0
+        pages = [] # (expires_at, size, path) of live pages
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.page'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.st_mtime <= now:
+                    removed += self._unlink(entry.path)
+                else:
+                    pages.append((stat.st_mtime, stat.st_size, entry.path))
+        pages.sort()
+        total_bytes = sum(size for _, size, _ in pages)
+        excess = len(pages) - self.max_entries
+        for _, size, path in pages:
+            if excess <= 0 and total_bytes <= self.max_bytes:
+                break
+            removed += self._unlink(path)
+            excess -= 1
+            total_bytes -= size
+        self._remove_stale_markers()
+        return removed
+
+    def _remove_stale_markers(self):
+        """Deletes dependency markers whose page is gone, and empty dependency folders."""
+        cutoff = time.time() - self.MARKER_GRACE
+        with os.scandir(os.path.join(self.directory, 'deps')) as dep_folders:
+            for dep_folder in dep_folders:
+                try:
+                    markers = os.scandir(dep_folder.path)
+                except FileNotFoundError:
+                    continue
+                with markers:
+                    for marker in markers:
+                        try:
+                            if (marker.stat().st_mtime < cutoff
+                                    and not os.path.exists(self._entry_path(marker.name))):
+                                self._unlink(marker.path)
+                        except FileNotFoundError:
+                            pass
+                self._rmdir_if_empty(dep_folder.path)
+
+    def invalidate(self, deps):
+        removed = 0
+        for dep in deps:
+            dep_folder = os.path.join(self.directory, 'deps', self._hash(dep))
+            try:
+                key_hashes = os.listdir(dep_folder)
+            except FileNotFoundError:
+                continue
+            for key_hash in key_hashes:
+                removed += self._unlink(self._entry_path(key_hash))
+                self._unlink(os.path.join(dep_folder, key_hash))
+            self._rmdir_if_empty(dep_folder)
+        return removed
+
+    def clear(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                self._unlink(os.path.join(root, name))
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.page'))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _rmdir_if_empty(path):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass # Not empty (another process just added a marker), or already gone
+
+
+class PageCache:
+    """Caches rendered GET responses of view functions.
+
+    Use `page_cache.cached(deps)` under the route decorator, where `deps`
+    gets the view's arguments and returns the content labels the page shows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0 # Entries evicted by write events
+
+    def init_app(self, app):
+        for key, default in PAGE_CACHE_DEFAULTS.items():
+            app.config.setdefault(key, default)
+        # Strong reference: the handler must live as long as the app
+        db.content_changed.connect(self._on_content_changed, sender=app, weak=False)
+
+    def get_store(self, app=None):
+        """Returns the app's store, creating it from the config on first use."""
+        app = app or current_app
+        store = app.extensions.get('page_cache')
+        if store is None:
+            directory = app.config.get('PAGE_CACHE_DIR')
+            max_bytes = int(app.config.get('PAGE_CACHE_MAX_BYTES', PAGE_CACHE_DEFAULTS['PAGE_CACHE_MAX_BYTES']))
+            if directory:
+                max_entries = int(app.config.get('PAGE_CACHE_MAX_ENTRIES',
+                                                 PAGE_CACHE_DEFAULTS['PAGE_CACHE_MAX_ENTRIES']))
+                store = FileStore(directory, max_entries, max_bytes)
+            else:
+                store = MemoryStore(max_bytes)
+            app.extensions['page_cache'] = store
+        return store
+
+    def _on_content_changed(self, app, keys):
+        store = self.get_store(app)
+        if '*' in keys:
+            store.clear()
+            return
+        removed = store.invalidate(keys)
+        with self._lock:
+            self.invalidations += removed
+
+    @staticmethod
+    def make_key(view_args, query_args=()):
+        """Builds a cache key from the endpoint, its route arguments and the given query arguments."""
+        args = [(name, request.args.getlist(name)) for name in query_args if name in request.args]
+        return json.dumps([request.endpoint, sorted(view_args.items()), args], default=str)
+
+    def cached(self, deps, query_args=(), version=None):
+        """Decorator caching a view's successful GET responses.
+
+        Args:
+            deps: Callable taking the view's keyword arguments and returning
+                  the labels of the content the page shows.
+            query_args: Names of the query arguments the view reads; other
+                  arguments don't change the page, so they are not part of
+                  the key.
+            version: Optional callable taking the view's keyword arguments
+                  and returning a (version token, last-modified) stamp, as
+                  for @conditional. Entries are stored with the token and
+                  only served while it is unchanged. When it is the stamp given
+                  to an enclosing @conditional, that reading is reused, so
+                  a hit costs no extra lookup and a miss one (after
+                  rendering).
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**view_args):
+                # Pending flash messages are rendered into (and consumed by)
+                # the page, so such requests always bypass the cache
+                if (request.method != 'GET' or not current_app.config.get('PAGE_CACHE_ENABLED')
+                        or session.get('_flashes')):
+                    return view(**view_args)
+                store = self.get_store()
+                key = self.make_key(view_args, query_args)
+                rendered_at = None
+                if version is not None:
+                    stamped = g.get('page_stamp')
+                    rendered_at = _token(stamped[1] if stamped and stamped[0] is version
+                                         else version(**view_args))
+                entry = store.get(key)
+                if entry is not None and entry[2] == rendered_at:
+                    with self._lock:
+                        self.hits += 1
+                    g.page_body_token = entry[2] # Checked by @conditional before it adds validators
+                    response = current_app.response_class(entry[0], content_type=entry[1])
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+                with self._lock:
+                    self.misses += 1
+                response = make_response(view(**view_args))
+                if (response.status_code == 200 and not response.is_streamed
+                        and (version is None or _token(version(**view_args)) == rendered_at)):
+                    store.set(key, response.get_data(), response.content_type,
+                              frozenset(deps(**view_args)), current_app.config.get('PAGE_CACHE_TTL'),
+                              version=rendered_at)
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self, app=None):
+        """Returns the hit/miss counters and the store's current size."""
+        store = self.get_store(app)
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(store),
+                'bytes': getattr(store, 'size_bytes', None),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+    def clear(self, app=None):
+        self.get_store(app).clear()
+
+
+page_cache = PageCache()
+
+
+# --- Conditional GET ---
+# ETag and Last-Modified come from version stamps kept in the database (see
+# db.get_post_stamp / db.get_change_counter), so a client revalidating an
+# unchanged page costs one indexed lookup and a 304, with no page queries
+# or rendering.
+#
+# Stamps have millisecond precision, HTTP dates whole seconds. Last-Modified
+# is the end of the stamp's second (rounded up), and only sent once that
+# second is over: any later change then has a later stamp, so
+# If-Modified-Since never hides it. Until then clients revalidate by ETag.
+#
+# The validators describe the stamp read here, so they must only go on a
+# body of that version: PageCache.cached serves an entry only when its
+# token matches this same reading, and reports it for a last check below.
+
+def _etag_salt():
+    """Mixed into every ETag so a deploy with changed templates invalidates them."""
+    salt = current_app.config.get('ETAG_SALT')
+    if salt:
+        return salt
+    salt = current_app.extensions.get('etag_salt')
+    if salt is None:
+        digest = hashlib.sha1()
+        template_folder = os.path.join(current_app.root_path, current_app.template_folder or 'templates')
+        for root, _, files in sorted(os.walk(template_folder)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(f"{name}:{os.path.getmtime(path)}".encode('utf-8'))
+        salt = current_app.extensions['etag_salt'] = digest.hexdigest()[:12]
+    return salt
+
+def conditional(stamp):
+    """Decorator answering conditional GETs with 304 before the view runs.
+
+    Args:
+        stamp: Callable taking the view's keyword arguments and returning a
+               (version token, last-modified UTC datetime) pair, or None if
+               the resource doesn't exist (the view then handles the request).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            # Pages with pending flash messages must be rendered to show them
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return view(**view_args)
+            current = stamp(**view_args)
+            if current is None:
+                return view(**view_args)
+            g.page_stamp = (stamp, current) # Reused by PageCache.cached
+            token, last_modified = current
+            etag = hashlib.sha1(f"{_etag_salt()}|{request.full_path}|{token}".encode('utf-8')).hexdigest()
+            last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0) + timedelta(seconds=1)
+            if last_modified > datetime.now(timezone.utc):
+                last_modified = None # Another change may still land in the stamp's second
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+                if g.get('page_body_token', token) != token:
+                    return response # A cached body from another version must not get this one's validators
+            response.set_etag(etag, weak=True) # Same content, not byte-identical (e.g. compression)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True # Always revalidate; 304s are cheap
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,223 @@
+# comment_queue.py
+
+import os
+import time
+import queue
+import atexit
+import threading
+from flask import current_app, session
+import db
+
+# --- Write-behind comment ingestion (optional) ---
+# With COMMENT_WRITE_BEHIND on, a comment POST only puts the comment on a
+# bounded in-process queue and redirects. A background thread drains the
+# queue in batches (every COMMENT_FLUSH_MS, or as soon as
+# COMMENT_BATCH_SIZE comments are waiting), writing each batch in a single
+# transaction, so a burst of comments shares one write lock and one fsync
+# instead of taking one each.
+#
+# - Backpressure: when the queue is full, a submit waits up to
+#   COMMENT_SUBMIT_TIMEOUT for room and then fails (QueueFull).
+# - Read-your-writes: the client's session remembers its last queued
+#   comment, and that client's next request first waits until the comment
+#   has been written, so the post page it is redirected to shows it. This
+#   is only guaranteed when that request reaches the same worker process
+#   (e.g. a single-process server). Another worker can't see this
+#   process's queue, and only waits two flush intervals as a best effort.
+# - Shutdown: the queue is flushed at interpreter exit, for at most a
+#   timeout; whatever is still queued after it is lost (and logged).
+
+# Defaults, overridable through app.config
+COMMENT_QUEUE_DEFAULTS = {
+    'COMMENT_WRITE_BEHIND': False,
+    'COMMENT_QUEUE_SIZE': 1000,        # Comments waiting to be written, at most
+    'COMMENT_BATCH_SIZE': 100,         # Comments per transaction, at most
+    'COMMENT_FLUSH_MS': 50,            # Longest a comment waits for its batch
+    'COMMENT_SUBMIT_TIMEOUT': 2.0,     # Seconds a request waits for room in a full queue
+}
+PENDING_SESSION_KEY = '_pending_comment'
+_STOP = object()
+
+
+class QueueFull(Exception):
+    """The comment queue stayed full for the whole submit timeout."""
+
+
+class CommentWriter:
+    """A bounded comment queue and the thread that writes it out in batches."""
+
+    def __init__(self, app, max_size, batch_size, flush_interval, submit_timeout):
+        self.app = app
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.submit_timeout = submit_timeout
+        self.pid = os.getpid() # The thread doesn't survive a fork
+        self._queue = queue.Queue(maxsize=max(1, max_size))
+        self._submit_lock = threading.Lock() # Keeps sequence numbers in queue order
+        self._flushed = threading.Condition()
+        self.submitted_seq = 0
+        self.flushed_seq = 0
+        self.batches = 0
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name='comment-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, post_id, author, content):
+        """Queues a comment and returns its sequence number.
+
+        Raises:
+            QueueFull: If there was no room within the submit timeout.
+        """
+        deadline = time.monotonic() + self.submit_timeout
+        if not self._submit_lock.acquire(timeout=self.submit_timeout):
+            raise QueueFull()
+        try:
+            seq = self.submitted_seq + 1
+            try:
+                self._queue.put((seq, (post_id, author, content)),
+                                timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                raise QueueFull() from None
+            self.submitted_seq = seq
+            return seq
+        finally:
+            self._submit_lock.release()
+
+    def wait_for(self, seq, timeout):
+        """Blocks until comment `seq` has been written; returns False on timeout."""
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self.flushed_seq >= seq, timeout=timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        """Waits for a comment, then gathers more until the batch is full or the interval ends."""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with self.app.app_context():
+                written = db.add_comments(comment for _, comment in batch)
+        except Exception: # Never let the writer thread die; the comments are lost, say so
+            self.app.logger.exception(f"Failed to write {len(batch)} queued comments")
+            written = 0
+        with self._flushed:
+            self.batches += 1
+            self.written += written
+            self.flushed_seq = batch[-1][0]
+            self._flushed.notify_all()
+
+    def close(self, timeout=10.0):
+        """Writes out everything still queued, then stops the thread, waiting at most `timeout` seconds.
+
+        Returns:
+            True if the thread stopped with the queue written out.
+        """
+        if not self._thread.is_alive():
+            return True
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout) # Waits for room if the queue is full
+        except queue.Full:
+            pass
+        else:
+            self._thread.join(max(0.0, deadline - time.monotonic()))
+        if self._thread.is_alive():
+            self.app.logger.warning(f"Comment writer did not finish within {timeout}s; "
+                                    f"{self.pending()} queued comments not written")
+            return False
+        return True
+
+    def stats(self):
+        with self._flushed:
+            return {
+                'pending': self.pending(),
+                'submitted': self.submitted_seq,
+                'flushed': self.flushed_seq,
+                'batches': self.batches,
+                'written': self.written,
+            }
+
+
+def get_writer(app=None):
+    """Returns the app's comment writer in this process, starting it on first use."""
+    app = app or current_app._get_current_object() # The thread outlives the request
+    writer = app.extensions.get('comment_writer')
+    if writer is None or writer.pid != os.getpid():
+        config = app.config
+        writer = CommentWriter(
+            app,
+            max_size=int(config['COMMENT_QUEUE_SIZE']),
+            batch_size=int(config['COMMENT_BATCH_SIZE']),
+            flush_interval=float(config['COMMENT_FLUSH_MS']) / 1000,
+            submit_timeout=float(config['COMMENT_SUBMIT_TIMEOUT']),
+        )
+        app.extensions['comment_writer'] = writer
+        atexit.register(writer.close)
+    return writer
+
+def add_comment(post_id, author, content):
+    """Adds a comment, through the write-behind queue when it is enabled.
+
+    Returns:
+        A truthy value on success (the comment id when written directly),
+        None if the comment could not be written.
+
+    Raises:
+        QueueFull: In write-behind mode, if the queue had no room in time.
+    """
+    if not current_app.config.get('COMMENT_WRITE_BEHIND'):
+        return db.add_comment(post_id, author, content)
+    seq = get_writer().submit(post_id, author, content)
+    session[PENDING_SESSION_KEY] = [os.getpid(), seq]
+    return seq
+
+def _wait_for_pending_comment():
+    """Read-your-writes: holds the client's next request until its queued comment is written.
+
+    Guaranteed only in the process that queued it; see the module comment.
+    """
+    if not current_app.config.get('COMMENT_WRITE_BEHIND'):
+        return # Don't touch (and Vary on) the session when the mode is off
+    pending = session.get(PENDING_SESSION_KEY)
+    if not pending:
+        return
+    session.pop(PENDING_SESSION_KEY)
+    pid, seq = pending
+    timeout = float(current_app.config['COMMENT_SUBMIT_TIMEOUT'])
+    writer = current_app.extensions.get('comment_writer')
+    if writer is not None and pid == writer.pid:
+        if not writer.wait_for(seq, timeout):
+            current_app.logger.warning(f"Queued comment {seq} not written after {timeout}s")
+    else:
+        # Queued by another worker process, which flushes on the same schedule;
+        # its queue isn't visible from here, so this is a best effort
+        time.sleep(min(timeout, float(current_app.config['COMMENT_FLUSH_MS']) / 1000 * 2))
+
+
+def init_app(app):
+    """Register the write-behind comment queue with the Flask app."""
+    for key, default in COMMENT_QUEUE_DEFAULTS.items():
+        app.config.setdefault(key, default)
+    app.before_request(_wait_for_pending_comment)
@@ -2,10 +2,25 @@
 
 import sqlite3
 import os
-import uuid # Import uuid for generating unique filenames
+import json
+import datetime
+import html
+import re
+import queue
+import threading
+import operator
+import contextlib
+import hashlib # Uploads are stored under their SHA-256 content hash
+import tempfile
 # Import Flask context globals and current_app for path finding and logging
 from flask import current_app, g
+from flask.cli import with_appcontext
+from flask.signals import Namespace
 import click
+import images
+import querylog
+import models
+import tag_cache
 
 # Define default paths relative to this script
 DEFAULT_DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'blog.db')
@@ -15,16 +30,80 @@ DEFAULT_SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'schema.sql')
 # This path is relative to the 'static' folder Flask serves
 IMAGE_UPLOAD_FOLDER = 'uploads/images'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Leading bytes of each allowed format, mapped to the extension files are stored with
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'\xff\xd8\xff': 'jpg',
+    b'GIF87a': 'gif',
+    b'GIF89a': 'gif',
+}
+MAX_IMAGE_UPLOAD_BYTES = 10 * 1024 * 1024 # Default cap, overridable via app.config
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000 # Width * height cap, overridable via app.config
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# --- Column sets for post queries ---
+# List pages only need the summary columns, so they never pull full article
+# bodies out of SQLite; detail pages ask for the content explicitly.
+POST_COLUMNS = ('id', 'title', 'content', 'excerpt', 'published_date', 'updated_at', 'image_filename',
+                'comment_count')
+POST_DETAIL_COLUMNS = ('id', 'title', 'content', 'published_date', 'image_filename', 'comment_count')
+POST_SUMMARY_COLUMNS = ('id', 'title', 'excerpt', 'published_date', 'image_filename')
+EXCERPT_LENGTH = 200 # Max characters stored in posts.excerpt
+
+# --- Pagination settings for list pages ---
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+COMMENT_PAGE_SIZE = 50 # Comments rendered with the post; more are loaded on demand
 
 # --- Helper Functions ---
 
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    """Builds the plain-text summary stored in posts.excerpt.
+
+    Markup is stripped and whitespace collapsed; longer texts are cut at a
+    word boundary and end with an ellipsis.
+    """
+    text = html.unescape(re.sub(r'<[^>]+>', ' ', content or ''))
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0].rstrip(' ,.;:') + '\u2026'
+
+def post_columns_sql(columns, table_alias=None):
+    """Turns a post column set into a SELECT list, rejecting unknown columns.
+
+    Args:
+        columns: Column names, normally POST_DETAIL_COLUMNS or POST_SUMMARY_COLUMNS.
+        table_alias: Optional alias to prefix each column with (e.g. 'p').
+    """
+    unknown = set(columns) - set(POST_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown post columns: {sorted(unknown)}")
+    prefix = f"{table_alias}." if table_alias else ''
+    return ', '.join(prefix + column for column in columns)
+
 def allowed_file(filename):
     """Checks if the filename has an allowed extension."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def sniff_image_type(header):
+    """Returns the image extension matching a file's leading bytes, or None."""
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+    return None
+
 def save_image(image_file_storage):
-    """Saves an uploaded image file and returns its unique relative path.
+    """Saves an uploaded image under its content hash and returns its relative path.
+
+    The upload is streamed to disk in chunks while being hashed, and aborted
+    once it exceeds MAX_IMAGE_UPLOAD_BYTES (app.config). Images whose header
+    declares more than MAX_IMAGE_PIXELS (app.config) are refused before any
+    decoding, like oversized files (with Pillow installed). The file is stored
+    as <sha256>.<ext>, so an image that was already uploaded is not stored
+    (or post-processed) a second time. Its type is checked against the
+    file's actual leading bytes, not just the name.
 
     Args:
         image_file_storage: The FileStorage object from Flask request.files.
@@ -32,49 +111,124 @@ def save_image(image_file_storage):
     Returns:
         The relative path (from static folder) of the saved image, or None if failed.
     """
-    if image_file_storage and allowed_file(image_file_storage.filename):
-        # Create a unique filename to avoid conflicts and for security
-        _, ext = os.path.splitext(image_file_storage.filename)
-        # using UUID for safety against path traversal etc.
-        unique_filename = f"{uuid.uuid4().hex}{ext}"
-
-        # Ensure the upload directory exists within the static folder
-        # Use current_app.static_folder which points to 'static' directory
-        # Make sure current_app is available (this function should be called within a request context)
-        if not current_app:
-             print("Error: Cannot access current_app. Function called outside of application context.")
-             return None
-        upload_path_full = os.path.join(current_app.static_folder, IMAGE_UPLOAD_FOLDER)
-        os.makedirs(upload_path_full, exist_ok=True)
-
-        # Save the file to the full path
-        save_to = os.path.join(upload_path_full, unique_filename)
-        try:
-            image_file_storage.save(save_to)
-            # Return the relative path (from static) to store in DB
-            relative_path = os.path.join(IMAGE_UPLOAD_FOLDER, unique_filename).replace("\\", "/")
-            current_app.logger.info(f"Saved image: {relative_path}")
-            return relative_path
-        except Exception as e:
-            # Log the error if saving fails
-            current_app.logger.error(f"Failed to save image {unique_filename}: {e}")
-            return None
-    elif image_file_storage and image_file_storage.filename != '':
+    if not image_file_storage or not image_file_storage.filename:
+        return None # No file
+    if not allowed_file(image_file_storage.filename):
         # Log if the file type was not allowed but a file was present
         current_app.logger.warning(f"Image upload failed: File type not allowed for {image_file_storage.filename}")
-    return None # No file, or not allowed type
+        return None
+
+    upload_path_full = os.path.join(current_app.static_folder, IMAGE_UPLOAD_FOLDER)
+    os.makedirs(upload_path_full, exist_ok=True)
+    max_bytes = current_app.config.get('MAX_IMAGE_UPLOAD_BYTES', MAX_IMAGE_UPLOAD_BYTES)
+
+    # Stream into a temp file in the upload folder, so the final rename is atomic
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+    tmp = tempfile.NamedTemporaryFile(dir=upload_path_full, suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            while True:
+                chunk = image_file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if extension is None:
+                    extension = sniff_image_type(chunk)
+                    if extension is None:
+                        current_app.logger.warning(f"Image upload failed: {image_file_storage.filename} is not a PNG, JPEG or GIF")
+                        return None
+                size += len(chunk)
+                if size > max_bytes:
+                    current_app.logger.warning(f"Image upload failed: {image_file_storage.filename} exceeds {max_bytes} bytes")
+                    return None
+                digest.update(chunk)
+                tmp.write(chunk)
+        if extension is None:
+            return None # Empty file
+        max_pixels = current_app.config.get('MAX_IMAGE_PIXELS', MAX_IMAGE_PIXELS)
+        pixels = images.image_pixels(tmp.name)
+        if pixels is not None and pixels > max_pixels:
+            current_app.logger.warning(f"Image upload failed: {image_file_storage.filename} exceeds {max_pixels} pixels")
+            return None
+
+        unique_filename = f"{digest.hexdigest()}.{extension}"
+        relative_path = f"{IMAGE_UPLOAD_FOLDER}/{unique_filename}"
+        save_to = os.path.join(upload_path_full, unique_filename)
+        already_stored = os.path.exists(save_to)
+        if already_stored:
+            current_app.logger.info(f"Image already stored, reusing: {relative_path}")
+            os.utime(save_to) # Fresh again, so gc-uploads leaves it alone until the post is written
+        else:
+            os.replace(tmp.name, save_to)
+            current_app.logger.info(f"Saved image: {relative_path}")
+            # Resized/WebP copies so pages don't ship the full original as a thumbnail
+            images.create_derivatives(relative_path)
+        register_image(relative_path, size)
+        image_uploaded.send(current_app._get_current_object(), size_bytes=size, stored=not already_stored)
+        return relative_path
+    except OSError as e:
+        # Log the error if saving fails
+        current_app.logger.error(f"Failed to save image {image_file_storage.filename}: {e}")
+        return None
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name) # Rejected upload, or a duplicate of a stored file
+
+def register_image(relative_image_path, size_bytes):
+    """Records a stored image file in the images table (reference count untouched).
+
+    The reference counts themselves are maintained by triggers on posts.
+    """
+    conn = get_db()
+    try:
+        conn.execute(
+            "INSERT INTO images (filename, size_bytes) VALUES (?, ?) ON CONFLICT (filename) DO NOTHING",
+            (relative_image_path, size_bytes)
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in register_image for {relative_image_path}: {e}")
+        conn.rollback()
+
+def get_image_ref_count(relative_image_path):
+    """Returns how many posts reference an image file (0 if unknown)."""
+    row = get_db().execute(
+        "SELECT ref_count FROM images WHERE filename = ?", (relative_image_path,)
+    ).fetchone()
+    return row['ref_count'] if row else 0
 
 def delete_image_file(relative_image_path):
-    """Deletes an image file given its relative path from the static folder."""
+    """Deletes an image file (and its derivatives) once no post references it.
+
+    Images are shared between posts by content hash, so the file is only
+    removed when its reference count has dropped to zero.
+
+    Returns:
+        True if the file was deleted, False otherwise (still referenced,
+        missing, or an error).
+    """
     if not relative_image_path:
         return False
     # Make sure current_app is available
     if not current_app:
          print("Error: Cannot access current_app. Function called outside of application context.")
          return False
+    conn = get_db()
+    try:
+        if get_image_ref_count(relative_image_path) > 0:
+            current_app.logger.info(f"Keeping image still used by other posts: {relative_image_path}")
+            return False
+        conn.execute("DELETE FROM images WHERE filename = ? AND ref_count <= 0", (relative_image_path,))
+        conn.commit()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error checking references for image {relative_image_path}: {e}")
+        conn.rollback()
+        return False
     try:
         # Construct the full path relative to the static folder
         image_path_full = os.path.join(current_app.static_folder, relative_image_path)
+        images.delete_derivatives(current_app.static_folder, relative_image_path)
         if os.path.exists(image_path_full):
             os.remove(image_path_full)
             current_app.logger.info(f"Deleted image file: {image_path_full}")
@@ -88,34 +242,283 @@ def delete_image_file(relative_image_path):
 
 
 # --- Connection Management ---
+# Connections are reused across requests through a small per-process pool
+# instead of being opened and torn down for every app context. Each one is
+# configured once, when it is created: WAL so readers never wait for the
+# writer, relaxed fsyncs (safe under WAL), foreign keys (needed for the
+# ON DELETE CASCADE rules in schema.sql) and larger page/mmap caches.
+
+# Defaults for the pool settings, overridable through app.config
+DB_CONFIG_DEFAULTS = {
+    'DB_POOL_SIZE': 8,            # Idle connections kept per process (0 = no reuse)
+    'DB_JOURNAL_MODE': 'WAL',
+    'DB_SYNCHRONOUS': 'NORMAL',
+    'DB_CACHE_SIZE_KIB': 16384,   # Page cache per connection
+    'DB_MMAP_SIZE': 64 * 1024 * 1024,
+    'DB_BUSY_TIMEOUT': 5.0,       # Seconds to wait for a lock before failing
+}
+
+class ConnectionPool:
+    """A bounded pool of configured SQLite connections to one database file.
+
+    Idle connections wait in a LIFO queue, so the most recently used (and
+    warmest) connection is handed out first. A connection is only ever used
+    by one thread at a time, but may move between threads across requests.
+    """
+
+    def __init__(self, db_path, size, pragmas, busy_timeout):
+        self.db_path = db_path
+        self.size = size
+        self.pragmas = pragmas # Ordered (name, value) pairs run on each new connection
+        self.busy_timeout = busy_timeout
+        self.pid = os.getpid() # Connections must not be shared with forked workers
+        self._idle = queue.LifoQueue(maxsize=max(size, 1))
+        self._lock = threading.Lock()
+        self.closed = False
+        self.hits = 0       # Requests served by a reused connection
+        self.misses = 0     # Requests that had to open a new connection
+        self.discarded = 0  # Connections closed because the pool was full
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            timeout=self.busy_timeout,
+            check_same_thread=False, # Pooled connections move between request threads
+            factory=querylog.InstrumentedConnection # Times statements during requests
+        )
+        conn.row_factory = sqlite3.Row # Keep using Row factory
+        for name, value in self.pragmas:
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self):
+        """Returns an idle connection, or opens a new one if none is free."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.hits += 1
+        return conn
+
+    def release(self, conn):
+        """Returns a connection to the pool, closing it if the pool is full."""
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Never hand out a connection mid-transaction
+            conn.set_trace_callback(None)
+            conn.query_stats = None
+        except sqlite3.Error:
+            conn.close() # Broken connection, don't keep it
+            return
+        if self.size > 0 and not self.closed:
+            try:
+                self._idle.put_nowait(conn)
+                return
+            except queue.Full:
+                pass
+        conn.close()
+        with self._lock:
+            self.discarded += 1
+
+    def close(self):
+        """Closes every idle connection; connections released later are closed too."""
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        """Returns the pool counters as a dict."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'database': self.db_path,
+                'size': self.size,
+                'idle': self._idle.qsize(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'discarded': self.discarded,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+def get_pool(app=None):
+    """Gets the connection pool for the app's configured database.
+
+    The pool is created lazily, and replaced if the DATABASE setting changed
+    or the process was forked since it was created.
+    """
+    app = app or current_app
+    db_path = app.config.get('DATABASE', DEFAULT_DATABASE_PATH)
+    pool = app.extensions.get('db_pool')
+    if pool is not None and pool.db_path == db_path and pool.pid == os.getpid():
+        return pool
+    if pool is not None and pool.pid == os.getpid():
+        pool.close()
+    config = {key: app.config.get(key, default) for key, default in DB_CONFIG_DEFAULTS.items()}
+    pool = ConnectionPool(
+        db_path,
+        size=int(config['DB_POOL_SIZE']),
+        pragmas=[
+            ('journal_mode', config['DB_JOURNAL_MODE']),
+            ('synchronous', config['DB_SYNCHRONOUS']),
+            ('foreign_keys', 'ON'),
+            ('cache_size', -int(config['DB_CACHE_SIZE_KIB'])), # Negative = size in KiB
+            ('mmap_size', int(config['DB_MMAP_SIZE'])),
+        ],
+        busy_timeout=float(config['DB_BUSY_TIMEOUT'])
+    )
+    app.extensions['db_pool'] = pool
+    return pool
+
+def get_pool_stats(app=None):
+    """Returns hit/miss statistics for the current process's connection pool."""
+    return get_pool(app).stats()
+
+def close_pool(app=None):
+    """Closes all pooled connections (e.g. before deleting the database file)."""
+    app = app or current_app
+    pool = app.extensions.pop('db_pool', None)
+    if pool is not None and pool.pid == os.getpid():
+        pool.close()
 
 def get_db():
     """Gets the database connection for the current application context."""
     if 'db' not in g:
         db_path = current_app.config.get('DATABASE', DEFAULT_DATABASE_PATH)
         try:
-            # Add detect_types parameter here!
-            g.db = sqlite3.connect(
-                db_path,
-                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-            )
-            g.db.row_factory = sqlite3.Row # Keep using Row factory
+            # Remember the pool too, so the connection goes back where it came from
+            g.db_pool = get_pool()
+            g.db = g.db_pool.acquire()
+            g.db.query_stats = querylog.get_query_stats()
         except sqlite3.Error as e:
             current_app.logger.error(f"Database connection failed for {db_path}: {e}")
             # Optionally raise the error or return None depending on desired handling
             raise e # Or handle more gracefully
     return g.db
 
+def execute_as(model, sql, params=(), conn=None):
+    """Runs a query whose rows are fetched as `model` objects (see models.Model.row_factory).
+
+    Connections keep sqlite3.Row as their row factory, for the many callers
+    that index rows by position; the loaders opt in to models per cursor.
+    """
+    cursor = (conn or get_db()).cursor()
+    cursor.row_factory = model.row_factory
+    return cursor.execute(sql, params)
+
 def close_db(e=None):
-    """Closes the database connection if it exists in the current context."""
+    """Returns the context's database connection to the pool, if it has one."""
     db_conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
     if db_conn is not None:
-        db_conn.close()
+        pool.release(db_conn)
+
+@contextlib.contextmanager
+def write_transaction(conn=None):
+    """Runs a block of writes as one transaction: one commit, one fsync.
+
+    BEGIN IMMEDIATE takes the write lock up front, so reads made inside the
+    block (e.g. the current tag links) cannot go stale before the writes.
+    Commits on success and rolls back if the block raises.
+    """
+    conn = conn or get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+# --- Change Notifications ---
+# Sent after a write has been committed, with `keys` naming the content it
+# changed: 'index', 'post:<id>', 'tag:<name>', or '*' for everything (e.g.
+# after init-db). Caches subscribe to evict exactly the affected pages.
+_signals = Namespace()
+content_changed = _signals.signal('content-changed')
+# Sent by save_image() for each accepted upload, with its size and whether
+# it was stored (False when the same file had been uploaded before)
+image_uploaded = _signals.signal('image-uploaded')
+
+def notify_change(keys):
+    """Sends content_changed for the current app, if anything changed."""
+    if keys:
+        content_changed.send(current_app._get_current_object(), keys=frozenset(keys))
+
+def _post_change_keys(conn, post_id, tag_names=()):
+    """Labels of the pages showing a post: its own, the index and its tags' pages.
+
+    Reads the post's current tags, so call it before a write removes links.
+    """
+    tag_ids = [row['tag_id'] for row in conn.execute(
+        "SELECT tag_id FROM post_tags WHERE post_id = ?", (post_id,)
+    )]
+    names = {tag.name for tag in get_tag_cache(conn).resolve_ids(conn, tag_ids).values()}
+    names |= {name.strip() for name in tag_names if name and name.strip()}
+    return {'index', f"post:{post_id}"} | {f"tag:{name}" for name in names}
+
+
+# --- Tag Cache ---
+
+def get_tag_cache(conn=None, force_check=False):
+    """This process's tag cache (see tag_cache.py), checked against the 'tags' change counter.
+
+    Args:
+        conn: Connection to check and load with (the context's by default).
+        force_check: Read the counter now, regardless of TAG_CACHE_CHECK_INTERVAL.
+            Writers pass True inside their transaction, so they never use stale IDs.
+    """
+    app = current_app
+    database = app.config.get('DATABASE', DEFAULT_DATABASE_PATH)
+    cache = app.extensions.get('tag_cache')
+    if cache is None or cache.key != (database, os.getpid()):
+        cache = tag_cache.TagCache(database, int(app.config['TAG_CACHE_SIZE']),
+                                   float(app.config['TAG_CACHE_CHECK_INTERVAL']))
+        app.extensions['tag_cache'] = cache
+    cache.sync(conn or get_db(), force=force_check)
+    return cache
+
+def _warm_tag_cache():
+    """Loads this process's tag cache before its first request, so no page pays for it.
+
+    Runs per process rather than in init_app, as a cache loaded before a
+    fork is discarded by each worker (see TagCache.key).
+    """
+    app = current_app
+    database = app.config.get('DATABASE', DEFAULT_DATABASE_PATH)
+    cache = app.extensions.get('tag_cache')
+    if (cache is not None and cache.key == (database, os.getpid())) or not app.config['TAG_CACHE_SIZE']:
+        return
+    if not os.path.exists(database):
+        return # Not initialized yet; loaded on first use after init-db
+    try:
+        get_tag_cache()
+    except sqlite3.Error as e:
+        app.logger.warning(f"Could not warm the tag cache: {e}")
+
+def _invalidate_tag_cache(app, keys):
+    """Empties the tag cache when everything changed (init-db, imports)."""
+    cache = app.extensions.get('tag_cache')
+    if '*' in keys and cache is not None:
+        cache.invalidate()
 
 def init_app(app):
     """Register database functions with the Flask app."""
+    for key, default in dict(DB_CONFIG_DEFAULTS, **tag_cache.TAG_CACHE_DEFAULTS).items():
+        app.config.setdefault(key, default)
     app.teardown_appcontext(close_db)
+    app.before_request(_warm_tag_cache)
+    content_changed.connect(_invalidate_tag_cache, sender=app, weak=False)
     app.cli.add_command(init_db_command_context)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(recount_command)
 
 
 # --- Database Initialization ---
@@ -140,7 +543,9 @@ def init_db_logic(schema_path=None):
             sql_script = f.read()
             conn.executescript(sql_script)
         conn.commit() # Commit the changes from executescript
-        return True # Indicate success
+        notify_change({'*'}) # Every cached page is stale now
+        # schema.sql builds the version 0 baseline; migrations bring it up to date
+        return migrate_db() is not None
 
     except sqlite3.Error as e:
         # Log the specific SQL error
@@ -168,17 +573,491 @@ def init_db_command_context():
         click.echo('Database initialization failed. Check logs or console output.', err=True)
 
 
+# --- Schema Migrations ---
+# schema.sql creates the baseline tables at user_version 0. Each migration
+# below moves a database up exactly one version inside its own transaction,
+# recording progress in PRAGMA user_version, so existing databases can be
+# upgraded in place with `flask migrate-db` instead of being re-initialized.
+
+def _migration_add_query_indexes(conn):
+    """Indexes for the access paths used by the list, tag and comment queries."""
+    # Replace single-column indexes some existing databases were created with
+    for legacy_index in ('idx_posts_published_date', 'idx_post_tags_tag_id',
+                         'idx_comments_post_id', 'idx_tags_name'):
+        conn.execute(f"DROP INDEX IF EXISTS {legacy_index}")
+    # Keyset pagination and "newest first" listings walk this index in order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_published ON posts (published_date, id)")
+    # Tag pages look links up by tag; including post_id makes the index covering
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags (tag_id, post_id)")
+    # Comments are always fetched per post in date order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_published ON comments (post_id, published_date)")
+
+def _migration_add_post_excerpt(conn):
+    """Adds posts.excerpt to databases created before it was part of schema.sql."""
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(posts)")]
+    if 'excerpt' in columns:
+        return # Created from a schema.sql that already has the column
+    conn.execute("ALTER TABLE posts ADD COLUMN excerpt TEXT NULL")
+    _fill_excerpts(conn)
+
+def _fill_excerpts(conn):
+    """Computes posts.excerpt where it is missing."""
+    conn.create_function('make_excerpt', 1, make_excerpt, deterministic=True)
+    conn.execute("UPDATE posts SET excerpt = make_excerpt(content) WHERE excerpt IS NULL")
+
+def _migration_add_post_search(conn):
+    """Full-text index over post titles, bodies and tag names, kept in sync by triggers."""
+    # rowid mirrors posts.id; the tags column holds the post's tag names
+    conn.execute("""
+        CREATE VIRTUAL TABLE posts_fts USING fts5(
+            title, content, tags,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    # Triggers cover every write path, including ON DELETE CASCADE and bulk imports
+    conn.execute("""
+        CREATE TRIGGER posts_fts_after_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, content, tags) VALUES (NEW.id, NEW.title, NEW.content, '');
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER posts_fts_after_update AFTER UPDATE OF title, content ON posts BEGIN
+            UPDATE posts_fts SET title = NEW.title, content = NEW.content WHERE rowid = NEW.id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER posts_fts_after_delete AFTER DELETE ON posts BEGIN
+            DELETE FROM posts_fts WHERE rowid = OLD.id;
+        END
+    """)
+    for event, ref in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        conn.execute(f"""
+            CREATE TRIGGER posts_fts_tags_after_{event.lower()} AFTER {event} ON post_tags BEGIN
+                UPDATE posts_fts SET tags = (
+                    SELECT COALESCE(group_concat(t.name, ' '), '')
+                    FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+                    WHERE pt.post_id = {ref}.post_id
+                ) WHERE rowid = {ref}.post_id;
+            END
+        """)
+    # Index the posts that already exist
+    _fill_post_search(conn)
+
+def _fill_post_search(conn):
+    """(Re)builds the full-text index from the posts and their tags."""
+    conn.execute("DELETE FROM posts_fts")
+    conn.execute("""
+        INSERT INTO posts_fts (rowid, title, content, tags)
+        SELECT p.id, p.title, p.content, COALESCE((
+            SELECT group_concat(t.name, ' ')
+            FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.post_id = p.id
+        ), '')
+        FROM posts p
+    """)
+
+def _migration_add_image_refs(conn):
+    """Reference-counted registry of stored image files, maintained by triggers on posts."""
+    conn.execute("""
+        CREATE TABLE images (
+            filename TEXT PRIMARY KEY,             -- Path relative to static/, as in posts.image_filename
+            ref_count INTEGER NOT NULL DEFAULT 0,  -- Number of posts using this file
+            size_bytes INTEGER NULL,               -- File size when stored (NULL for older files)
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER images_ref_after_post_insert AFTER INSERT ON posts
+        WHEN NEW.image_filename IS NOT NULL BEGIN
+            INSERT INTO images (filename, ref_count) VALUES (NEW.image_filename, 1)
+            ON CONFLICT (filename) DO UPDATE SET ref_count = ref_count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER images_ref_after_post_update AFTER UPDATE OF image_filename ON posts
+        WHEN OLD.image_filename IS NOT NEW.image_filename BEGIN
+            UPDATE images SET ref_count = ref_count - 1 WHERE filename = OLD.image_filename;
+            INSERT INTO images (filename, ref_count) SELECT NEW.image_filename, 1 WHERE NEW.image_filename IS NOT NULL
+            ON CONFLICT (filename) DO UPDATE SET ref_count = ref_count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER images_ref_after_post_delete AFTER DELETE ON posts
+        WHEN OLD.image_filename IS NOT NULL BEGIN
+            UPDATE images SET ref_count = ref_count - 1 WHERE filename = OLD.image_filename;
+        END
+    """)
+    _fill_image_refs(conn)
+
+def _fill_image_refs(conn):
+    """Recounts image references from posts, registering images not yet known."""
+    conn.execute("UPDATE images SET ref_count = 0")
+    conn.execute("""
+        INSERT INTO images (filename, ref_count)
+        SELECT image_filename, COUNT(*) FROM posts WHERE image_filename IS NOT NULL GROUP BY image_filename
+        ON CONFLICT (filename) DO UPDATE SET ref_count = excluded.ref_count
+    """)
+
+# SQLite expression for the current UTC time with millisecond precision
+SQL_NOW_MS = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+def _bump_counter_sql(name):
+    """Statement (for use in triggers) that advances a change counter."""
+    return f"""
+        INSERT INTO change_counters (name, version, changed_at) VALUES ('{name}', 1, {SQL_NOW_MS})
+        ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at;
+    """
+
+def _migration_add_change_stamps(conn):
+    """Version stamps for conditional GETs, maintained by triggers.
+
+    posts.updated_at moves whenever the post page would render differently:
+    the post itself, its comments or its tag links change. The 'posts'
+    change counter moves whenever a list page (index or tag page) would.
+    """
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(posts)")]
+    if 'updated_at' not in columns:
+        conn.execute("ALTER TABLE posts ADD COLUMN updated_at TIMESTAMP NULL")
+    conn.execute("""
+        CREATE TABLE change_counters (
+            name TEXT PRIMARY KEY,              -- What changed, e.g. 'posts'
+            version INTEGER NOT NULL DEFAULT 0, -- Bumped on every change
+            changed_at TIMESTAMP NOT NULL       -- Time of the last change (UTC)
+        )
+    """)
+    # Never reuse the previous stamp, even for two changes in the same millisecond
+    touch_post = (
+        "UPDATE posts SET updated_at = strftime('%Y-%m-%d %H:%M:%f', "
+        "MAX(julianday('now'), COALESCE(julianday(updated_at), 0) + 0.0015 / 86400)) "
+        "WHERE id = {ref}.{column};"
+    )
+    conn.execute(f"""
+        CREATE TRIGGER posts_stamp_after_insert AFTER INSERT ON posts BEGIN
+            UPDATE posts SET updated_at = {SQL_NOW_MS} WHERE id = NEW.id AND updated_at IS NULL;
+            {_bump_counter_sql('posts')}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER posts_stamp_after_update
+        AFTER UPDATE OF title, content, published_date, image_filename ON posts BEGIN
+            {touch_post.format(ref='NEW', column='id')}
+            {_bump_counter_sql('posts')}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER posts_stamp_after_delete AFTER DELETE ON posts BEGIN
+            {_bump_counter_sql('posts')}
+        END
+    """)
+    for event, ref in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        # List pages don't show comments, so these only touch the post
+        conn.execute(f"""
+            CREATE TRIGGER comments_stamp_after_{event.lower()} AFTER {event} ON comments BEGIN
+                {touch_post.format(ref=ref, column='post_id')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER post_tags_stamp_after_{event.lower()} AFTER {event} ON post_tags BEGIN
+                {touch_post.format(ref=ref, column='post_id')}
+                {_bump_counter_sql('posts')}
+            END
+        """)
+    _fill_post_stamps(conn)
+
+def _fill_post_stamps(conn):
+    """Sets missing posts.updated_at values and advances the 'posts' change counter."""
+    # Existing posts were last changed by their newest comment, if any
+    conn.execute("""
+        UPDATE posts SET updated_at = MAX(published_date, COALESCE(
+            (SELECT MAX(c.published_date) FROM comments c WHERE c.post_id = posts.id), published_date
+        ))
+        WHERE updated_at IS NULL
+    """)
+    conn.execute(f"""
+        INSERT INTO change_counters (name, version, changed_at) VALUES ('posts', 1, {SQL_NOW_MS})
+        ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at
+    """)
+
+def _migration_add_counts(conn):
+    """Denormalized posts.comment_count and tags.post_count, maintained by triggers.
+
+    Listings and the tag cloud read these instead of running COUNT(*) per row.
+    The triggers also fire for rows removed by ON DELETE CASCADE.
+    """
+    for table, column in (('posts', 'comment_count'), ('tags', 'post_count')):
+        columns = [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    for event, ref, delta in (('INSERT', 'NEW', '+ 1'), ('DELETE', 'OLD', '- 1')):
+        conn.execute(f"""
+            CREATE TRIGGER comments_count_after_{event.lower()} AFTER {event} ON comments BEGIN
+                UPDATE posts SET comment_count = comment_count {delta} WHERE id = {ref}.post_id;
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER post_tags_count_after_{event.lower()} AFTER {event} ON post_tags BEGIN
+                UPDATE tags SET post_count = post_count {delta} WHERE id = {ref}.tag_id;
+            END
+        """)
+    _fill_counts(conn)
+
+def _fill_counts(conn):
+    """Recounts comments per post and posts per tag.
+
+    Returns:
+        (posts corrected, tags corrected).
+    """
+    posts_fixed = conn.execute("""
+        UPDATE posts SET comment_count = counted.n
+        FROM (SELECT p.id, (SELECT COUNT(*) FROM comments c WHERE c.post_id = p.id) AS n FROM posts p) AS counted
+        WHERE posts.id = counted.id AND posts.comment_count != counted.n
+    """).rowcount
+    tags_fixed = conn.execute("""
+        UPDATE tags SET post_count = counted.n
+        FROM (SELECT t.id, (SELECT COUNT(*) FROM post_tags pt WHERE pt.tag_id = t.id) AS n FROM tags t) AS counted
+        WHERE tags.id = counted.id AND tags.post_count != counted.n
+    """).rowcount
+    return posts_fixed, tags_fixed
+
+def _migration_add_tag_stamps(conn):
+    """A 'tags' change counter, bumped by triggers whenever the tag vocabulary changes.
+
+    Processes compare it against the stamp of their tag cache to know when
+    tag IDs they hold may be stale.
+    """
+    for event, columns in (('INSERT', ''), ('UPDATE', ' OF name'), ('DELETE', '')):
+        conn.execute(f"""
+            CREATE TRIGGER tags_stamp_after_{event.lower()} AFTER {event}{columns} ON tags BEGIN
+                {_bump_counter_sql('tags')}
+            END
+        """)
+    _fill_tag_stamp(conn)
+
+def _fill_tag_stamp(conn):
+    """Advances the 'tags' change counter."""
+    conn.execute(f"""
+        INSERT INTO change_counters (name, version, changed_at) VALUES ('tags', 1, {SQL_NOW_MS})
+        ON CONFLICT (name) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at
+    """)
+
+def rebuild_derived_data(conn):
+    """Recomputes everything triggers normally keep up to date.
+
+    For use after rows were written with the triggers dropped, e.g. by a
+    bulk import. Runs inside the caller's transaction.
+    """
+    _fill_excerpts(conn)
+    _fill_post_search(conn)
+    _fill_image_refs(conn)
+    _fill_post_stamps(conn)
+    _fill_counts(conn)
+    _fill_tag_stamp(conn)
+
+def _migration_add_deferred_objects(conn):
+    """A table recording the indexes and triggers a bulk load has dropped.
+
+    See bulk.deferred_indexes_and_triggers and restore_deferred_objects.
+    """
+    conn.execute("""
+        CREATE TABLE deferred_objects (
+            name TEXT PRIMARY KEY,  -- Index or trigger name
+            type TEXT NOT NULL,     -- 'index' or 'trigger'
+            sql TEXT NOT NULL       -- Its CREATE statement, from sqlite_master
+        )
+    """)
+
+def restore_deferred_objects(conn):
+    """Recreates the indexes and triggers left dropped by an interrupted bulk load.
+
+    The objects are recreated, the derived data rebuilt and the record
+    cleared in one transaction, so a crash at any point leaves either the
+    record or the objects in place. Does nothing if nothing was deferred.
+
+    Returns:
+        The number of indexes and triggers recreated.
+    """
+    rows = conn.execute("SELECT type, name, sql FROM deferred_objects ORDER BY type, name").fetchall()
+    if not rows:
+        return 0
+    with write_transaction(conn):
+        existing = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master")}
+        for row in rows: # Indexes before triggers
+            if row['name'] not in existing:
+                conn.execute(row['sql'])
+        rebuild_derived_data(conn)
+        conn.execute("DELETE FROM deferred_objects")
+    return len(rows)
+
+# (version, description, function) - append only, never renumber
+MIGRATIONS = [
+    (1, "Add indexes for post listing, tag and comment queries", _migration_add_query_indexes),
+    (2, "Add and backfill posts.excerpt", _migration_add_post_excerpt),
+    (3, "Add FTS5 full-text search over posts and tags", _migration_add_post_search),
+    (4, "Add reference-counted image registry", _migration_add_image_refs),
+    (5, "Add posts.updated_at and change counters for conditional GETs", _migration_add_change_stamps),
+    (6, "Add trigger-maintained posts.comment_count and tags.post_count", _migration_add_counts),
+    (7, "Add a change counter for the tag vocabulary, for tag caches", _migration_add_tag_stamps),
+    (8, "Add a record of indexes and triggers dropped by bulk loads", _migration_add_deferred_objects),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version():
+    """Returns the migration version recorded in the database."""
+    return get_db().execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db():
+    """Applies all pending migrations in order.
+
+    Returns:
+        A list of (version, description) tuples for the migrations applied
+        (empty if already up to date), or None if a migration failed. A
+        failed migration is rolled back and leaves the version unchanged.
+    """
+    conn = get_db()
+    current_version = get_schema_version()
+    applied = []
+    for version, description, apply_migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            conn.execute("BEGIN") # DDL does not open a transaction implicitly
+            apply_migration(conn)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            current_app.logger.error(f"Migration {version} ({description}) failed: {e}")
+            return None
+        applied.append((version, description))
+    if applied:
+        notify_change({'*'}) # Cached pages were rendered against the old schema
+    return applied
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Upgrade the database schema by applying pending migrations."""
+    click.echo(f"Database schema is at version {get_schema_version()}.")
+    applied = migrate_db()
+    if applied is None:
+        click.echo('Migration failed. Check logs or console output.', err=True)
+    elif not applied:
+        click.echo(f"Already up to date (version {SCHEMA_VERSION}).")
+    else:
+        for version, description in applied:
+            click.echo(f"  Applied migration {version}: {description}")
+        click.echo(f"Database schema is now at version {SCHEMA_VERSION}.")
+    if applied is not None:
+        try:
+            restored = restore_deferred_objects(get_db())
+        except sqlite3.Error as e:
+            current_app.logger.error(f"Restoring deferred indexes and triggers failed: {e}")
+            raise click.ClickException(f"Restoring deferred indexes and triggers failed: {e}")
+        if restored:
+            click.echo(f"Recreated {restored} indexes and triggers dropped by an interrupted bulk load.")
+
+@click.command('recount')
+@with_appcontext
+def recount_command():
+    """Repair posts.comment_count and tags.post_count by counting the rows again."""
+    conn = get_db()
+    try:
+        with write_transaction(conn):
+            posts_fixed, tags_fixed = _fill_counts(conn)
+    except sqlite3.Error as e:
+        current_app.logger.error(f"Recount failed: {e}")
+        raise click.ClickException(f"Recount failed: {e}")
+    if posts_fixed or tags_fixed:
+        notify_change({'*'})
+    click.echo(f"Corrected comment counts on {posts_fixed} posts and post counts on {tags_fixed} tags.")
+
+
+# --- Query Plan Inspection ---
+
+def explain_query_plan(sql, params=()):
+    """Returns the EXPLAIN QUERY PLAN detail lines for a statement."""
+    rows = get_db().execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row['detail'] for row in rows]
+
+def full_scan_tables(plan_details):
+    """Names the tables a query plan reads with a full scan (no index).
+
+    Scans of subquery results (co-routines and materialized views) read rows
+    the subquery already found, so they are not counted.
+    """
+    subqueries = set()
+    scanned = []
+    for detail in plan_details:
+        match = re.match(r'(?:CO-ROUTINE|MATERIALIZE) (\w+)$', detail)
+        if match:
+            subqueries.add(match.group(1))
+        match = re.match(r'SCAN (?:TABLE )?(\w+)$', detail)
+        if match and match.group(1) not in subqueries:
+            scanned.append(match.group(1))
+    return scanned
+
+
+# --- Version Stamps (conditional GETs) ---
+# Single indexed lookups, cheap enough to run before deciding whether a
+# page has to be built at all.
+
+def get_post_stamp(post_id):
+    """Returns when a post's page last changed (post, comments or tags), or None if there is no such post."""
+    try:
+        row = get_db().execute("SELECT updated_at FROM posts WHERE id = ?", (post_id,)).fetchone()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_post_stamp for post {post_id}: {e}")
+        return None
+    return row['updated_at'] if row else None
+
+def get_tag_stamp(tag_name):
+    """Returns what a tag page's version depends on, in one lookup.
+
+    The row has the tag's ID (None if there is no such tag), the number of
+    posts with it and the latest updated_at among them (together they move
+    whenever the page would render differently), and the 'posts' change
+    counter's changed_at, a conservative last-modified time. None on error.
+    """
+    conn = get_db()
+    try:
+        # The tag cache turns the name into an ID, so the tags table isn't joined
+        tag = get_tag_cache(conn).resolve_names(conn, [tag_name]).get(tag_name)
+        return conn.execute("""
+            SELECT ? AS tag_id, COUNT(p.id) AS posts, MAX(p.updated_at) AS updated_at,
+                   (SELECT changed_at FROM change_counters WHERE name = 'posts') AS "changed_at [timestamp]"
+            FROM post_tags pt JOIN posts p ON p.id = pt.post_id
+            WHERE pt.tag_id = ?
+        """, (tag and tag.id, tag and tag.id)).fetchone()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_tag_stamp for tag '{tag_name}': {e}")
+        return None
+
+def get_change_counter(name):
+    """Returns the (version, changed_at) row of a change counter, or None."""
+    try:
+        return get_db().execute(
+            "SELECT version, changed_at FROM change_counters WHERE name = ?", (name,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_change_counter for '{name}': {e}")
+        return None
+
+
 # --- CRUD Operations for Posts (with Image Handling) ---
 
-def get_all_posts(order_by="published_date DESC"):
-    """Retrieves all posts including image filename."""
+def get_all_posts(order_by="published_date DESC", columns=POST_DETAIL_COLUMNS):
+    """Retrieves all posts including image filename.
+
+    Pass columns=POST_SUMMARY_COLUMNS to skip loading the post bodies.
+    """
     conn = get_db()
     cursor = conn.cursor()
+    cursor.row_factory = models.Post.row_factory
     allowed_orders = ["published_date DESC", "published_date ASC", "title ASC", "title DESC"]
     if order_by not in allowed_orders:
         order_by = "published_date DESC"
-    # Include image_filename in the SELECT
-    query = f"SELECT id, title, content, published_date, image_filename FROM posts ORDER BY {order_by}"
+    # Only the requested columns are read (image_filename is in both column sets)
+    query = f"SELECT {post_columns_sql(columns)} FROM posts ORDER BY {order_by}"
     try:
         posts = cursor.execute(query).fetchall()
         return posts
@@ -186,39 +1065,113 @@ def get_all_posts(order_by="published_date DESC"):
         current_app.logger.error(f"DB error in get_all_posts: {e}")
         return [] # Return empty list on error
 
-def get_post_by_id(post_id):
-    """Retrieves a single post by its ID, including image filename."""
-    conn = get_db()
+def get_post_by_id(post_id, columns=POST_DETAIL_COLUMNS):
+    """Retrieves a single post by its ID, including image filename.
+
+    Args:
+        post_id: ID of the post.
+        columns: Post columns to load (the full detail columns by default).
+    """
     try:
-        post = conn.execute(
+        post = execute_as(
             # Include image_filename in the SELECT
-            "SELECT id, title, content, published_date, image_filename FROM posts WHERE id = ?", (post_id,)
+            models.Post, f"SELECT {post_columns_sql(columns)} FROM posts WHERE id = ?", (post_id,)
         ).fetchone()
         return post # Returns None if not found, which is expected
     except sqlite3.Error as e:
         current_app.logger.error(f"DB error in get_post_by_id for post {post_id}: {e}")
         return None
 
-def add_post(title, content, image_filename=None): # Add image_filename parameter
-    """Adds a new post to the database, including the image filename."""
+def _parse_timestamp(value):
+    """Parses a TIMESTAMP read as text (e.g. from JSON), like the sqlite3 converter does."""
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def load_post_bundle(post_id, with_tags=True, with_comments=True, columns=POST_DETAIL_COLUMNS,
+                     comment_limit=COMMENT_PAGE_SIZE):
+    """Loads a post with its tags and first page of comments in a single statement.
+
+    The tags and comments are aggregated into JSON arrays by correlated
+    subqueries (json_group_array), so the whole page is one round trip and
+    one consistent snapshot: a comment or tag change committed in between
+    can't show up in one part and not the other.
+
+    Args:
+        post_id: ID of the post.
+        with_tags: Set to False to skip the tags (bundle.tags is then None).
+        with_comments: Set to False to skip the comments (bundle.comments is then None).
+        columns: Post columns to load (the full detail columns by default).
+        comment_limit: Comments in the first page, clamped to 1..MAX_PAGE_SIZE.
+
+    Returns:
+        A models.PostBundle, or None if the post doesn't exist.
+    """
+    comment_limit = max(1, min(comment_limit, MAX_PAGE_SIZE))
+    select = [post_columns_sql(columns, 'p')]
+    params = []
+    if with_tags:
+        # json_group_array aggregates in the order the subquery delivers the rows
+        select.append("""(SELECT json_group_array(json_array(t.id, t.name))
+                          FROM (SELECT t.id, t.name FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+                                WHERE pt.post_id = p.id ORDER BY t.name) t) AS tags_json""")
+    if with_comments:
+        # Same index seek as get_comments_page, with one extra row for next_cursor
+        select.append("""(SELECT json_group_array(json_array(c.id, c.author, c.content, c.published_date))
+                          FROM (SELECT id, author, content, published_date FROM comments
+                                WHERE post_id = p.id ORDER BY published_date, id LIMIT ?) c) AS comments_json""")
+        params.append(comment_limit + 1)
+    params.append(post_id)
+    try:
+        row = get_db().execute(f"SELECT {', '.join(select)} FROM posts p WHERE p.id = ?", params).fetchone()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in load_post_bundle for post {post_id}: {e}")
+        return None
+    if row is None:
+        return None
+
+    post = models.Post(**{column: row[column] for column in columns})
+    tags = comments = next_cursor = None
+    if with_tags:
+        tags = tuple(map(models.Tag.builder(('id', 'name')), json.loads(row['tags_json'])))
+    if with_comments:
+        comments = tuple(map(models.Comment.builder(('id', 'author', 'content', 'published_date')),
+                             json.loads(row['comments_json'])))
+        for comment in comments:
+            comment.published_date = _parse_timestamp(comment.published_date)
+        if len(comments) > comment_limit:
+            comments = comments[:comment_limit]
+            next_cursor = encode_cursor(comments[-1])
+    return models.PostBundle(post, tags=tags, comments=comments, next_cursor=next_cursor)
+
+def add_post(title, content, image_filename=None, tags=None): # Add image_filename parameter
+    """Adds a new post to the database, including the image filename and excerpt.
+
+    If `tags` (a list of tag names) is given, the post's tags are written in
+    the same transaction as the post itself.
+    """
     conn = get_db()
     try:
-        cursor = conn.execute(
-            # Include image_filename in the INSERT
-            "INSERT INTO posts (title, content, image_filename) VALUES (?, ?, ?)",
-            (title, content, image_filename) # Pass the filename (can be None)
-        )
-        conn.commit()
-        return cursor.lastrowid # Return the ID of the newly inserted post
+        with write_transaction(conn):
+            cursor = conn.execute(
+                # Include image_filename and the precomputed excerpt in the INSERT
+                "INSERT INTO posts (title, content, excerpt, image_filename) VALUES (?, ?, ?, ?)",
+                (title, content, make_excerpt(content), image_filename) # Pass the filename (can be None)
+            )
+            post_id = cursor.lastrowid
+            if tags is not None:
+                _write_post_tags(conn, post_id, tags)
+            changed = _post_change_keys(conn, post_id)
+        notify_change(changed)
+        return post_id # Return the ID of the newly inserted post
     except sqlite3.Error as e:
-        # Log the specific error
+        # Log the specific error (write_transaction already rolled back)
         current_app.logger.error(f"Database error in add_post: {e}")
-        conn.rollback()
         return None # Indicate failure
 
-def update_post(post_id, title, content, image_filename=None, update_image=False):
+def update_post(post_id, title, content, image_filename=None, update_image=False, tags=None):
     """Updates an existing post. Can optionally update the image filename.
 
+    The stored excerpt is regenerated from the new content.
+
     Args:
         post_id: ID of the post to update.
         title: New title.
@@ -227,24 +1180,32 @@ def update_post(post_id, title, content, image_filename=None, update_image=False
         update_image: Boolean indicating if the image_filename field should be updated.
                       If False, image_filename is ignored. If True, it's updated
                       (even if image_filename is None, which would remove the image link).
+        tags: Optional list of tag names. If given, the post's tags are made to
+              match it in the same transaction as the update.
     """
     conn = get_db()
     try:
         if update_image:
             # Update title, content, AND image_filename
-            sql = "UPDATE posts SET title = ?, content = ?, image_filename = ? WHERE id = ?"
-            params = (title, content, image_filename, post_id)
+            sql = "UPDATE posts SET title = ?, content = ?, excerpt = ?, image_filename = ? WHERE id = ?"
+            params = (title, content, make_excerpt(content), image_filename, post_id)
         else:
             # Only update title and content, leave image_filename as is
-            sql = "UPDATE posts SET title = ?, content = ? WHERE id = ?"
-            params = (title, content, post_id)
+            sql = "UPDATE posts SET title = ?, content = ?, excerpt = ? WHERE id = ?"
+            params = (title, content, make_excerpt(content), post_id)
 
-        cursor = conn.execute(sql, params)
-        conn.commit()
-        return cursor.rowcount > 0 # True if a row was affected (post existed)
+        with write_transaction(conn):
+            # Pages of tags removed by this update change too
+            changed = _post_change_keys(conn, post_id, tags or ())
+            cursor = conn.execute(sql, params)
+            updated = cursor.rowcount > 0 # True if a row was affected (post existed)
+            if updated and tags is not None:
+                _write_post_tags(conn, post_id, tags)
+        if updated:
+            notify_change(changed)
+        return updated
     except sqlite3.Error as e:
         current_app.logger.error(f"Database error in update_post for post {post_id}: {e}")
-        conn.rollback()
         return False # Indicate failure
 
 def delete_post(post_id):
@@ -255,12 +1216,14 @@ def delete_post(post_id):
     image_to_delete = post_data['image_filename'] if post_data else None
 
     try:
-        cursor = conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-        # Note: ON DELETE CASCADE in schema handles comments and post_tags automatically
-        conn.commit()
+        with write_transaction(conn):
+            changed = _post_change_keys(conn, post_id) # Before the cascade drops its tag links
+            cursor = conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+            # Note: ON DELETE CASCADE in schema handles comments and post_tags automatically
         rows_affected = cursor.rowcount
 
         if rows_affected > 0:
+            notify_change(changed)
             # If post deletion was successful, try deleting the image file
             if image_to_delete:
                 delete_image_file(image_to_delete) # Attempt deletion, ignore result for now
@@ -270,8 +1233,8 @@ def delete_post(post_id):
             current_app.logger.warning(f"Attempted to delete non-existent post with ID: {post_id}")
             return False
     except sqlite3.Error as e:
+        # write_transaction already rolled back
         current_app.logger.error(f"Database error deleting post {post_id}: {e}")
-        conn.rollback()
         return False
 
 
@@ -282,16 +1245,18 @@ def add_or_get_tag(tag_name):
     conn = get_db()
     tag_id = None
     try:
-        # Try selecting first (more common case)
-        result = conn.execute("SELECT id FROM tags WHERE name = ?", (tag_name,)).fetchone()
-        if result:
-            tag_id = result['id']
+        # Try the tag cache first (more common case); it reads tags it doesn't hold
+        cache = get_tag_cache(conn)
+        tag = cache.resolve_names(conn, [tag_name]).get(tag_name)
+        if tag:
+            tag_id = tag.id
         else:
             # If not found, try inserting
             try:
                 cursor = conn.execute("INSERT INTO tags (name) VALUES (?)", (tag_name,))
                 conn.commit()
                 tag_id = cursor.lastrowid
+                cache.add([models.Tag(id=tag_id, name=tag_name)])
             except sqlite3.IntegrityError: # Handles race condition if tag inserted between SELECT and INSERT
                 conn.rollback() # Rollback the failed INSERT attempt
                 # Fetch again, it should exist now
@@ -315,6 +1280,7 @@ def link_post_tag(post_id, tag_id):
             (post_id, tag_id)
         )
         conn.commit()
+        notify_change(_post_change_keys(conn, post_id))
         return True
     except sqlite3.IntegrityError: # Link likely already exists or invalid ID
         conn.rollback() # Rollback the failed insert
@@ -333,12 +1299,72 @@ def link_post_tag(post_id, tag_id):
         conn.rollback()
         return False
 
+def _write_post_tags(conn, post_id, tag_names):
+    """Makes a post's tag links match `tag_names`, inside the caller's transaction.
+
+    Known tags are resolved through the tag cache (checked against the
+    'tags' counter inside this transaction); missing ones are upserted in one
+    executemany and their IDs read with a single SELECT ... IN. Then only the
+    links that actually changed are deleted or inserted. Does not commit.
+
+    Returns:
+        The set of tag IDs the post is now linked to.
+    """
+    names = list(dict.fromkeys(name.strip() for name in tag_names if name and name.strip()))
+    desired_ids = set()
+    if names:
+        known = get_tag_cache(conn, force_check=True).cached_names(names)
+        desired_ids = {tag.id for tag in known.values()}
+        missing = [name for name in names if name not in known]
+        if missing:
+            conn.executemany(
+                "INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+                [(name,) for name in missing]
+            )
+            rows = conn.execute(
+                "SELECT id FROM tags WHERE name IN (SELECT value FROM json_each(?))",
+                (json.dumps(missing),)
+            ).fetchall()
+            desired_ids |= {row['id'] for row in rows}
+
+    current_ids = {row['tag_id'] for row in conn.execute(
+        "SELECT tag_id FROM post_tags WHERE post_id = ?", (post_id,)
+    )}
+    removed = current_ids - desired_ids
+    added = desired_ids - current_ids
+    if removed:
+        conn.executemany("DELETE FROM post_tags WHERE post_id = ? AND tag_id = ?",
+                         [(post_id, tag_id) for tag_id in removed])
+    if added:
+        conn.executemany("INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)",
+                         [(post_id, tag_id) for tag_id in added])
+    return desired_ids
+
+def set_post_tags(post_id, tag_names):
+    """Replaces a post's tags with `tag_names` in a single transaction.
+
+    Returns:
+        True on success, False on a database error (nothing is changed then).
+    """
+    conn = get_db()
+    try:
+        with write_transaction(conn):
+            changed = _post_change_keys(conn, post_id, tag_names)
+            _write_post_tags(conn, post_id, tag_names)
+        notify_change(changed)
+        return True
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in set_post_tags for post {post_id}: {e}")
+        return False
+
 def unlink_all_tags_for_post(post_id):
     """Removes all tag associations for a specific post."""
     conn = get_db()
     try:
+        changed = _post_change_keys(conn, post_id)
         conn.execute("DELETE FROM post_tags WHERE post_id = ?", (post_id,))
         conn.commit()
+        notify_change(changed)
         return True
     except sqlite3.Error as e:
         current_app.logger.error(f"DB error in unlink_all_tags_for_post for post {post_id}: {e}")
@@ -347,9 +1373,8 @@ def unlink_all_tags_for_post(post_id):
 
 def get_tags_for_post(post_id):
     """Retrieves all tags associated with a specific post."""
-    conn = get_db()
     try:
-        tags = conn.execute("""
+        tags = execute_as(models.Tag, """
             SELECT t.id, t.name
             FROM tags t
             JOIN post_tags pt ON t.id = pt.tag_id
@@ -361,31 +1386,271 @@ def get_tags_for_post(post_id):
         current_app.logger.error(f"DB error in get_tags_for_post for post {post_id}: {e}")
         return []
 
-def get_posts_by_tag(tag_name):
-    """Retrieves all posts associated with a specific tag name, including image."""
+def get_posts_by_tag(tag_name, columns=POST_DETAIL_COLUMNS):
+    """Retrieves all posts associated with a specific tag name, including image.
+
+    Pass columns=POST_SUMMARY_COLUMNS to skip loading the post bodies.
+    """
     conn = get_db()
     try:
-        posts = conn.execute("""
-            SELECT p.id, p.title, p.content, p.published_date, p.image_filename -- Add image_filename
+        tag = get_tag_cache(conn).resolve_names(conn, [tag_name]).get(tag_name)
+        if tag is None:
+            return []
+        posts = execute_as(models.Post, f"""
+            SELECT {post_columns_sql(columns, 'p')}
             FROM posts p
             JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE t.name = ?
+            WHERE pt.tag_id = ?
             ORDER BY p.published_date DESC
-        """, (tag_name,)).fetchall()
+        """, (tag.id,), conn=conn).fetchall()
         return posts
     except sqlite3.Error as e:
         current_app.logger.error(f"DB error in get_posts_by_tag for tag '{tag_name}': {e}")
         return []
 
+def iter_tags_with_counts():
+    """Yields every tag (name, post_count) in name order, straight from the cursor.
+
+    Rows are not fetched into a list first, so callers can stream them out.
+    """
+    try:
+        cursor = execute_as(models.Tag, """
+            SELECT name, post_count FROM tags ORDER BY name
+        """)
+        yield from cursor
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in iter_tags_with_counts: {e}")
+
+def get_tags_for_posts(post_ids):
+    """Retrieves the tags for many posts at once, grouped by post ID.
+
+    Uses a single query on post_tags no matter how many IDs are given: the
+    IDs are passed as one JSON array parameter, so SQLite's bound-variable
+    limit never applies. Tag names come from the tag cache, so the tags
+    table is only read for tags it doesn't hold.
+
+    Returns:
+        A dict mapping each post ID to its list of Tags (ordered by name).
+        Posts without tags map to an empty list. A tag on several posts is
+        the same Tag object in each list.
+    """
+    tags_by_post = {post_id: [] for post_id in post_ids}
+    if not tags_by_post:
+        return tags_by_post # Nothing to look up, skip the query entirely
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.row_factory = None # Plain tuples
+    try:
+        links = cursor.execute("""
+            SELECT post_id, tag_id FROM post_tags
+            WHERE post_id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(list(tags_by_post)),)).fetchall()
+        tags = get_tag_cache(conn).resolve_ids(conn, [tag_id for _, tag_id in links])
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_tags_for_posts: {e}")
+        return tags_by_post
+    for post_id, tag_id in links:
+        tag = tags.get(tag_id)
+        if tag is not None: # None only if the tag was deleted in between
+            tags_by_post[post_id].append(tag)
+    for post_tags in tags_by_post.values():
+        post_tags.sort(key=operator.attrgetter('name'))
+    return tags_by_post
+
+def encode_cursor(post):
+    """Builds the keyset cursor for a post (or comment): its published date and ID.
+
+    The date is written back exactly as SQLite stores it, so comparing the
+    cursor against the published_date column gives the same ordering.
+    """
+    return f"{post['published_date'].isoformat(' ')}~{post['id']}"
+
+def decode_cursor(cursor):
+    """Parses a cursor made by encode_cursor().
+
+    Returns:
+        A (published_date_text, post_id) tuple, or None if the cursor is malformed.
+    """
+    published_date, sep, post_id = (cursor or '').rpartition('~')
+    if not sep:
+        return None
+    try:
+        datetime.datetime.fromisoformat(published_date) # Validate only, keep the text
+        return published_date, int(post_id)
+    except ValueError:
+        return None
+
+def get_posts_with_tags(tag_name=None, before=None, after=None, limit=None,
+                        columns=POST_SUMMARY_COLUMNS, with_tags=True):
+    """Retrieves posts with their tags attached, in a constant number of queries.
+
+    One query loads the posts (all of them, or only those with `tag_name`)
+    and one more loads the tags for every post returned, instead of calling
+    get_tags_for_post() once per post.
+
+    Args:
+        tag_name: Only return posts with this tag (optional).
+        before: Decoded cursor; only return posts older than it (optional).
+        after: Decoded cursor; only return posts newer than it (optional).
+        limit: Maximum number of posts to return (optional, None = all).
+        columns: Post columns to load; summaries by default, so no bodies are read.
+            'id' and 'published_date' are always included for the cursors.
+        with_tags: Set to False to skip the tag query (post.tags is left unset).
+
+    Returns:
+        A list of Posts, newest first, each with its list of Tags in post.tags.
+    """
+    conn = get_db()
+    columns = tuple(dict.fromkeys(('id', 'published_date') + tuple(columns)))
+    sql = f"SELECT {post_columns_sql(columns, 'p')} FROM posts p"
+    where, params = [], []
+    if tag_name is not None:
+        # The tag cache turns the name into an ID, so the tags table isn't joined
+        try:
+            tag = get_tag_cache(conn).resolve_names(conn, [tag_name]).get(tag_name)
+        except sqlite3.Error as e:
+            current_app.logger.error(f"DB error in get_posts_with_tags (tag {tag_name!r}): {e}")
+            return []
+        if tag is None:
+            return [] # No such tag, so no posts
+        sql += " JOIN post_tags pt ON pt.post_id = p.id"
+        where.append("pt.tag_id = ?")
+        params.append(tag.id)
+    # Keyset conditions on (published_date, id): the index seek costs the same
+    # on page 1 and page 1000, unlike OFFSET which walks every skipped row
+    if before is not None:
+        where.append("(p.published_date, p.id) < (?, ?)")
+        params.extend(before)
+    elif after is not None:
+        where.append("(p.published_date, p.id) > (?, ?)")
+        params.extend(after)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    # Rows newer than an 'after' cursor are read upwards from it, then flipped
+    direction = "ASC" if before is None and after is not None else "DESC"
+    sql += f" ORDER BY p.published_date {direction}, p.id {direction}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    try:
+        posts = execute_as(models.Post, sql, params, conn=conn).fetchall()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_posts_with_tags (tag {tag_name!r}): {e}")
+        return []
+    if direction == "ASC":
+        posts.reverse()
+
+    if with_tags:
+        tags_by_post = get_tags_for_posts([post.id for post in posts])
+        for post in posts:
+            post.tags = tags_by_post[post.id]
+    return posts
+
+def get_posts_page(tag_name=None, before=None, after=None, limit=DEFAULT_PAGE_SIZE,
+                   columns=POST_SUMMARY_COLUMNS, with_tags=True):
+    """Retrieves one page of posts (with tags) using keyset pagination.
+
+    Pages are anchored on (published_date, id) cursors rather than offsets,
+    so every page costs the same no matter how deep into the archive it is.
+
+    Args:
+        tag_name: Only page through posts with this tag (optional).
+        before: Decoded cursor; the page holds the posts just older than it.
+        after: Decoded cursor; the page holds the posts just newer than it.
+        limit: Page size, clamped to 1..MAX_PAGE_SIZE.
+        columns: Post columns to load (summary columns by default).
+        with_tags: Set to False to skip loading each post's tags.
+
+    Returns:
+        A dict with 'posts' (newest first), plus 'next_cursor' (older posts)
+        and 'prev_cursor' (newer posts), each None when there is no such page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # Fetch one extra row to learn whether another page exists beyond this one
+    posts = get_posts_with_tags(tag_name=tag_name, before=before, after=after, limit=limit + 1,
+                                columns=columns, with_tags=with_tags)
+    has_more = len(posts) > limit
+
+    if after is not None and before is None:
+        # Walking towards newer posts: the surplus row is the newest one
+        if has_more:
+            posts = posts[1:]
+        next_cursor = encode_cursor(posts[-1]) if posts else None
+        prev_cursor = encode_cursor(posts[0]) if posts and has_more else None
+    else:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(posts[-1]) if posts and has_more else None
+        prev_cursor = encode_cursor(posts[0]) if posts and before is not None else None
+
+    return {'posts': posts, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+
+
+# --- Full-Text Search ---
+
+SEARCH_PAGE_SIZE = 10
+MAX_SEARCH_PAGE = 50 # Ranked results can't use keyset cursors; cap the OFFSET instead
+# Markers placed around matched terms by snippet(); the view escapes the
+# snippet text and turns them into <mark> tags
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+def build_fts_query(text):
+    """Turns free text from the search box into a safe FTS5 MATCH expression.
+
+    Every word becomes a quoted phrase (so FTS5 operators and punctuation in
+    user input can't cause syntax errors) and all words must match. The last
+    word is a prefix match, so partially typed words still find results.
+
+    Returns:
+        The MATCH expression, or None if the text contains no words.
+    """
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+def search_posts(query_text, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Searches post titles, bodies and tag names, best matches first.
+
+    Results are ranked with bm25, weighting title and tag hits above body
+    hits, and each carries a snippet with the matched terms wrapped in
+    HIGHLIGHT_START/HIGHLIGHT_END.
+
+    Returns:
+        A dict with 'results' (summary columns plus 'snippet'), 'page' and
+        'has_next'.
+    """
+    page = max(1, min(page, MAX_SEARCH_PAGE))
+    empty = {'results': [], 'page': page, 'has_next': False}
+    match = build_fts_query(query_text)
+    if match is None:
+        return empty
+    conn = get_db()
+    try:
+        rows = conn.execute(f"""
+            SELECT {post_columns_sql(POST_SUMMARY_COLUMNS, 'p')},
+                   snippet(posts_fts, -1, ?, ?, '\u2026', 24) AS snippet
+            FROM posts_fts
+            JOIN posts p ON p.id = posts_fts.rowid
+            WHERE posts_fts MATCH ?
+            ORDER BY bm25(posts_fts, 10.0, 1.0, 5.0)
+            LIMIT ? OFFSET ?
+        """, (HIGHLIGHT_START, HIGHLIGHT_END, match, per_page + 1, (page - 1) * per_page)).fetchall()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in search_posts for {query_text!r}: {e}")
+        return empty
+    return {'results': rows[:per_page], 'page': page, 'has_next': len(rows) > per_page}
+
 
 # --- Comment Operations (Unchanged by Image Feature) ---
 
 def get_comments_for_post(post_id):
     """Retrieves all comments for a specific post."""
-    conn = get_db()
     try:
-        comments = conn.execute("""
+        comments = execute_as(models.Comment, """
             SELECT id, author, content, published_date
             FROM comments
             WHERE post_id = ?
@@ -396,6 +1661,38 @@ def get_comments_for_post(post_id):
         current_app.logger.error(f"DB error in get_comments_for_post for post {post_id}: {e}")
         return []
 
+def get_comments_page(post_id, after=None, limit=COMMENT_PAGE_SIZE):
+    """Retrieves one page of a post's comments, oldest first, using keyset pagination.
+
+    Seeks idx_comments_post_published, whose entries end in the comment's
+    rowid (= id), so it is ordered by (post_id, published_date, id): any page
+    is read straight off the index without sorting or skipping rows.
+
+    Args:
+        post_id: The post whose comments to load.
+        after: Decoded cursor (see decode_cursor); the page holds the comments just after it.
+        limit: Page size, clamped to 1..MAX_PAGE_SIZE.
+
+    Returns:
+        A dict with 'comments' and 'next_cursor' (None on the last page).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sql = "SELECT id, author, content, published_date FROM comments WHERE post_id = ?"
+    params = [post_id]
+    if after is not None:
+        sql += " AND (published_date, id) > (?, ?)"
+        params.extend(after)
+    sql += " ORDER BY published_date, id LIMIT ?"
+    params.append(limit + 1) # One extra row tells whether there is a next page
+    try:
+        comments = execute_as(models.Comment, sql, params).fetchall()
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error in get_comments_page for post {post_id}: {e}")
+        return {'comments': [], 'next_cursor': None}
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+    return {'comments': comments, 'next_cursor': encode_cursor(comments[-1]) if has_more else None}
+
 def add_comment(post_id, author, content):
     """Adds a new comment to a specific post."""
     conn = get_db()
@@ -405,8 +1702,33 @@ def add_comment(post_id, author, content):
             (post_id, author, content)
         )
         conn.commit()
+        notify_change({f"post:{post_id}"}) # Comments only appear on the post's own page
         return cursor.lastrowid
     except sqlite3.Error as e:
         current_app.logger.error(f"DB error in add_comment for post {post_id}: {e}")
         conn.rollback()
         return None
+
+def add_comments(comments):
+    """Adds several comments in one transaction (one commit, one fsync).
+
+    Args:
+        comments: (post_id, author, content) tuples.
+
+    Returns:
+        The number of comments written. If the batch fails (e.g. one post
+        was deleted meanwhile), the comments are retried one at a time so
+        only the offending ones are lost.
+    """
+    conn = get_db()
+    comments = list(comments)
+    try:
+        with write_transaction(conn):
+            conn.executemany("INSERT INTO comments (post_id, author, content) VALUES (?, ?, ?)", comments)
+        written = comments
+    except sqlite3.Error as e:
+        current_app.logger.warning(f"Batch of {len(comments)} comments failed ({e}); retrying one by one")
+        written = [comment for comment in comments if add_comment(*comment) is not None]
+        return len(written) # add_comment already notified
+    notify_change({f"post:{post_id}" for post_id, _, _ in written})
+    return len(written)
@@ -0,0 +1,245 @@
+# images.py
+
+import os
+import json
+import click
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app, url_for
+from flask.cli import with_appcontext
+
+# Pillow is optional: without it uploads still work, but no derivatives are
+# generated and templates fall back to the original image
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# What decoding an image can raise: I/O and format errors, and Pillow's
+# decompression bomb checks (the warning too, when warnings are errors)
+DECODE_ERRORS = (OSError, ValueError)
+if Image is not None:
+    DECODE_ERRORS += (Image.DecompressionBombError, Image.DecompressionBombWarning)
+
+# --- Derivative settings ---
+# Derivatives live next to the originals, in a subfolder of the upload folder:
+#   uploads/images/<name>.jpg -> uploads/images/derived/<name>-320.jpg, <name>-320.webp, ...
+DERIVED_FOLDER_NAME = 'derived'
+DEFAULT_DERIVATIVE_WIDTHS = (320, 640, 1280)
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+# GIFs are often animated; resizing would keep only the first frame
+RESIZABLE_FORMATS = {'JPEG': 'jpg', 'PNG': 'png'}
+
+# Manifests read by templates, cached per process (image path -> manifest)
+_manifest_cache = {}
+
+
+def _derived_paths(static_folder, relative_image_path):
+    """Returns (derived folder, file stem, relative derived folder) for an image."""
+    relative_folder, filename = os.path.split(relative_image_path)
+    stem = os.path.splitext(filename)[0]
+    relative_derived = f"{relative_folder}/{DERIVED_FOLDER_NAME}".lstrip('/')
+    return os.path.join(static_folder, relative_derived), stem, relative_derived
+
+
+def image_pixels(path):
+    """Returns an image's width * height, read from its header without decoding it.
+
+    Images above Pillow's hard decompression bomb limit count as infinitely
+    large. Returns None if Pillow isn't installed.
+
+    Raises:
+        OSError: If the file isn't an image Pillow can read.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        return float('inf')
+    return width * height
+
+
+def _save_atomically(image, path, **save_options):
+    """Writes an image to a temporary file first, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    image.save(tmp_path, **save_options)
+    os.replace(tmp_path, path)
+
+
+def generate_derivatives(static_folder, relative_image_path, widths=DEFAULT_DERIVATIVE_WIDTHS, force=False):
+    """Creates resized copies and WebP variants of an uploaded image.
+
+    Runs without an app context so it can be used from a process pool.
+    Widths at or above the original's width are skipped (never upscale);
+    the original width gets a WebP variant only. A small JSON manifest is
+    written last and is what templates use to build srcset attributes.
+
+    Returns:
+        The manifest dict, or None if the image can't be processed.
+    """
+    if Image is None:
+        return None
+    source_path = os.path.join(static_folder, relative_image_path)
+    derived_folder, stem, relative_derived = _derived_paths(static_folder, relative_image_path)
+    manifest_path = os.path.join(derived_folder, f"{stem}.json")
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    with Image.open(source_path) as original:
+        # Pillow only warns between MAX_IMAGE_PIXELS and twice that; don't decode those either
+        if Image.MAX_IMAGE_PIXELS and original.width * original.height > Image.MAX_IMAGE_PIXELS:
+            raise Image.DecompressionBombError(
+                f"{original.width}x{original.height} pixels exceeds the limit of {Image.MAX_IMAGE_PIXELS}")
+        extension = RESIZABLE_FORMATS.get(original.format)
+        if extension is None:
+            return None
+        image = ImageOps.exif_transpose(original) # Apply camera rotation before resizing
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if extension == 'png' and has_alpha else 'RGB')
+        original_width, original_height = image.size
+        os.makedirs(derived_folder, exist_ok=True)
+
+        manifest = {'width': original_width, 'fallback': [], 'webp': []}
+        for width in sorted({w for w in widths if w < original_width} | {original_width}):
+            if width == original_width:
+                resized = image
+            else:
+                height = max(1, round(original_height * width / original_width))
+                resized = image.resize((width, height), Image.LANCZOS)
+                fallback_name = f"{stem}-{width}.{extension}"
+                if extension == 'jpg':
+                    _save_atomically(resized, os.path.join(derived_folder, fallback_name),
+                                     format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+                else:
+                    _save_atomically(resized, os.path.join(derived_folder, fallback_name),
+                                     format='PNG', optimize=True)
+                manifest['fallback'].append([f"{relative_derived}/{fallback_name}", width])
+            webp_name = f"{stem}-{width}.webp"
+            _save_atomically(resized, os.path.join(derived_folder, webp_name),
+                             format='WEBP', quality=WEBP_QUALITY, method=4)
+            manifest['webp'].append([f"{relative_derived}/{webp_name}", width])
+
+    # The original is the largest fallback candidate
+    manifest['fallback'].append([relative_image_path, original_width])
+    tmp_manifest = f"{manifest_path}.tmp"
+    with open(tmp_manifest, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, manifest_path)
+    _manifest_cache.pop(relative_image_path, None)
+    return manifest
+
+
+def create_derivatives(relative_image_path):
+    """Generates derivatives for a just-saved upload (within an app context).
+
+    Failures are logged and otherwise ignored: the original is still served.
+    """
+    widths = current_app.config.get('IMAGE_DERIVATIVE_WIDTHS', DEFAULT_DERIVATIVE_WIDTHS)
+    try:
+        return generate_derivatives(current_app.static_folder, relative_image_path, widths)
+    except DECODE_ERRORS as e:
+        current_app.logger.warning(f"Could not create derivatives for {relative_image_path}: {e}")
+        return None
+
+
+def delete_derivatives(static_folder, relative_image_path):
+    """Removes every derivative (and the manifest) of an image. Returns the count removed."""
+    derived_folder, stem, _ = _derived_paths(static_folder, relative_image_path)
+    _manifest_cache.pop(relative_image_path, None)
+    removed = 0
+    if not os.path.isdir(derived_folder):
+        return removed
+    prefix = f"{stem}-"
+    with os.scandir(derived_folder) as entries:
+        for entry in entries:
+            if entry.name == f"{stem}.json" or (entry.name.startswith(prefix)
+                                                and entry.name[len(prefix):].split('.')[0].isdigit()):
+                os.remove(entry.path)
+                removed += 1
+    return removed
+
+
+def load_manifest(relative_image_path):
+    """Returns the derivative manifest for an image, or None if there is none."""
+    if relative_image_path not in _manifest_cache:
+        derived_folder, stem, _ = _derived_paths(current_app.static_folder, relative_image_path)
+        try:
+            with open(os.path.join(derived_folder, f"{stem}.json")) as f:
+                _manifest_cache[relative_image_path] = json.load(f)
+        except (OSError, ValueError):
+            return None # Not generated yet; don't cache so a backfill is picked up
+    return _manifest_cache[relative_image_path]
+
+
+def responsive_image(relative_image_path):
+    """Builds the src/srcset values for an image (used as a template global).
+
+    Returns:
+        A dict with 'src', 'srcset' and 'webp_srcset'; both srcsets are
+        empty strings when no derivatives exist.
+    """
+    image = {'src': url_for('static', filename=relative_image_path), 'srcset': '', 'webp_srcset': ''}
+    manifest = load_manifest(relative_image_path)
+    if manifest:
+        for key, variant in (('srcset', 'fallback'), ('webp_srcset', 'webp')):
+            image[key] = ', '.join(f"{url_for('static', filename=path)} {width}w"
+                                   for path, width in manifest[variant])
+    return image
+
+
+def _rebuild_one(job):
+    """Process pool worker: (static_folder, relative path, widths, force) -> (path, ok, error)."""
+    static_folder, relative_image_path, widths, force = job
+    try:
+        return relative_image_path, generate_derivatives(static_folder, relative_image_path, widths, force) is not None, None
+    except DECODE_ERRORS as e:
+        return relative_image_path, False, str(e)
+
+
+def iter_original_images(static_folder, upload_folder):
+    """Yields the relative paths of uploaded originals (not derivatives)."""
+    full_folder = os.path.join(static_folder, upload_folder)
+    if not os.path.isdir(full_folder):
+        return
+    with os.scandir(full_folder) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                yield f"{upload_folder}/{entry.name}"
+
+
+@click.command('rebuild-thumbnails')
+@click.option('--workers', default=None, type=int, help='Worker processes (default: one per CPU).')
+@click.option('--force', is_flag=True, help='Regenerate derivatives that already exist.')
+@with_appcontext
+def rebuild_thumbnails_command(workers, force):
+    """Create resized and WebP derivatives for all existing uploads."""
+    if Image is None:
+        click.echo('Pillow is not installed; cannot build thumbnails.', err=True)
+        return
+    import db # Imported here to avoid a circular import at module load
+    static_folder = current_app.static_folder
+    widths = tuple(current_app.config.get('IMAGE_DERIVATIVE_WIDTHS', DEFAULT_DERIVATIVE_WIDTHS))
+    jobs = ((static_folder, path, widths, force)
+            for path in iter_original_images(static_folder, db.IMAGE_UPLOAD_FOLDER))
+    built = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, ok, error in executor.map(_rebuild_one, jobs, chunksize=8):
+            if error:
+                failed += 1
+                click.echo(f"  Failed {path}: {error}", err=True)
+            elif ok:
+                built += 1
+            else:
+                skipped += 1 # Unsupported format (e.g. GIF)
+    _manifest_cache.clear()
+    click.echo(f"Derivatives ready for {built} images ({skipped} skipped, {failed} failed).")
+
+
+def init_app(app):
+    """Register image helpers and commands with the Flask app."""
+    app.config.setdefault('IMAGE_DERIVATIVE_WIDTHS', DEFAULT_DERIVATIVE_WIDTHS)
+    app.add_template_global(responsive_image)
+    app.cli.add_command(rebuild_thumbnails_command)
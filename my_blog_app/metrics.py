@@ -0,0 +1,332 @@
+# metrics.py
+
+import os
+import re
+import glob
+import mmap
+import time
+import fcntl
+import struct
+import bisect
+import threading
+import contextlib
+from flask import Response, current_app, g, request
+import db
+
+# --- Prometheus-style metrics ---
+# Each process writes its samples to its own file in METRICS_DIR, mapped
+# into memory: recording a sample is a dict lookup and an 8-byte write, with
+# no IPC and no locks shared between processes. GET /metrics reads every
+# process's file and adds them up, so all workers are reported together,
+# in the Prometheus text exposition format.
+#
+# Within a process, MetricsFile.add still takes a lock: with a threaded
+# server, two threads may bump the same value, and the read-add-write of a
+# float in the map is not atomic, even under the GIL. The lock is never
+# shared with other processes and is uncontended in a worker serving one
+# request at a time, where taking it costs well under a microsecond.
+#
+# Files of workers that have exited are folded into metrics-merged.db and
+# removed (when a worker starts, and on every scrape), so their counts are
+# kept without the directory growing with every restart, and a new process
+# that is given a recycled pid starts from zero. Folding holds an exclusive
+# flock on metrics.lock, and reading a shared one, so a scrape never counts
+# a file both before and after it was folded. Liveness is checked with
+# os.kill(pid, 0), so METRICS_DIR must not be shared between hosts.
+#
+# File layout: an 8-byte header holding the number of bytes in use, then
+# entries of (uint32 key length, key padded to 8 bytes, float64 value). A
+# key is the sample as written in the exposition, e.g.
+# 'blog_http_requests_total{endpoint="index",method="GET",status="200"}'.
+# Histogram buckets are stored cumulatively, so the files can be summed
+# sample by sample.
+
+# Defaults, overridable through app.config
+METRICS_DEFAULTS = {
+    'METRICS_ENABLED': True,
+    'METRICS_DIR': None, # Shared by all workers; defaults to <instance path>/metrics
+}
+
+_HEADER = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+INITIAL_FILE_SIZE = 64 * 1024
+MERGED_FILE = 'metrics-merged.db'
+LOCK_FILE = 'metrics.lock'
+_PROCESS_FILE = re.compile(r'metrics-(\d+)\.db')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name -> (type, help); the order here is the order of the exposition
+FAMILIES = {
+    'blog_http_requests_total': ('counter', 'Requests served, by endpoint, method and status.'),
+    'blog_http_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint.'),
+    'blog_http_response_size_bytes': ('histogram', 'Response body size (after compression), by endpoint.'),
+    'blog_db_queries_total': ('counter', 'SQL statements run, by endpoint.'),
+    'blog_db_duration_seconds_total': ('counter', 'Time spent in SQL statements, by endpoint.'),
+    'blog_page_cache_requests_total': ('counter', 'Page cache lookups, by result (hit or miss).'),
+    'blog_page_cache_hit_ratio': ('gauge', 'Page cache hits / lookups, over all workers.'),
+    'blog_uploads_total': ('counter', 'Accepted image uploads, by whether the file was new or a duplicate.'),
+    'blog_upload_bytes_total': ('counter', 'Bytes of accepted image uploads.'),
+}
+_SUFFIXES = ('_bucket', '_sum', '_count')
+
+
+def _sample_key(name, labels):
+    if not labels:
+        return name
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in zip(labels, escaped)) + '}'
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class MetricsFile:
+    """One process's samples, in a memory-mapped file only that process writes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock() # Between this process's threads only
+        self._offsets = {} # key -> offset of its value
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, 'r+b')
+        size = os.fstat(fd).st_size
+        if size < INITIAL_FILE_SIZE:
+            self._file.truncate(INITIAL_FILE_SIZE)
+            size = INITIAL_FILE_SIZE
+        self._map = mmap.mmap(fd, size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0] or _HEADER.size
+        # Reopened files (the merged one) carry on from their values
+        for key, offset, _ in _iter_entries(self._map, self._used):
+            self._offsets[key] = offset
+
+    def _allocate(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * (-(_LENGTH.size + len(encoded)) % 8)
+        needed = _LENGTH.size + len(padded) + _VALUE.size
+        if self._used + needed > len(self._map):
+            new_size = max(len(self._map) * 2, self._used + needed)
+            self._map.close()
+            self._file.truncate(new_size)
+            self._map = mmap.mmap(self._file.fileno(), new_size)
+        offset = self._used
+        _LENGTH.pack_into(self._map, offset, len(encoded))
+        self._map[offset + _LENGTH.size:offset + _LENGTH.size + len(padded)] = padded
+        value_offset = offset + _LENGTH.size + len(padded)
+        _VALUE.pack_into(self._map, value_offset, 0.0)
+        # Publish the entry only once it is complete, for readers in other processes
+        self._used += needed
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._offsets[key] = value_offset
+        return value_offset
+
+    def add(self, key, amount):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._allocate(key)
+            _VALUE.pack_into(self._map, offset, _VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+def _iter_entries(buffer, used):
+    """Yields (key, value offset, value) for each entry in a metrics file."""
+    offset = _HEADER.size
+    while offset + _LENGTH.size <= used:
+        length = _LENGTH.unpack_from(buffer, offset)[0]
+        key_end = offset + _LENGTH.size + length
+        value_offset = key_end + (-(_LENGTH.size + length) % 8)
+        if value_offset + _VALUE.size > used:
+            break
+        key = bytes(buffer[offset + _LENGTH.size:key_end]).decode('utf-8')
+        yield key, value_offset, _VALUE.unpack_from(buffer, value_offset)[0]
+        offset = value_offset + _VALUE.size
+
+def _read_file(path):
+    """Yields (key, value) for each entry in a metrics file; nothing if it is gone."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return
+    if len(data) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    for key, _, value in _iter_entries(data, used):
+        yield key, value
+
+@contextlib.contextmanager
+def _directory_lock(directory, exclusive):
+    with open(os.path.join(directory, LOCK_FILE), 'ab') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, but belongs to another user
+    return True
+
+def fold_dead_files(directory, own_pid=None):
+    """Adds the files of processes that have exited into the merged file, and removes them.
+
+    Args:
+        directory: The METRICS_DIR.
+        own_pid: The calling process's pid when it is about to open its own
+            file: a file with that name was left by an earlier process the
+            pid was recycled from, so it is folded too.
+
+    Returns:
+        The number of files folded.
+    """
+    if not os.path.isdir(directory):
+        return 0
+    with _directory_lock(directory, exclusive=True):
+        dead = []
+        for path in sorted(glob.glob(os.path.join(directory, 'metrics-*.db'))):
+            match = _PROCESS_FILE.fullmatch(os.path.basename(path))
+            if match and (int(match.group(1)) == own_pid or not _is_running(int(match.group(1)))):
+                dead.append(path)
+        if not dead:
+            return 0
+        merged = MetricsFile(os.path.join(directory, MERGED_FILE))
+        try:
+            for path in dead:
+                for key, value in _read_file(path):
+                    merged.add(key, value)
+                os.remove(path)
+        finally:
+            merged.close()
+    return len(dead)
+
+def read_samples(directory):
+    """Adds up the samples of every process's file in `directory` (and the merged file), in first-seen order."""
+    if not os.path.isdir(directory):
+        return {}
+    totals = {}
+    with _directory_lock(directory, exclusive=False):
+        for path in sorted(glob.glob(os.path.join(directory, 'metrics-*.db'))):
+            for key, value in _read_file(path):
+                totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+class Metrics:
+    """Records request, database, cache and upload metrics for an app."""
+
+    def init_app(self, app):
+        for key, default in METRICS_DEFAULTS.items():
+            app.config.setdefault(key, default)
+        app.before_request(self._start_timer)
+        app.after_request(self._record_response)
+        db.image_uploaded.connect(self._on_image_uploaded, sender=app, weak=False)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def get_directory(self, app=None):
+        app = app or current_app
+        return app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+
+    def get_file(self, app=None):
+        """Returns this process's metrics file, opening it on first use (and after a fork)."""
+        app = app or current_app
+        directory = self.get_directory(app)
+        metrics_file = app.extensions.get('metrics_file')
+        if metrics_file is not None and metrics_file[0] == (directory, os.getpid()):
+            return metrics_file[1]
+        if metrics_file is not None and metrics_file[0][1] == os.getpid():
+            metrics_file[1].close()
+        os.makedirs(directory, exist_ok=True)
+        fold_dead_files(directory, own_pid=os.getpid())
+        opened = MetricsFile(os.path.join(directory, f"metrics-{os.getpid()}.db"))
+        app.extensions['metrics_file'] = ((directory, os.getpid()), opened)
+        return opened
+
+    def inc(self, name, labels=None, amount=1.0):
+        self.get_file().add(_sample_key(name, labels), amount)
+
+    def observe(self, name, value, buckets, labels=None):
+        """Records one histogram observation (buckets are cumulative)."""
+        labels = labels or {}
+        metrics_file = self.get_file()
+        first = bisect.bisect_left(buckets, value)
+        for index, bound in enumerate(buckets + (float('inf'),)):
+            # Touch every bucket so the series is complete from the first observation
+            metrics_file.add(_sample_key(f"{name}_bucket", dict(labels, le=_format_bound(bound))),
+                             1.0 if index >= first else 0.0)
+        metrics_file.add(_sample_key(f"{name}_sum", labels), value)
+        metrics_file.add(_sample_key(f"{name}_count", labels), 1.0)
+
+    def _start_timer(self):
+        g.metrics_started = time.perf_counter()
+
+    def _record_response(self, response):
+        if not current_app.config.get('METRICS_ENABLED') or 'metrics_started' not in g:
+            return response
+        endpoint = request.endpoint or 'unmatched' # Unrouted URLs share one series
+        labels = {'endpoint': endpoint}
+        self.inc('blog_http_requests_total',
+                 {'endpoint': endpoint, 'method': request.method, 'status': response.status_code})
+        self.observe('blog_http_request_duration_seconds', time.perf_counter() - g.metrics_started,
+                     LATENCY_BUCKETS, labels)
+        size = response.calculate_content_length()
+        if size is not None: # Unknown for streamed responses
+            self.observe('blog_http_response_size_bytes', size, SIZE_BUCKETS, labels)
+        stats = g.get('query_stats')
+        if stats is not None and stats.count:
+            self.inc('blog_db_queries_total', labels, stats.count)
+            self.inc('blog_db_duration_seconds_total', labels, stats.seconds)
+        cache_result = response.headers.get('X-Cache')
+        if cache_result in ('HIT', 'MISS'):
+            self.inc('blog_page_cache_requests_total', {'result': cache_result.lower()})
+        return response
+
+    def _on_image_uploaded(self, app, size_bytes, stored):
+        if app.config.get('METRICS_ENABLED'):
+            self.inc('blog_uploads_total', {'result': 'stored' if stored else 'duplicate'})
+            self.inc('blog_upload_bytes_total', amount=size_bytes)
+
+    def render(self, app=None):
+        """The metrics of all processes, in the Prometheus text exposition format."""
+        directory = self.get_directory(app)
+        fold_dead_files(directory)
+        samples = read_samples(directory)
+        hits = samples.get(_sample_key('blog_page_cache_requests_total', {'result': 'hit'}), 0.0)
+        misses = samples.get(_sample_key('blog_page_cache_requests_total', {'result': 'miss'}), 0.0)
+        samples['blog_page_cache_hit_ratio'] = hits / (hits + misses) if hits + misses else 0.0
+
+        by_family = {name: [] for name in FAMILIES}
+        for key, value in samples.items():
+            name = key.split('{', 1)[0]
+            if name not in FAMILIES:
+                name = next((name[:-len(suffix)] for suffix in _SUFFIXES if name.endswith(suffix)), name)
+            if name in by_family:
+                by_family[name].append(f"{key} {value!r}")
+        lines = []
+        for name, (metric_type, help_text) in FAMILIES.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(by_family[name])
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        if not current_app.config.get('METRICS_ENABLED'):
+            return Response('Metrics are disabled.\n', status=404, mimetype='text/plain')
+        return Response(self.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+metrics = Metrics()
+
+def init_app(app):
+    """Register the metrics hooks and the /metrics endpoint with the Flask app."""
+    metrics.init_app(app)
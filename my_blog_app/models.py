@@ -0,0 +1,128 @@
+# models.py
+
+# --- Read models ---
+# Small objects handed from the db.py loaders to views and templates. They
+# use __slots__, so each one is a fixed array of field references with no
+# per-instance __dict__: far smaller than a sqlite3.Row copied into a dict.
+#
+# Fields are read as attributes (post.title, which is what templates use)
+# or by name (post['title'], like the sqlite3.Row they replace), and dict()
+# accepts them. A loader that selects only some columns leaves the other
+# fields unset: reading one raises AttributeError/KeyError, which Jinja
+# renders as undefined, just like a missing dict key.
+
+
+_BUILDERS = {} # (model class, column names) -> function building an instance from a row
+
+def _compile_builder(cls, names):
+    """Generates a function that fills the `names` fields of a new `cls` from a row.
+
+    Like namedtuple, the code is generated so that filling an object is one
+    tuple unpack into its slots, with no per-column Python loop.
+    """
+    unknown = set(names) - set(cls.__slots__)
+    if unknown:
+        raise AttributeError(f"{cls.__name__} has no fields {sorted(unknown)}")
+    targets = ', '.join(f"obj.{name}" for name in names)
+    namespace = {'new': object.__new__, 'cls': cls}
+    exec(f"def build(row):\n    obj = new(cls)\n    {targets}, = row\n    return obj\n", namespace)
+    return namespace['build']
+
+
+class Model:
+    """Base class for the __slots__ read models."""
+    __slots__ = ()
+    _last_builder = None # (cursor.description, builder) of the latest query, per class
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        """sqlite3 row factory building an instance from a row, by column name.
+
+        Install it on a cursor (cursor.row_factory = Post.row_factory) to
+        fetch rows straight into models, without an intermediate Row.
+        """
+        description = cursor.description # The same tuple for every row of a query
+        last = cls._last_builder
+        if last is None or last[0] is not description:
+            last = cls._last_builder = (description, cls.builder(column[0] for column in description))
+        return last[1](row)
+
+    @classmethod
+    def builder(cls, names):
+        """A function building an instance from a sequence of values for the fields `names`."""
+        names = tuple(names)
+        builder = _BUILDERS.get((cls, names))
+        if builder is None:
+            builder = _BUILDERS[(cls, names)] = _compile_builder(cls, names)
+        return builder
+
+    def keys(self):
+        """The names of the fields that are set (lets dict(obj) copy it)."""
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name, None) == getattr(other, name, None) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.keys())
+        return f"{type(self).__name__}({fields})"
+
+
+class Post(Model):
+    """A post: any of the db.POST_COLUMNS, plus the tags attached by the list loaders."""
+    __slots__ = ('id', 'title', 'content', 'excerpt', 'published_date', 'updated_at', 'image_filename',
+                 'comment_count', 'tags')
+
+
+class Tag(Model):
+    """A tag; post_count is only set by the loaders that read it."""
+    __slots__ = ('id', 'name', 'post_count')
+
+
+class Comment(Model):
+    """A comment on a post."""
+    __slots__ = ('id', 'post_id', 'author', 'content', 'published_date')
+
+
+class PostBundle:
+    """A post with its tags and first page of comments, read in one snapshot.
+
+    Attributes:
+        post: The Post.
+        tags: Tuple of Tags, or None if not loaded.
+        comments: Tuple of Comments (first page, oldest first), or None if not loaded.
+        next_cursor: Cursor for the next page of comments, None on the last page.
+    """
+    __slots__ = ('post', 'tags', 'comments', 'next_cursor')
+
+    def __init__(self, post, tags=None, comments=None, next_cursor=None):
+        object.__setattr__(self, 'post', post)
+        object.__setattr__(self, 'tags', tags)
+        object.__setattr__(self, 'comments', comments)
+        object.__setattr__(self, 'next_cursor', next_cursor)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"PostBundle is immutable (cannot set {name!r})")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"PostBundle is immutable (cannot delete {name!r})")
+
+    def __repr__(self):
+        return (f"PostBundle(post_id={self.post.get('id')!r}, "
+                f"tags={None if self.tags is None else len(self.tags)}, "
+                f"comments={None if self.comments is None else len(self.comments)})")
@@ -0,0 +1,198 @@
+# querylog.py
+
+import json
+import time
+import sqlite3
+from flask import current_app, g, request, has_request_context
+
+# --- Per-request query instrumentation ---
+# Pooled connections are InstrumentedConnection objects. While a request
+# holds one, every statement it runs is timed into that request's QueryStats.
+# After the request the totals are sent as a Server-Timing header and logged
+# as one JSON line, and statements slower than SLOW_QUERY_MS are logged with
+# their EXPLAIN QUERY PLAN.
+
+# Defaults, overridable through app.config
+QUERY_LOG_DEFAULTS = {
+    'QUERY_STATS_ENABLED': True,
+    'QUERY_STATS_HEADER': True,          # Send the Server-Timing header
+    'SLOW_QUERY_MS': 100.0,              # Log statements slower than this (None = never)
+    'QUERY_STATS_MAX_STATEMENTS': 200,   # Per-statement timings kept per request
+}
+
+
+class StatementTiming:
+    """One statement run during a request and the time spent on it."""
+    __slots__ = ('sql', 'params', 'seconds')
+
+    def __init__(self, sql, params, seconds):
+        self.sql = sql
+        self.params = params # None for executemany
+        self.seconds = seconds
+
+
+class QueryStats:
+    """Statement count, total database time and per-statement timings for one request."""
+
+    def __init__(self, max_statements):
+        self.max_statements = max_statements
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] # The first max_statements StatementTimings
+
+    def record(self, sql, params, seconds):
+        entry = StatementTiming(sql, params, seconds)
+        self.count += 1
+        self.seconds += seconds
+        if len(self.statements) < self.max_statements:
+            self.statements.append(entry)
+        return entry
+
+    def add_time(self, entry, seconds):
+        """Charges time spent fetching rows to the statement that produced them."""
+        entry.seconds += seconds
+        self.seconds += seconds
+
+    def slow_statements(self, threshold_ms):
+        return [entry for entry in self.statements if entry.seconds * 1000 >= threshold_ms]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor that times execute and fetch calls into its connection's QueryStats.
+
+    Rows read by iterating the cursor are not timed; the statement's time then
+    covers running it up to the first row.
+    """
+    _entry = None
+
+    def execute(self, sql, parameters=(), /):
+        stats = self.connection.query_stats
+        if stats is None:
+            self._entry = None
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._entry = stats.record(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        stats = self.connection.query_stats
+        if stats is None:
+            self._entry = None
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._entry = stats.record(sql, None, time.perf_counter() - start)
+
+    def _timed_fetch(self, fetch, *args):
+        stats = self.connection.query_stats
+        if self._entry is None or stats is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            stats.add_time(self._entry, time.perf_counter() - start)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose statements are timed while `query_stats` is set."""
+    query_stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts create plain cursors, bypassing cursor()
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def get_query_stats():
+    """The current request's QueryStats, created on first use.
+
+    Returns None outside of requests (CLI commands) or when disabled.
+    """
+    if not has_request_context() or not current_app.config.get('QUERY_STATS_ENABLED'):
+        return None
+    if 'query_stats' not in g:
+        g.query_stats = QueryStats(int(current_app.config['QUERY_STATS_MAX_STATEMENTS']))
+    return g.query_stats
+
+def explain(conn, entry):
+    """EXPLAIN QUERY PLAN detail lines for a recorded statement (not itself recorded)."""
+    if entry.params is None:
+        return ['(executemany: plan not available)']
+    stats, conn.query_stats = conn.query_stats, None
+    try:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {entry.sql}", entry.params).fetchall()
+        return [row['detail'] for row in rows]
+    except sqlite3.Error as e:
+        return [f"(EXPLAIN failed: {e})"]
+    finally:
+        conn.query_stats = stats
+
+def server_timing(stats, request_seconds):
+    """Formats a Server-Timing header value: database time and the whole request."""
+    return (f'db;dur={stats.seconds * 1000:.2f};desc="{stats.count} queries", '
+            f'app;dur={request_seconds * 1000:.2f}')
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+def _report(response):
+    """Sends the request's query stats as a header and log lines."""
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+    request_seconds = time.perf_counter() - g.get('request_started', time.perf_counter())
+    config = current_app.config
+    if config.get('QUERY_STATS_HEADER'):
+        response.headers.add('Server-Timing', server_timing(stats, request_seconds))
+    current_app.logger.info(json.dumps({
+        'event': 'request_queries',
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'queries': stats.count,
+        'db_ms': round(stats.seconds * 1000, 3),
+        'request_ms': round(request_seconds * 1000, 3),
+    }))
+
+    threshold = config.get('SLOW_QUERY_MS')
+    conn = g.get('db')
+    if threshold is not None and conn is not None:
+        for entry in stats.slow_statements(float(threshold)):
+            current_app.logger.warning(json.dumps({
+                'event': 'slow_query',
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'ms': round(entry.seconds * 1000, 3),
+                'sql': ' '.join(entry.sql.split()), # One line per statement
+                'plan': explain(conn, entry),
+            }))
+    return response
+
+
+def init_app(app):
+    """Register the query instrumentation hooks with the Flask app."""
+    for key, default in QUERY_LOG_DEFAULTS.items():
+        app.config.setdefault(key, default)
+    app.before_request(_start_timer)
+    app.after_request(_report)
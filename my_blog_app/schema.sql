@@ -1,6 +1,15 @@
 -- schema.sql
 
+-- Baseline schema (version 0). Indexes and later changes are applied on top
+-- of it by the migrations in db.py, see `flask migrate-db`.
+PRAGMA user_version = 0;
+
 -- Ensure previous tables are dropped if they exist
+-- (including the ones created by migrations)
+DROP TABLE if EXISTS deferred_objects;
+DROP TABLE if EXISTS posts_fts;
+DROP TABLE if EXISTS images;
+DROP TABLE if EXISTS change_counters;
 DROP TABLE if EXISTS comments;
 DROP TABLE if EXISTS post_tags;
 DROP TABLE if EXISTS tags;
@@ -11,6 +20,7 @@ CREATE TABLE posts (
     id INTEGER PRIMARY KEY AUTOINCREMENT, -- Unique identifier for each post
     title TEXT NOT NULL,                  -- Title of the blog post
     content TEXT NOT NULL,                -- Main body/content of the post
+    excerpt TEXT NULL,                    -- Plain-text summary kept in sync with content by db.py
     published_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, -- When the post was created/published
     image_filename TEXt NULL               -- images 
 );
@@ -0,0 +1,173 @@
+# synthetic.py
+
+import random
+import datetime
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import db
+import bulk
+
+# --- Synthetic data for load testing ---
+# Generates production-sized databases: post lengths, tag popularity
+# (Zipf-distributed, a few tags on most posts and a long tail), comment
+# counts (heavy-tailed) and publication dates spread over several years.
+# Every batch is generated from its own RNG seeded by (seed, batch number),
+# so a given --seed yields the same database however many workers run.
+
+DEFAULT_TAG_COUNT = 200
+DEFAULT_BATCH_SIZE = 2000
+TAG_ZIPF_EXPONENT = 1.1
+TAGS_PER_POST = (1, 6)
+COMMENT_PARETO_ALPHA = 1.5 # ~2 comments per post on average, a few posts with hundreds
+MAX_COMMENTS_PER_POST = 500
+DATE_SPAN_DAYS = 3 * 365
+# Dates end at a fixed point rather than "now", so seeded runs are reproducible
+DATE_RANGE_END = datetime.datetime(2025, 1, 1)
+
+
+def _format_timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S') # Same format as CURRENT_TIMESTAMP
+
+def _make_faker(seed):
+    from faker import Faker # Imported lazily: only needed when generating content
+    fake = Faker()
+    fake.seed_instance(seed)
+    return fake
+
+def make_tag_names(count, seed):
+    """Returns `count` distinct tag names, most popular first."""
+    fake = _make_faker(f"{seed}:tags")
+    names = []
+    seen = set()
+    while len(names) < count:
+        # The word list runs out after a few hundred tags; pairs keep it going
+        name = fake.word() if len(names) < 300 else f"{fake.word()}-{fake.word()}"
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+def zipf_cum_weights(count, exponent=TAG_ZIPF_EXPONENT):
+    """Cumulative weights giving rank k a probability proportional to 1/k^exponent."""
+    cum_weights, total = [], 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+def generate_batch(job):
+    """Generates one batch of posts, their tag links and comments (process pool worker).
+
+    Args:
+        job: (seed, batch number, first post id, first post index, post count,
+              total posts, tag count).
+
+    Returns:
+        (post rows, (post id, tag rank) links, comment rows), ready for executemany.
+    """
+    seed, batch_number, first_id, first_index, count, total, tag_count = job
+    rng = random.Random(f"{seed}:{batch_number}")
+    fake = _make_faker(rng.getrandbits(64))
+    cum_weights = zipf_cum_weights(tag_count)
+    span_seconds = DATE_SPAN_DAYS * 86400
+    range_start = DATE_RANGE_END - datetime.timedelta(seconds=span_seconds)
+
+    posts, links, comments = [], [], []
+    for offset in range(count):
+        post_id = first_id + offset
+        # Ids grow with publication date, as they do in a real blog
+        position = (first_index + offset + rng.random()) / total
+        published = range_start + datetime.timedelta(seconds=int(position * span_seconds))
+        content = '\n\n'.join(fake.paragraphs(nb=rng.randint(2, 8)))
+        posts.append((post_id, fake.sentence(nb_words=rng.randint(3, 9)).rstrip('.'), content,
+                      db.make_excerpt(content), _format_timestamp(published)))
+
+        ranks = set(rng.choices(range(tag_count), cum_weights=cum_weights, k=rng.randint(*TAGS_PER_POST)))
+        links.extend((post_id, rank) for rank in sorted(ranks))
+
+        comment_count = min(int(rng.paretovariate(COMMENT_PARETO_ALPHA)) - 1, MAX_COMMENTS_PER_POST)
+        remaining = (DATE_RANGE_END - published).total_seconds()
+        for _ in range(comment_count):
+            commented = published + datetime.timedelta(seconds=int(rng.random() ** 3 * remaining))
+            comments.append((post_id, fake.name(), fake.sentence(nb_words=rng.randint(4, 30)),
+                             _format_timestamp(commented)))
+    return posts, links, comments
+
+def iter_jobs(count, seed, first_id, tag_count, batch_size):
+    """Splits `count` posts into generate_batch jobs."""
+    for batch_number, first_index in enumerate(range(0, count, batch_size)):
+        batch_count = min(batch_size, count - first_index)
+        yield (seed, batch_number, first_id + first_index, first_index, batch_count, count, tag_count)
+
+def _bounded_map(executor, function, jobs, window):
+    """Like executor.map, but with at most `window` jobs in flight, so results
+    that the database hasn't caught up with don't pile up in memory."""
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(executor.submit(function, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def seed_synthetic(count, seed=None, tag_count=DEFAULT_TAG_COUNT, batch_size=DEFAULT_BATCH_SIZE,
+                   workers=0, progress=None):
+    """Adds `count` generated posts (with tags and comments) to the database.
+
+    Must run within an app context. Each batch is written in one transaction
+    with executemany. Into an empty database, indexes and triggers are
+    deferred until the end (see bulk.deferred_indexes_and_triggers); existing
+    posts keep them in place, as the app may be serving them meanwhile.
+
+    Args:
+        count: Number of posts to generate.
+        seed: Makes the output reproducible; random if None.
+        tag_count: Size of the tag vocabulary.
+        batch_size: Posts per batch (and per transaction).
+        workers: Processes generating content in parallel (0 = in this process).
+        progress: Optional callable receiving the number of posts written so far.
+
+    Returns:
+        A dict with the number of posts, post_tags and comments written.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    conn = db.get_db()
+    db.restore_deferred_objects(conn) # Finish an earlier load that was interrupted
+    empty = not conn.execute("SELECT EXISTS (SELECT 1 FROM posts)").fetchone()[0]
+    tag_names = make_tag_names(tag_count, seed)
+    with db.write_transaction(conn):
+        conn.executemany("INSERT INTO tags (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+                         [(name,) for name in tag_names])
+    tag_ids = {row['name']: row['id'] for row in conn.execute("SELECT id, name FROM tags")}
+    tag_id_by_rank = [tag_ids[name] for name in tag_names]
+    # Continue after every id ever used, including deleted posts
+    row = conn.execute("SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'posts'), 0),"
+                       " COALESCE((SELECT MAX(id) FROM posts), 0))").fetchone()
+    first_id = row[0] + 1
+
+    jobs = iter_jobs(count, seed, first_id, tag_count, max(1, batch_size))
+    totals = {'posts': 0, 'post_tags': 0, 'comments': 0}
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    try:
+        batches = _bounded_map(executor, generate_batch, jobs, 2 * workers) if executor else map(generate_batch, jobs)
+        with bulk.deferred_indexes_and_triggers(conn) if empty else contextlib.nullcontext():
+            for posts, links, comments in batches: # In job order, whatever finishes first
+                with db.write_transaction(conn):
+                    conn.executemany("INSERT INTO posts (id, title, content, excerpt, published_date)"
+                                     " VALUES (?, ?, ?, ?, ?)", posts)
+                    conn.executemany("INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)",
+                                     [(post_id, tag_id_by_rank[rank]) for post_id, rank in links])
+                    conn.executemany("INSERT INTO comments (post_id, author, content, published_date)"
+                                     " VALUES (?, ?, ?, ?)", comments)
+                totals['posts'] += len(posts)
+                totals['post_tags'] += len(links)
+                totals['comments'] += len(comments)
+                if progress:
+                    progress(totals['posts'])
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    db.notify_change({'*'})
+    return totals
@@ -0,0 +1,150 @@
+# tag_cache.py
+
+import os
+import json
+import time
+import threading
+import collections
+import models
+
+# --- In-process tag cache ---
+# The tag vocabulary is small and rarely changes, but tag names are resolved
+# on every tag page and tag write, and tag IDs on every listing. Each
+# process keeps a bidirectional name <-> Tag map, bounded as an LRU, loaded
+# from the tags table (up to TAG_CACHE_SIZE tags) before the process's
+# first request (see db._warm_tag_cache), or on first use outside one.
+#
+# Consistency across processes: triggers bump the 'tags' change counter in
+# SQLite whenever a tag is inserted, renamed or deleted. A cache compares
+# its stamp against that counter at most every TAG_CACHE_CHECK_INTERVAL
+# seconds, and always inside write transactions before resolving names, and
+# reloads when it moved. In-process, db.content_changed with '*' (init-db,
+# imports) empties it at once.
+
+# Defaults, overridable through app.config
+TAG_CACHE_DEFAULTS = {
+    'TAG_CACHE_SIZE': 10000,           # Tags kept per process (0 = no caching)
+    'TAG_CACHE_CHECK_INTERVAL': 1.0,   # Seconds between reads of the 'tags' counter
+}
+_UNLOADED = object()
+
+
+class TagCache:
+    """Bidirectional tag name <-> Tag map with an LRU bound, checked against the 'tags' change counter.
+
+    Lookups take a connection: names or IDs not in the cache are read from
+    the tags table in one query, and kept if they were read outside a
+    transaction (inside one they might be rolled back). The Tag objects are
+    shared by every caller and must not be modified.
+    """
+
+    def __init__(self, database, max_size, check_interval):
+        self.key = (database, os.getpid()) # Rebuilt for another database, or after a fork
+        self.max_size = max(0, max_size)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._by_id = collections.OrderedDict() # id -> Tag, least recently used first
+        self._by_name = {}                      # name -> Tag
+        self._stamp = _UNLOADED                 # 'tags' counter the entries were loaded at
+        self._checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def sync(self, conn, force=False):
+        """Reloads the cache if the 'tags' change counter moved since it was loaded.
+
+        The counter is read at most every check_interval seconds, unless `force`.
+        """
+        if not self.max_size:
+            return
+        now = time.monotonic()
+        if (not force and self._stamp is not _UNLOADED
+                and now - self._checked_at < self.check_interval):
+            return
+        # Read before the tags: a change in between only causes one more reload
+        row = conn.execute("SELECT version, changed_at FROM change_counters WHERE name = 'tags'").fetchone()
+        stamp = tuple(row) if row else None
+        with self._lock:
+            self._checked_at = now
+            if stamp == self._stamp:
+                return
+        self._load(conn, stamp)
+
+    def _load(self, conn, stamp):
+        # Name order, straight off the covering unique index on tags(name)
+        rows = conn.execute("SELECT id, name FROM tags ORDER BY name LIMIT ?", (self.max_size,)).fetchall()
+        make_tag = models.Tag.builder(('id', 'name'))
+        with self._lock:
+            self._by_id.clear()
+            self._by_name.clear()
+            for row in rows:
+                tag = make_tag(tuple(row))
+                self._by_id[tag.id] = tag
+                self._by_name[tag.name] = tag
+            self._stamp = stamp
+            self.loads += 1
+
+    def invalidate(self):
+        """Empties the cache; the next lookup reloads it."""
+        with self._lock:
+            self._by_id.clear()
+            self._by_name.clear()
+            self._stamp = _UNLOADED
+
+    def add(self, tags):
+        """Caches Tags known to be committed, evicting the least recently used beyond max_size."""
+        if not self.max_size:
+            return
+        with self._lock:
+            for tag in tags:
+                self._by_id[tag.id] = tag
+                self._by_id.move_to_end(tag.id)
+                self._by_name[tag.name] = tag
+            while len(self._by_id) > self.max_size:
+                _, evicted = self._by_id.popitem(last=False)
+                del self._by_name[evicted.name]
+
+    def _lookup(self, index, keys):
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                tag = index.get(key)
+                if tag is None:
+                    missing.append(key)
+                else:
+                    found[key] = tag
+                    self._by_id.move_to_end(tag.id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def _resolve(self, conn, index, column, keys):
+        found, missing = self._lookup(index, dict.fromkeys(keys))
+        if missing:
+            rows = conn.execute(
+                f"SELECT id, name FROM tags WHERE {column} IN (SELECT value FROM json_each(?))",
+                (json.dumps(missing),)
+            ).fetchall()
+            make_tag = models.Tag.builder(('id', 'name'))
+            loaded = [make_tag(tuple(row)) for row in rows]
+            if not conn.in_transaction:
+                self.add(loaded)
+            found.update((getattr(tag, column), tag) for tag in loaded)
+        return found
+
+    def cached_names(self, names):
+        """Returns {name: Tag} for the given names that are in the cache, without querying."""
+        return self._lookup(self._by_name, names)[0]
+
+    def resolve_names(self, conn, names):
+        """Returns {name: Tag} for the given names that exist; the rest are left out."""
+        return self._resolve(conn, self._by_name, 'name', names)
+
+    def resolve_ids(self, conn, tag_ids):
+        """Returns {id: Tag} for the given tag IDs that exist; the rest are left out."""
+        return self._resolve(conn, self._by_id, 'id', tag_ids)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._by_id), 'hits': self.hits, 'misses': self.misses, 'loads': self.loads}
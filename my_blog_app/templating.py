@@ -0,0 +1,89 @@
+# templating.py
+
+import os
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+# --- Compiled template cache ---
+# Jinja compiles each template to Python code the first time a process
+# renders it. With a bytecode cache the compiled code is written to disk and
+# later processes (e.g. each new worker) load it instead of compiling again.
+# Entries are keyed by template name and checked against a checksum of the
+# template source, so edited templates are recompiled automatically; touching
+# a file without changing it does not force a rebuild (clearing the cache
+# does, which precompile-templates starts with).
+# `flask precompile-templates` fills the cache ahead of time, at deploy.
+
+# Defaults, overridable through app.config (before init_app runs)
+TEMPLATE_CACHE_DEFAULTS = {
+    'TEMPLATE_BYTECODE_CACHE': True,
+    'TEMPLATE_CACHE_DIR': None, # Defaults to <instance path>/jinja-cache
+}
+
+
+def get_cache_dir(app):
+    return app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja-cache')
+
+
+class AppBytecodeCache(FileSystemBytecodeCache):
+    """A FileSystemBytecodeCache in the app's TEMPLATE_CACHE_DIR, created on first write.
+
+    The directory is read from the config on every use rather than when
+    init_app runs, so importing the app creates nothing on disk, and the
+    setting can still be changed afterwards (as the tests do).
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pattern = '__jinja2_%s.cache'
+
+    @property
+    def directory(self):
+        return get_cache_dir(self.app)
+
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            super().clear()
+
+def compile_all(app):
+    """Loads (compiling, or reading from the bytecode cache) every template of the app.
+
+    Returns:
+        The names of the templates loaded.
+    """
+    names = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Compile every template into the bytecode cache, so workers skip compiling them."""
+    app = current_app._get_current_object()
+    if not app.config.get('TEMPLATE_BYTECODE_CACHE'):
+        raise click.ClickException('TEMPLATE_BYTECODE_CACHE is off; there is no cache to fill.')
+    app.jinja_env.bytecode_cache.clear() # Compile from source, not from stale entries
+    app.jinja_env.cache.clear()
+    started = time.perf_counter()
+    names = compile_all(app)
+    click.echo(f"Compiled {len(names)} templates into {app.jinja_env.bytecode_cache.directory} "
+               f"in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+
+def init_app(app):
+    """Install the bytecode cache and register the precompile command with the Flask app."""
+    for key, default in TEMPLATE_CACHE_DEFAULTS.items():
+        app.config.setdefault(key, default)
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        # Read when the Jinja environment is created, on first use
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=AppBytecodeCache(app))
+    app.cli.add_command(precompile_templates_command)
@@ -0,0 +1,149 @@
+# tests/benchmarks/conftest.py
+
+import os
+import json
+import shutil
+import pytest
+from app import app as flask_app
+import db
+import synthetic
+
+# Databases are generated once per size and schema version, then copied for
+# each session so benchmarks that write never change the template
+BENCH_SEED = 1234
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('blog benchmarks')
+    group.addoption('--bench-sizes', default='',
+                    help='Comma-separated database sizes (posts) to benchmark, e.g. 1000,10000,100000. '
+                         'Benchmarks are skipped when not given.')
+    group.addoption('--bench-baseline', default=DEFAULT_BASELINE,
+                    help='JSON file with baseline p50/p95 latencies and query counts.')
+    group.addoption('--bench-save-baseline', action='store_true',
+                    help='Write this run\'s results to the baseline file instead of comparing.')
+    group.addoption('--bench-max-regression', type=float, default=15.0,
+                    help='Fail when p50, p95 or memory use is more than this many percent worse than the baseline.')
+
+
+def pytest_generate_tests(metafunc):
+    if 'bench_size' in metafunc.fixturenames:
+        raw = metafunc.config.getoption('--bench-sizes')
+        sizes = [int(size) for size in raw.split(',') if size.strip()]
+        metafunc.parametrize('bench_size', sizes, scope='session', ids=lambda size: f"{size}posts")
+
+
+def _build_template(path, size):
+    """Creates a database with `size` synthetic posts at `path`."""
+    flask_app.config['DATABASE'] = path
+    with flask_app.app_context():
+        assert db.init_db_logic()
+        synthetic.seed_synthetic(size, seed=BENCH_SEED, workers=os.cpu_count() if size >= 10000 else 0)
+    db.close_pool(flask_app) # Checkpoints the WAL into the main file
+
+
+@pytest.fixture(scope='session')
+def bench_app(bench_size, pytestconfig, tmp_path_factory):
+    """The app, configured against a working copy of a database with `bench_size` posts."""
+    cache = getattr(pytestconfig, 'cache', None) # None with -p no:cacheprovider
+    folder = cache.mkdir('bench-dbs') if cache else tmp_path_factory.mktemp('bench-dbs')
+    template = os.path.join(str(folder), f"blog-{bench_size}-seed{BENCH_SEED}-v{db.SCHEMA_VERSION}.db")
+    if not os.path.exists(template):
+        _build_template(f"{template}.tmp", bench_size)
+        os.replace(f"{template}.tmp", template)
+    working_copy = str(tmp_path_factory.mktemp('bench') / os.path.basename(template))
+    shutil.copyfile(template, working_copy)
+
+    saved_config = {key: flask_app.config.get(key)
+                    for key in ('DATABASE', 'TESTING', 'PAGE_CACHE_ENABLED', 'TAG_CACHE_CHECK_INTERVAL')}
+    flask_app.config.update({
+        'DATABASE': working_copy,
+        'TESTING': True,
+        'PAGE_CACHE_ENABLED': False, # Measure the real work, not cache hits
+        'TAG_CACHE_CHECK_INTERVAL': 3600, # Steady state: no counter reads outside writes
+    })
+    with flask_app.app_context():
+        db.get_tag_cache() # Warm, as after a worker's first requests
+    yield flask_app
+    db.close_pool(flask_app)
+    flask_app.config.update(saved_config)
+
+
+def _percentile(sorted_data, fraction):
+    index = min(len(sorted_data) - 1, max(0, round(fraction * (len(sorted_data) - 1))))
+    return sorted_data[index]
+
+
+class Baseline:
+    """Stored p50/p95 latencies, query counts and memory use, keyed by benchmark name."""
+
+    def __init__(self, path, max_regression, compare=True):
+        self.path = path
+        self.max_regression = max_regression
+        self.compare = compare
+        self.results = {}
+        try:
+            with open(path) as f:
+                self.stored = json.load(f)
+        except FileNotFoundError:
+            self.stored = {}
+
+    def regressions(self, name, result):
+        """Returns a list of messages for every way `result` is worse than the baseline."""
+        stored = self.stored.get(name)
+        if stored is None or not self.compare:
+            return []
+        problems = []
+        for key in ('p50', 'p95'):
+            limit = stored[key] * (1 + self.max_regression / 100)
+            if result[key] > limit:
+                problems.append(f"{key} {result[key] * 1000:.3f}ms vs baseline {stored[key] * 1000:.3f}ms "
+                                f"(+{(result[key] / stored[key] - 1) * 100:.0f}%)")
+        if result['queries'] > stored['queries']:
+            problems.append(f"{result['queries']} queries per call vs baseline {stored['queries']}")
+        return problems
+
+    def check(self, name, timings, queries=0):
+        """Records p50/p95 of `timings` (seconds) and `queries` under `name`.
+
+        Returns:
+            (result dict, list of regressions against the baseline).
+        """
+        data = sorted(timings)
+        result = {'p50': _percentile(data, 0.50), 'p95': _percentile(data, 0.95), 'queries': queries}
+        self.results[name] = result
+        return result, self.regressions(name, result)
+
+    def check_bytes(self, name, bytes_per_item):
+        """Records a memory measurement under `name`.
+
+        Returns:
+            (result dict, list of regressions against the baseline).
+        """
+        result = {'bytes_per_item': bytes_per_item}
+        self.results[name] = result
+        stored = self.stored.get(name)
+        if stored is None or not self.compare:
+            return result, []
+        limit = stored['bytes_per_item'] * (1 + self.max_regression / 100)
+        if bytes_per_item <= limit:
+            return result, []
+        return result, [f"{bytes_per_item:.0f} bytes per item vs baseline {stored['bytes_per_item']:.0f} "
+                        f"(+{(bytes_per_item / stored['bytes_per_item'] - 1) * 100:.0f}%)"]
+
+    def save(self):
+        merged = dict(self.stored, **self.results)
+        with open(self.path, 'w') as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture(scope='session')
+def bench_baseline(pytestconfig):
+    save = pytestconfig.getoption('--bench-save-baseline')
+    baseline = Baseline(pytestconfig.getoption('--bench-baseline'),
+                        pytestconfig.getoption('--bench-max-regression'), compare=not save)
+    yield baseline
+    if save and baseline.results:
+        baseline.save()
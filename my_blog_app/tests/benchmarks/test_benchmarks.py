@@ -0,0 +1,158 @@
+# tests/benchmarks/test_benchmarks.py
+#
+# Latency and queries-per-call for every route and db.py function, against
+# synthetic databases of the sizes given with --bench-sizes. For example:
+#
+#   python -m pytest tests/benchmarks --bench-sizes=1000,10000,100000 --bench-save-baseline
+#   python -m pytest tests/benchmarks --bench-sizes=1000,10000,100000
+#
+# The first run records p50/p95 and query counts in baseline.json; later
+# runs fail when p50 or p95 regress by more than --bench-max-regression
+# percent, or when a call issues more queries than before.
+
+import contextlib
+import itertools
+import pytest
+import db
+import querylog
+
+pytest.importorskip('pytest_benchmark')
+
+PEDANTIC_ROUNDS = 50 # For benchmarks that need fresh setup before every call
+_counter = itertools.count()
+
+
+@contextlib.contextmanager
+def counting_queries():
+    """Counts the statements run through db.get_db(): every execute call, repeats included.
+
+    Counted at the cursor (querylog's QueryStats), not with a trace callback:
+    Python traces each statement a trigger runs as the statement that fired
+    it, so traces can't tell trigger bodies from an N+1 loop repeating the
+    same SQL. Trigger bodies are not execute calls, so they are not counted;
+    an executemany counts once.
+    """
+    stats = querylog.QueryStats(max_statements=0)
+    original_get_db = db.get_db
+    connections = set()
+
+    def counted_get_db():
+        conn = original_get_db()
+        conn.query_stats = stats
+        connections.add(conn)
+        return conn
+
+    db.get_db = counted_get_db
+    try:
+        yield stats
+    finally:
+        db.get_db = original_get_db
+        for conn in connections:
+            conn.query_stats = None # Don't count (or time) the measured calls
+
+
+def run_benchmark(benchmark, bench_baseline, bench_size, name, call, setup=None):
+    """Measures `call`, records p50/p95 and queries per call, and checks the baseline."""
+    args = setup()[0] if setup else ()
+    with counting_queries() as queries:
+        call(*args)
+
+    if setup:
+        benchmark.pedantic(call, setup=setup, rounds=PEDANTIC_ROUNDS)
+    else:
+        benchmark(call)
+    if benchmark.disabled:
+        return
+
+    key = f"{name}[{bench_size}]"
+    result, problems = bench_baseline.check(key, benchmark.stats.stats.data, queries=queries.count)
+    benchmark.extra_info.update(result)
+    if problems:
+        pytest.fail(f"{key} regressed: " + '; '.join(problems))
+
+
+@pytest.fixture(scope='session')
+def bench_data(bench_app):
+    """Ids and names to aim the benchmarks at, picked from the generated data."""
+    with bench_app.app_context():
+        conn = db.get_db()
+        post_id = conn.execute("SELECT id FROM posts ORDER BY id LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM posts)").fetchone()[0]
+        popular_tag = conn.execute("""
+            SELECT t.name FROM tags t JOIN post_tags pt ON pt.tag_id = t.id
+            GROUP BY t.id ORDER BY COUNT(*) DESC LIMIT 1
+        """).fetchone()[0]
+        title_word = conn.execute("SELECT title FROM posts WHERE id = ?", (post_id,)).fetchone()[0].split()[0]
+        tag_names = [row[0] for row in conn.execute("SELECT name FROM tags ORDER BY id LIMIT 3")]
+    return {'post_id': post_id, 'tag': popular_tag, 'word': title_word, 'tag_names': tag_names}
+
+
+# --- Routes ---
+
+ROUTES = {
+    'index': lambda client, data: client.get('/'),
+    'post': lambda client, data: client.get(f"/post/{data['post_id']}"),
+    'posts_by_tag': lambda client, data: client.get(f"/tag/{data['tag']}"),
+    'tag_cloud': lambda client, data: client.get('/tags'),
+    'post_comments': lambda client, data: client.get(f"/post/{data['post_id']}/comments?after=2000-01-01 00:00:00~0"),
+    'search': lambda client, data: client.get(f"/search?q={data['word']}"),
+    'api_posts': lambda client, data: client.get('/api/v1/posts?limit=50'),
+    'create_post': lambda client, data: client.post('/post/new', data={
+        'title': f"Benchmark post {next(_counter)}", 'content': 'Benchmark body. ' * 40,
+        'tags': ', '.join(data['tag_names'])}),
+    'edit_post': lambda client, data: client.post(f"/post/{data['post_id']}/edit", data={
+        'title': f"Edited {next(_counter)}", 'content': 'Edited body. ' * 40,
+        'tags': ', '.join(data['tag_names'][:2])}),
+}
+
+@pytest.mark.parametrize('route', ROUTES)
+def test_route(benchmark, bench_app, bench_data, bench_baseline, bench_size, route):
+    client = bench_app.test_client()
+    request = ROUTES[route]
+    assert request(client, bench_data).status_code in (200, 302)
+    run_benchmark(benchmark, bench_baseline, bench_size, f"route:{route}", lambda: request(client, bench_data))
+
+
+# --- db.py functions ---
+
+def _new_post(data):
+    return (db.add_post(f"Scratch {next(_counter)}", 'Scratch body.'),), {}
+
+def _new_post_and_tags(data):
+    (post_id,), _ = _new_post(data)
+    return (post_id, data['tag_names']), {}
+
+DB_FUNCTIONS = {
+    'get_post_by_id': lambda data: db.get_post_by_id(data['post_id']),
+    'get_posts_page': lambda data: db.get_posts_page(),
+    'get_posts_page_by_tag': lambda data: db.get_posts_page(tag_name=data['tag']),
+    'get_posts_by_tag': lambda data: db.get_posts_by_tag(data['tag'], columns=db.POST_SUMMARY_COLUMNS),
+    'get_all_posts': lambda data: db.get_all_posts(columns=db.POST_SUMMARY_COLUMNS),
+    'get_tags_for_post': lambda data: db.get_tags_for_post(data['post_id']),
+    'get_comments_for_post': lambda data: db.get_comments_for_post(data['post_id']),
+    'get_comments_page': lambda data: db.get_comments_page(data['post_id']),
+    'load_post_bundle': lambda data: db.load_post_bundle(data['post_id']),
+    'search_posts': lambda data: db.search_posts(data['word']),
+    'add_post': lambda data: db.add_post(f"Bench {next(_counter)}", 'Body. ' * 50, tags=data['tag_names']),
+    'update_post': lambda data: db.update_post(data['post_id'], f"Updated {next(_counter)}", 'Body. ' * 50,
+                                               tags=data['tag_names']),
+    'add_or_get_tag': lambda data: db.add_or_get_tag(data['tag']),
+    'add_comment': lambda data: db.add_comment(data['post_id'], 'Bench', 'A benchmark comment.'),
+}
+# Functions whose work depends on what earlier calls left behind get a
+# fresh post before every call, so each call does the same work
+DB_FUNCTIONS_WITH_SETUP = {
+    'delete_post': (db.delete_post, _new_post),
+    'link_post_tag': (lambda post_id: db.link_post_tag(post_id, 1), _new_post),
+    'set_post_tags': (db.set_post_tags, _new_post_and_tags),
+}
+
+@pytest.mark.parametrize('function', list(DB_FUNCTIONS) + list(DB_FUNCTIONS_WITH_SETUP))
+def test_db_function(benchmark, bench_app, bench_data, bench_baseline, bench_size, function):
+    with bench_app.app_context():
+        if function in DB_FUNCTIONS_WITH_SETUP:
+            call, setup = DB_FUNCTIONS_WITH_SETUP[function]
+            run_benchmark(benchmark, bench_baseline, bench_size, f"db:{function}", call,
+                          setup=lambda: setup(bench_data))
+        else:
+            run_benchmark(benchmark, bench_baseline, bench_size, f"db:{function}",
+                          lambda: DB_FUNCTIONS[function](bench_data))
@@ -0,0 +1,55 @@
+# tests/benchmarks/test_memory.py
+#
+# Memory held by a listing of every post with its tags, in bytes per post
+# (traced with tracemalloc), as the loaders build it ('models': Post and Tag
+# objects with __slots__) and as they used to ('dicts': each sqlite3.Row
+# copied into a dict, with a list of tag Rows). Run with the other
+# benchmarks (--bench-sizes=...); results are checked against the same
+# baseline file. Add -s to see the numbers.
+
+import gc
+import tracemalloc
+import pytest
+import db
+
+
+def _listing_as_dicts():
+    """The listing built the way get_posts_with_tags() did before models.Post."""
+    conn = db.get_db()
+    posts = [dict(row) for row in conn.execute(f"""
+        SELECT {db.post_columns_sql(db.POST_SUMMARY_COLUMNS)} FROM posts
+        ORDER BY published_date DESC, id DESC
+    """)]
+    tags_by_post = {post['id']: [] for post in posts}
+    for tag in conn.execute("""
+        SELECT pt.post_id, t.id, t.name FROM post_tags pt JOIN tags t ON t.id = pt.tag_id ORDER BY t.name
+    """).fetchall():
+        tags_by_post[tag['post_id']].append(tag)
+    for post in posts:
+        post['tags'] = tags_by_post[post['id']]
+    return posts
+
+LISTINGS = {
+    'models': lambda: db.get_posts_with_tags(),
+    'dicts': _listing_as_dicts,
+}
+
+@pytest.mark.parametrize('listing', LISTINGS)
+def test_listing_memory(bench_app, bench_baseline, bench_size, listing):
+    build = LISTINGS[listing]
+    with bench_app.app_context():
+        build() # Warm up: connection, statement cache, compiled row builders
+        gc.collect()
+        tracemalloc.start()
+        try:
+            posts = build()
+            retained = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+    assert len(posts) >= bench_size
+
+    key = f"memory:listing:{listing}[{bench_size}]"
+    result, problems = bench_baseline.check_bytes(key, retained / len(posts))
+    print(f"\n{key}: {result['bytes_per_item']:.0f} bytes per post")
+    if problems:
+        pytest.fail(f"{key} regressed: " + '; '.join(problems))
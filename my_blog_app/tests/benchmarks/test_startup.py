@@ -0,0 +1,59 @@
+# tests/benchmarks/test_startup.py
+#
+# What a fresh worker costs before it can serve: time to import the app, and
+# time to the first byte of the home page, each measured in a new Python
+# process. Run with the other benchmarks (--bench-sizes=...); results are
+# checked against the same baseline file.
+
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+STARTUP_ROUNDS = 7
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Runs in the fresh process; prints its own timings as JSON
+WORKER_SCRIPT = """
+import sys, json, time
+started = time.perf_counter()
+import app as app_module
+imported = time.perf_counter()
+app = app_module.app
+app.config.update(DATABASE=sys.argv[1], PAGE_CACHE_ENABLED=False)
+response = app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+first_byte = time.perf_counter()
+print(json.dumps({'import': imported - started, 'first_byte': first_byte - started}))
+"""
+
+
+def start_worker(database, template_cache_dir):
+    """Starts a new interpreter that imports the app and serves one request; returns its timings."""
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=str(template_cache_dir))
+    output = subprocess.run([sys.executable, '-c', WORKER_SCRIPT, database], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('templates', ['precompiled', 'uncached'])
+def test_worker_startup(bench_app, bench_baseline, bench_size, tmp_path, templates):
+    database = bench_app.config['DATABASE']
+    precompiled_dir = tmp_path / 'jinja-cache'
+    if templates == 'precompiled':
+        start_worker(database, precompiled_dir) # Fills the bytecode cache, like precompile-templates
+
+    runs = []
+    for round_number in range(STARTUP_ROUNDS):
+        # 'uncached' starts every worker with an empty cache, so it compiles every template
+        cache_dir = precompiled_dir if templates == 'precompiled' else tmp_path / f'empty-{round_number}'
+        runs.append(start_worker(database, cache_dir))
+
+    problems = []
+    for measure in ('import', 'first_byte'):
+        key = f"startup:{measure}:{templates}[{bench_size}]"
+        _, regressions = bench_baseline.check(key, [run[measure] for run in runs])
+        problems.extend(f"{key}: {problem}" for problem in regressions)
+    if problems:
+        pytest.fail('Worker startup regressed: ' + '; '.join(problems))
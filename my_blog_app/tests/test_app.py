@@ -5,9 +5,13 @@ from flask import url_for, current_app # Import current_app
 from app import app as flask_app # Import Flask app instance
 # Import db module to potentially interact with the DB in tests
 import db
+import images
+from cache import page_cache, FileStore
 import random
+import json
 import os
 import tempfile # For creating temporary files/directories
+import shutil
 import click # Needed for init_db_command_context if called directly
 
 @pytest.fixture
@@ -17,9 +21,13 @@ def app():
     db_fd, db_path = tempfile.mkstemp(suffix='.sqlite')
     print(f"Using test database: {db_path}") # for debugging
 
+    metrics_dir = tempfile.mkdtemp()
+    template_cache_dir = tempfile.mkdtemp()
     flask_app.config.update({
         "TESTING": True,
         "DATABASE": db_path, # Set the database path for the test app context
+        "METRICS_DIR": metrics_dir, # Keep per-process metrics files out of the instance folder
+        "TEMPLATE_CACHE_DIR": template_cache_dir, # Likewise the compiled templates
         # Disable WTF_CSRF_ENABLED if you add forms with CSRF later
         # "WTF_CSRF_ENABLED": False,
     })
@@ -32,10 +40,14 @@ def app():
     yield flask_app # Provide the configured app to the tests
 
     # --- Teardown ---
+    # Close pooled connections so SQLite checkpoints and removes its WAL files
+    db.close_pool(flask_app)
     # Close the file descriptor
     os.close(db_fd)
     # Remove the temporary database file
     os.unlink(db_path)
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    shutil.rmtree(template_cache_dir, ignore_errors=True)
     print(f"Cleaned up test database: {db_path}") # for debugging
 
 
@@ -44,6 +56,21 @@ def client(app):
     """A test client for the app."""
     return app.test_client()
 
+
+@pytest.fixture
+def query_log(monkeypatch):
+    """Records every SQL statement run through db.get_db() during a test."""
+    statements = []
+    original_get_db = db.get_db
+
+    def traced_get_db():
+        conn = original_get_db()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(db, 'get_db', traced_get_db)
+    return statements
+
 # --- Tests ---
 def test_index_page_loads(client):
     """Test if the index page (/) loads successfully."""
@@ -266,3 +293,1333 @@ def test_edit_post_submit(client):
     assert b'edited' in response_after_redirect.data # Check for one of the new tags
     assert bytes(tag_name_orig, 'utf-8') not in response_after_redirect.data # Check old tag is not displayed
 
+
+def test_edit_post_rerender_keeps_cleared_tags(client):
+    """A rejected edit shows the tags field as submitted, even when it was emptied on purpose."""
+    import re
+    with flask_app.app_context():
+        post_id = db.add_post('Tagged', 'Body.', tags=['keep', 'these'])
+    response = client.post(f'/post/{post_id}/edit', data={'title': '', 'content': 'Body.', 'tags': ''})
+    assert re.search(rb'name="tags"\s+value=""', response.data)
+    response = client.post(f'/post/{post_id}/edit', data={'title': '', 'content': 'Body.', 'tags': 'new'})
+    assert re.search(rb'name="tags"\s+value="new"', response.data)
+
+
+def test_list_pages_run_constant_number_of_queries(client, query_log):
+    """Index and tag pages load posts and tags in two queries (plus the version
+    stamp lookup, and its re-check before the page is cached), however many
+    posts exist."""
+    # --- Test Setup: Several posts sharing a tag, plus an extra tag each ---
+    with flask_app.app_context():
+        for i in range(5):
+            post_id = db.add_post(f"Batched Post {i}", "Content...")
+            db.link_post_tag(post_id, db.add_or_get_tag('batched'))
+            db.link_post_tag(post_id, db.add_or_get_tag(f'extra_{i}'))
+    # --- End Test Setup ---
+
+    query_log.clear()
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b'extra_4' in response.data
+    assert len(query_log) == 4, query_log
+
+    query_log.clear()
+    response = client.get('/tag/batched')
+    assert response.status_code == 200
+    assert b'Batched Post 0' in response.data
+    assert len(query_log) == 4, query_log
+
+
+def test_index_keyset_pagination(client):
+    """Walking the homepage with ?before= visits every post exactly once, newest first."""
+    # --- Test Setup: More posts than fit on one page ---
+    with flask_app.app_context():
+        post_ids = [db.add_post(f"Paged Post {i}", "Content...") for i in range(5)]
+    # --- End Test Setup ---
+
+    seen_ids = []
+    with flask_app.app_context():
+        page = db.get_posts_page(limit=2)
+        assert page['prev_cursor'] is None
+        while True:
+            seen_ids.extend(post['id'] for post in page['posts'])
+            if page['next_cursor'] is None:
+                break
+            page = db.get_posts_page(before=db.decode_cursor(page['next_cursor']), limit=2)
+        # Stepping back from the last page returns the page before it
+        previous = db.get_posts_page(after=db.decode_cursor(page['prev_cursor']), limit=2)
+        assert [p['id'] for p in previous['posts']] == seen_ids[2:4]
+
+    assert seen_ids == sorted(post_ids, reverse=True)
+
+    # The rendered page links to the next one
+    response = client.get('/?limit=2')
+    assert response.status_code == 200
+    assert b'Paged Post 4' in response.data
+    assert b'Paged Post 2' not in response.data
+    assert b'Older posts' in response.data
+
+
+def test_pagination_rejects_malformed_cursor(client):
+    """A cursor that does not decode returns 400 instead of an error page."""
+    assert client.get('/?before=not-a-cursor').status_code == 400
+    assert client.get('/tag/anything?after=2024-01-01~x').status_code == 400
+
+
+def test_list_pages_read_excerpt_not_content(client, query_log):
+    """List pages show the stored excerpt and never select the full post body."""
+    # --- Test Setup: A post long enough to be truncated ---
+    long_content = "<p>Opening sentence of the post.</p> " + "filler words " * 100 + "SECRET_TAIL"
+    with flask_app.app_context():
+        post_id = db.add_post("Excerpt Post", long_content)
+        db.link_post_tag(post_id, db.add_or_get_tag('excerpts'))
+        stored = db.get_db().execute("SELECT excerpt FROM posts WHERE id = ?", (post_id,)).fetchone()
+        assert stored['excerpt'].startswith("Opening sentence of the post. filler")
+        assert len(stored['excerpt']) <= db.EXCERPT_LENGTH + 1
+    # --- End Test Setup ---
+
+    for url in ('/', '/tag/excerpts'):
+        query_log.clear()
+        response = client.get(url)
+        assert response.status_code == 200
+        assert b'Opening sentence of the post.' in response.data
+        assert b'SECRET_TAIL' not in response.data
+        assert not any('content' in statement for statement in query_log), query_log
+
+    # Updating the post regenerates the excerpt
+    with flask_app.app_context():
+        assert db.update_post(post_id, "Excerpt Post", "Short new body.")
+        stored = db.get_db().execute("SELECT excerpt FROM posts WHERE id = ?", (post_id,)).fetchone()
+        assert stored['excerpt'] == "Short new body."
+
+
+def test_fresh_database_is_fully_migrated(app):
+    """init_db_logic() applies every migration on top of schema.sql."""
+    with app.app_context():
+        assert db.get_schema_version() == db.SCHEMA_VERSION
+        assert db.migrate_db() == [] # Nothing left to apply
+
+
+def test_migrate_db_upgrades_legacy_database(app):
+    """A database built from the old schema gains the excerpt column and indexes."""
+    with app.app_context():
+        conn = db.get_db()
+        # Recreate the pre-migration state: no excerpt column, version 0
+        conn.execute("INSERT INTO posts (title, content) VALUES ('Legacy', '<b>Old</b> body')")
+        conn.commit()
+        conn.execute("ALTER TABLE posts DROP COLUMN excerpt")
+        for index_name in ('idx_posts_published', 'idx_post_tags_tag', 'idx_comments_post_published'):
+            conn.execute(f"DROP INDEX {index_name}")
+        # Drop everything later migrations created on top of the baseline tables
+        for (trigger_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+            conn.execute(f"DROP TRIGGER {trigger_name}")
+        conn.execute("DROP TABLE posts_fts")
+        baseline_tables = ('posts', 'tags', 'comments', 'post_tags', 'sqlite_sequence')
+        for (table_name,) in conn.execute(
+                f"SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT IN {baseline_tables}").fetchall():
+            conn.execute(f"DROP TABLE {table_name}")
+        conn.execute("PRAGMA user_version = 0")
+        conn.commit()
+
+    result = app.test_cli_runner().invoke(args=['migrate-db'])
+    assert result.exit_code == 0
+    assert 'Applied migration 1' in result.output
+
+    with app.app_context():
+        conn = db.get_db()
+        assert db.get_schema_version() == db.SCHEMA_VERSION
+        legacy = conn.execute("SELECT excerpt FROM posts WHERE title = 'Legacy'").fetchone()
+        assert legacy['excerpt'] == 'Old body'
+        assert [r['title'] for r in db.search_posts('old')['results']] == ['Legacy'] # Backfilled
+        index_names = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {'idx_posts_published', 'idx_post_tags_tag', 'idx_comments_post_published'} <= index_names
+
+
+def test_queries_do_not_full_scan(client, query_log):
+    """Every statement db.py issues for the app's pages uses an index (EXPLAIN QUERY PLAN)."""
+    # --- Exercise the routes and db.py functions, recording their SQL ---
+    with flask_app.app_context():
+        post_ids = [db.add_post(f"Plan Post {i}", "Content...") for i in range(3)]
+        tag_id = db.add_or_get_tag('plans')
+        for post_id in post_ids:
+            db.link_post_tag(post_id, tag_id)
+        db.add_comment(post_ids[0], 'Planner', 'A comment.')
+        db.get_all_posts()
+        db.get_posts_by_tag('plans')
+        db.get_tags_for_post(post_ids[0])
+        db.get_comments_for_post(post_ids[0])
+        page = db.get_posts_page(limit=1)
+        db.get_posts_page(before=db.decode_cursor(page['next_cursor']), limit=1)
+        db.get_posts_page(tag_name='plans', after=db.decode_cursor(page['next_cursor']), limit=1)
+        db.unlink_all_tags_for_post(post_ids[2])
+
+    client.get('/')
+    client.get('/tag/plans')
+    client.get('/tags')
+    client.get(f'/post/{post_ids[0]}')
+    client.get(f'/post/{post_ids[0]}/comments?after=2000-01-01 00:00:00~0')
+    client.post(f'/post/{post_ids[0]}', data={'author': 'A', 'content': 'B'})
+    client.get(f'/post/{post_ids[0]}/edit')
+    client.post(f'/post/{post_ids[1]}/edit', data={'title': 'T', 'content': 'C', 'tags': 'plans, other'})
+    client.post(f'/post/{post_ids[1]}/delete')
+    # --- End exercise ---
+
+    statements = {s for s in query_log if s.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE')}
+    assert statements
+    with flask_app.app_context():
+        full_scans = {}
+        for statement in statements:
+            scanned = db.full_scan_tables(db.explain_query_plan(statement))
+            if scanned:
+                full_scans[statement] = scanned
+    assert not full_scans, full_scans
+
+
+def test_connections_are_pooled_and_configured(client, monkeypatch):
+    """Requests reuse pooled connections, each set up with WAL and foreign keys."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_ENABLED', False) # Every request must hit the DB
+    with flask_app.app_context():
+        conn = db.get_db()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1 # NORMAL
+        before = db.get_pool_stats()
+
+    for _ in range(3):
+        assert client.get('/').status_code == 200
+
+    with flask_app.app_context():
+        stats = db.get_pool_stats()
+    assert stats['misses'] == before['misses'] # No new connections were opened
+    assert stats['hits'] >= before['hits'] + 3
+    assert stats['idle'] >= 1
+
+
+def test_pooled_connection_is_returned_without_open_transaction(app):
+    """An uncommitted write is rolled back before the connection is reused."""
+    with app.app_context():
+        db.get_db().execute("INSERT INTO tags (name) VALUES ('never_committed')")
+    with app.app_context():
+        assert db.get_db().execute("SELECT 1 FROM tags WHERE name = 'never_committed'").fetchone() is None
+
+
+def test_post_and_tags_written_in_one_transaction(client, query_log):
+    """Creating or editing a post with many tags commits exactly once."""
+    tags = ', '.join(f'bulk_{i}' for i in range(10))
+    response = client.post('/post/new', data={'title': 'Many Tags', 'content': 'Body', 'tags': tags})
+    assert response.status_code == 302
+    assert query_log.count('COMMIT') == 1, query_log
+
+    with flask_app.app_context():
+        post_id = db.get_db().execute("SELECT id FROM posts WHERE title = 'Many Tags'").fetchone()['id']
+        assert {t['name'] for t in db.get_tags_for_post(post_id)} == {f'bulk_{i}' for i in range(10)}
+
+    query_log.clear()
+    new_tags = ', '.join(f'bulk_{i}' for i in range(5, 15))
+    response = client.post(f'/post/{post_id}/edit', data={'title': 'Many Tags', 'content': 'Body', 'tags': new_tags})
+    assert response.status_code == 302
+    assert query_log.count('COMMIT') == 1, query_log
+
+    with flask_app.app_context():
+        assert {t['name'] for t in db.get_tags_for_post(post_id)} == {f'bulk_{i}' for i in range(5, 15)}
+
+
+def test_set_post_tags_only_changes_the_difference(app, query_log):
+    """set_post_tags() keeps unchanged links and touches only added/removed ones."""
+    with app.app_context():
+        post_id = db.add_post("Diff Tags", "Body", tags=['keep', 'drop', 'keep'])
+        assert {t['name'] for t in db.get_tags_for_post(post_id)} == {'keep', 'drop'}
+
+        query_log.clear()
+        assert db.set_post_tags(post_id, ['keep', 'new'])
+        assert {t['name'] for t in db.get_tags_for_post(post_id)} == {'keep', 'new'}
+        link_writes = [s for s in query_log if 'post_tags' in s and s.startswith(('INSERT', 'DELETE'))]
+        # One delete ('drop') and one insert ('new'); the trace repeats statements that fire triggers
+        assert len(set(link_writes)) == 2, link_writes
+
+
+def test_search_finds_titles_bodies_and_tags(client):
+    """/search ranks FTS5 matches and highlights the matched terms."""
+    # --- Test Setup ---
+    with flask_app.app_context():
+        title_hit = db.add_post("Fjord kayaking guide", "Paddling tips.")
+        body_hit = db.add_post("Weekend notes", "We went kayaking on the <b>fjord</b> near Oslo.")
+        tag_hit = db.add_post("Untitled trip", "Nothing to see.", tags=['kayaking'])
+        db.add_post("Unrelated", "Baking lefse.")
+    # --- End Test Setup ---
+
+    with flask_app.app_context():
+        results = db.search_posts('kayaking')['results']
+        assert {r['id'] for r in results} == {title_hit, body_hit, tag_hit}
+        assert results[0]['id'] == title_hit # Title matches outrank body matches
+        # Tags edited later are searchable too, and removed ones are not
+        db.set_post_tags(tag_hit, ['canoeing'])
+        assert tag_hit not in {r['id'] for r in db.search_posts('kayaking')['results']}
+        assert [r['id'] for r in db.search_posts('canoe')['results']] == [tag_hit] # Prefix match
+        # Deleted posts drop out of the index
+        db.delete_post(body_hit)
+        assert body_hit not in {r['id'] for r in db.search_posts('fjord')['results']}
+        # Operators and quotes in user input are treated as plain words
+        assert db.search_posts('fjord" (')['results']
+        assert db.search_posts('NOT OR "')['results'] == []
+
+    response = client.get('/search?q=fjord')
+    assert response.status_code == 200
+    assert b'Fjord kayaking guide' in response.data
+    assert b'<mark>Fjord</mark>' in response.data
+
+    response = client.get('/search?q=nomatchword')
+    assert response.status_code == 200
+    assert b'No posts match' in response.data
+
+
+def _make_image_bytes(size=(1600, 900), image_format='JPEG'):
+    """Creates an in-memory test image (requires Pillow)."""
+    from PIL import Image
+    import io
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, format=image_format)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def static_dir(app, monkeypatch):
+    """Points the app's static folder at a temporary directory for upload tests."""
+    with tempfile.TemporaryDirectory() as tmp_static:
+        monkeypatch.setattr(app, 'static_folder', tmp_static)
+        images._manifest_cache.clear()
+        yield tmp_static
+        images._manifest_cache.clear()
+
+
+def test_upload_creates_responsive_derivatives(client, static_dir):
+    """Uploaded images get resized and WebP variants, served through srcset."""
+    pytest.importorskip('PIL')
+    response = client.post('/post/new', data={
+        'title': 'Image Post', 'content': 'Has a picture.', 'tags': 'photos',
+        'image': (_make_image_bytes(), 'photo.jpg'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    with flask_app.app_context():
+        post = db.get_db().execute("SELECT id, image_filename FROM posts WHERE title = 'Image Post'").fetchone()
+    derived = os.listdir(os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER, images.DERIVED_FOLDER_NAME))
+    stem = os.path.splitext(os.path.basename(post['image_filename']))[0]
+    for width in (320, 640, 1280):
+        assert f"{stem}-{width}.jpg" in derived
+        assert f"{stem}-{width}.webp" in derived
+    assert f"{stem}-1600.webp" in derived # WebP at the original width, but never upscaled
+
+    response = client.get('/')
+    assert b'type="image/webp"' in response.data
+    assert bytes(f"{stem}-320.jpg 320w", 'utf-8') in response.data
+
+    # Deleting the post removes the derivatives with the original
+    client.post(f"/post/{post['id']}/delete")
+    assert os.listdir(os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER, images.DERIVED_FOLDER_NAME)) == []
+
+
+def test_rebuild_thumbnails_backfills_existing_uploads(app, static_dir):
+    """flask rebuild-thumbnails generates derivatives for uploads that lack them."""
+    pytest.importorskip('PIL')
+    upload_dir = os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)
+    os.makedirs(upload_dir)
+    for name in ('old1.jpg', 'old2.png'):
+        image_format = 'PNG' if name.endswith('.png') else 'JPEG'
+        with open(os.path.join(upload_dir, name), 'wb') as f:
+            f.write(_make_image_bytes((700, 400), image_format).read())
+
+    result = app.test_cli_runner().invoke(args=['rebuild-thumbnails', '--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Derivatives ready for 2 images' in result.output
+    derived = set(os.listdir(os.path.join(upload_dir, images.DERIVED_FOLDER_NAME)))
+    assert {'old1-320.jpg', 'old1-640.jpg', 'old1-700.webp', 'old2-320.png', 'old2-700.webp'} <= derived
+
+
+def test_uploads_are_deduplicated_and_reference_counted(client, static_dir):
+    """The same image uploaded twice is stored once and kept until its last post is gone."""
+    pytest.importorskip('PIL')
+    image_bytes = _make_image_bytes((400, 300)).read()
+    import io
+    for title in ('First Copy', 'Second Copy'):
+        response = client.post('/post/new', data={
+            'title': title, 'content': 'Same picture.', 'image': (io.BytesIO(image_bytes), 'pic.JPEG'),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 302
+
+    import hashlib
+    expected = f"{db.IMAGE_UPLOAD_FOLDER}/{hashlib.sha256(image_bytes).hexdigest()}.jpg"
+    with flask_app.app_context():
+        rows = db.get_db().execute("SELECT id, image_filename FROM posts ORDER BY id").fetchall()
+        assert [row['image_filename'] for row in rows] == [expected, expected]
+        assert db.get_image_ref_count(expected) == 2
+    stored = [name for name in os.listdir(os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)) if name.endswith('.jpg')]
+    assert len(stored) == 1
+
+    client.post(f"/post/{rows[0]['id']}/delete")
+    assert os.path.exists(os.path.join(static_dir, expected)) # Still used by the second post
+    client.post(f"/post/{rows[1]['id']}/delete")
+    assert not os.path.exists(os.path.join(static_dir, expected))
+    with flask_app.app_context():
+        assert db.get_image_ref_count(expected) == 0
+
+
+def test_upload_rejects_oversized_and_disguised_files(client, static_dir):
+    """Uploads over the size cap or with a non-image body are refused and leave no files behind."""
+    import io
+    flask_app.config['MAX_IMAGE_UPLOAD_BYTES'] = 1024
+    try:
+        big_gif = b'GIF89a' + b'\0' * 4096
+        client.post('/post/new', data={'title': 'Too Big', 'content': 'x', 'image': (io.BytesIO(big_gif), 'big.gif')},
+                    content_type='multipart/form-data')
+    finally:
+        flask_app.config.pop('MAX_IMAGE_UPLOAD_BYTES')
+    client.post('/post/new', data={'title': 'Fake', 'content': 'x', 'image': (io.BytesIO(b'<?php echo 1; ?>'), 'evil.png')},
+                content_type='multipart/form-data')
+
+    with flask_app.app_context():
+        rows = db.get_db().execute("SELECT title, image_filename FROM posts ORDER BY id").fetchall()
+    assert [(row['title'], row['image_filename']) for row in rows] == [('Too Big', None), ('Fake', None)]
+    assert os.listdir(os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)) == [] # Temp files cleaned up
+
+
+def _png_header(width, height):
+    """A PNG declaring the given size, with no pixel data: cheap to write, huge to decode."""
+    import struct
+    import zlib
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(b'')) + chunk(b'IEND', b''))
+
+
+def test_upload_rejects_decompression_bombs(client, static_dir):
+    """Uploads whose header declares too many pixels are refused before being decoded."""
+    pytest.importorskip('PIL')
+    import io
+    response = client.post('/post/new', data={
+        'title': 'Bomb', 'content': 'x', 'image': (io.BytesIO(_png_header(20000, 10000)), 'bomb.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+    flask_app.config['MAX_IMAGE_PIXELS'] = 1000
+    try:
+        client.post('/post/new', data={
+            'title': 'Too Many Pixels', 'content': 'x', 'image': (_make_image_bytes((400, 300), 'PNG'), 'big.png'),
+        }, content_type='multipart/form-data')
+    finally:
+        flask_app.config.pop('MAX_IMAGE_PIXELS')
+
+    with flask_app.app_context():
+        rows = db.get_db().execute("SELECT title, image_filename FROM posts ORDER BY id").fetchall()
+        assert [(row['title'], row['image_filename']) for row in rows] == [('Bomb', None), ('Too Many Pixels', None)]
+        # Derivatives aren't decoded past Pillow's limit either (it only warns up to twice that)
+        upload_dir = os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)
+        assert os.listdir(upload_dir) == []
+        with open(os.path.join(upload_dir, 'legacy.png'), 'wb') as f:
+            f.write(_png_header(12000, 8000))
+        assert images.create_derivatives(f"{db.IMAGE_UPLOAD_FOLDER}/legacy.png") is None
+
+
+def test_gc_uploads_reports_and_removes_orphans(app, static_dir):
+    """flask gc-uploads finds unreferenced uploads and derivatives, and removes old ones in batches."""
+    upload_dir = os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)
+    derived_dir = os.path.join(upload_dir, images.DERIVED_FOLDER_NAME)
+    os.makedirs(derived_dir)
+    files = {
+        'kept.png': 100, 'legacy.jpg': 20000, 'abandoned.tmp': 300, 'fresh.jpg': 50, '.gitkeep': 0,
+        'derived/kept-320.webp': 40, 'derived/kept.json': 10,
+        'derived/legacy-320.jpg': 5000, 'derived/legacy-320.webp': 4000, 'derived/legacy.json': 10,
+    }
+    two_hours_ago = os.path.getmtime(static_dir) - 7200
+    for name, size in files.items():
+        path = os.path.join(upload_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if name != 'fresh.jpg':
+            os.utime(path, (two_hours_ago, two_hours_ago))
+    with app.app_context():
+        db.add_post('Kept', 'Uses an image.', image_filename=f"{db.IMAGE_UPLOAD_FOLDER}/kept.png")
+        db.add_post('Broken', 'Image is gone.', image_filename=f"{db.IMAGE_UPLOAD_FOLDER}/missing.jpg")
+        db.register_image(f"{db.IMAGE_UPLOAD_FOLDER}/legacy.jpg", 20000) # Stored, but no post uses it
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['gc-uploads', '--list'])
+    assert result.exit_code == 0, result.output
+    assert 'Scanned 9 files' in result.output
+    assert '6 orphaned' in result.output and '1 too recent' in result.output
+    assert '1 referenced but missing' in result.output
+    assert 'orphan: uploads/images/derived/legacy-320.webp' in result.output
+    assert '16.0 KiB - 64.0 KiB' in result.output # Histogram bucket holding legacy.jpg
+    assert len(os.listdir(derived_dir)) == 5 # Report only
+
+    result = runner.invoke(args=['gc-uploads', '--delete', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert '5 removed' in result.output
+    assert sorted(os.listdir(upload_dir)) == ['.gitkeep', 'derived', 'fresh.jpg', 'kept.png']
+    assert sorted(os.listdir(derived_dir)) == ['kept-320.webp', 'kept.json']
+    with app.app_context():
+        assert db.get_db().execute("SELECT filename FROM images WHERE filename LIKE '%legacy%'").fetchall() == []
+        assert db.get_image_ref_count(f"{db.IMAGE_UPLOAD_FOLDER}/kept.png") == 1
+
+
+def test_gc_uploads_background_collector(client, static_dir, monkeypatch, tmp_path):
+    """With UPLOAD_GC_INTERVAL set after startup, the first request starts a collector that removes old orphans."""
+    import time
+    upload_dir = os.path.join(static_dir, db.IMAGE_UPLOAD_FOLDER)
+    os.makedirs(upload_dir)
+    orphan = os.path.join(upload_dir, 'orphan.jpg')
+    with open(orphan, 'wb') as f:
+        f.write(b'x' * 100)
+    os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_GC_INTERVAL', 0.05)
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_GC_DELETE', True)
+    monkeypatch.setitem(flask_app.config, 'UPLOAD_GC_LOCK_FILE', str(tmp_path / 'upload-gc.lock'))
+    monkeypatch.delitem(flask_app.extensions, 'upload_collector', raising=False)
+
+    client.get('/')
+    collector = flask_app.extensions['upload_collector']
+    try:
+        deadline = time.monotonic() + 5
+        while (os.path.exists(orphan) or not collector.runs) and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert not os.path.exists(orphan)
+        assert collector.runs >= 1
+    finally:
+        collector.close()
+        del flask_app.extensions['upload_collector']
+
+
+def test_gc_uploads_only_one_collector_runs(app, tmp_path):
+    """Of several processes' collectors, only the lock holder collects; another takes over when it stops."""
+    import time
+    import uploads_gc
+    lock_path = str(tmp_path / 'upload-gc.lock')
+    # Each opens the lock file itself, so they contend as collectors in separate processes would
+    collectors = [uploads_gc.UploadCollector(app, 0.02, False, lock_path) for _ in range(2)]
+    try:
+        def wait_for(condition):
+            deadline = time.monotonic() + 5
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.02)
+            return condition()
+        assert wait_for(lambda: any(c.runs for c in collectors) and all(c.runs or c.skipped for c in collectors))
+        [holder] = [c for c in collectors if c.runs]
+        [waiting] = [c for c in collectors if c is not holder]
+        assert waiting.runs == 0 and waiting.skipped >= 1
+
+        holder.close()
+        assert wait_for(lambda: waiting.runs >= 1)
+    finally:
+        for collector in collectors:
+            collector.close()
+
+
+def test_page_cache_serves_repeat_gets_without_queries(client, query_log):
+    """A second GET of a list page is served from the cache without running the page's queries."""
+    with flask_app.app_context():
+        db.add_post('Cached Post', 'Rendered once.', tags=['cached'])
+        before = page_cache.stats()
+
+    assert client.get('/').headers['X-Cache'] == 'MISS'
+    query_log.clear()
+    response = client.get('/')
+    assert response.headers['X-Cache'] == 'HIT'
+    assert b'Cached Post' in response.data
+    assert query_log == ["SELECT version, changed_at FROM change_counters WHERE name = 'posts'"]
+    # Other query strings are other pages, unless the view doesn't read them
+    assert client.get('/?limit=5').headers['X-Cache'] == 'MISS'
+    assert client.get('/?utm_source=feed').headers['X-Cache'] == 'HIT'
+
+    with flask_app.app_context():
+        stats = page_cache.stats()
+    assert stats['hits'] == before['hits'] + 2
+    assert stats['misses'] == before['misses'] + 2
+
+
+def test_page_rendered_during_a_write_is_not_served_after_it(client, monkeypatch):
+    """A page whose render overlapped a write is cached under the old version, so it's never served."""
+    with flask_app.app_context():
+        db.add_post('Before', 'Already there.')
+    get_posts_page = db.get_posts_page
+    def get_posts_page_then_write(*args, **kwargs):
+        page = get_posts_page(*args, **kwargs)
+        monkeypatch.setattr(db, 'get_posts_page', get_posts_page)
+        db.add_post('During', 'Written while the index rendered.') # Evicts before the stale page is stored
+        return page
+    monkeypatch.setattr(db, 'get_posts_page', get_posts_page_then_write)
+
+    assert b'During' not in client.get('/').data
+    response = client.get('/')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert b'During' in response.data
+
+
+def test_writes_evict_only_affected_pages(client):
+    """A write evicts the post's page, the index and its tags' pages, and nothing else."""
+    with flask_app.app_context():
+        post_a = db.add_post('Post A', 'First.', tags=['alpha'])
+        post_b = db.add_post('Post B', 'Second.', tags=['beta'])
+    urls = ['/', f'/post/{post_a}', f'/post/{post_b}', '/tag/alpha', '/tag/beta', '/tag/gamma']
+    for url in urls:
+        client.get(url)
+
+    with flask_app.app_context():
+        db.update_post(post_a, 'Post A v2', 'First, edited.', tags=['gamma'])
+    cache_state = {url: client.get(url).headers['X-Cache'] for url in urls}
+    assert cache_state == {
+        '/': 'MISS', f'/post/{post_a}': 'MISS', '/tag/alpha': 'MISS', '/tag/gamma': 'MISS',
+        f'/post/{post_b}': 'HIT', '/tag/beta': 'HIT',
+    }
+    assert b'Post A v2' in client.get('/tag/gamma').data
+
+    with flask_app.app_context():
+        db.add_comment(post_b, 'Reader', 'Nice post.')
+    assert client.get(f'/post/{post_b}').headers['X-Cache'] == 'MISS'
+    assert client.get('/').headers['X-Cache'] == 'HIT'
+
+    with flask_app.app_context():
+        db.delete_post(post_b)
+    assert client.get(f'/post/{post_b}').status_code == 404
+    assert client.get('/tag/beta').headers['X-Cache'] == 'MISS'
+
+
+def test_page_cache_misses_after_another_process_writes(client):
+    """A write that this process never hears about (another worker's) still stops the cached page being served."""
+    import sqlite3
+    with flask_app.app_context():
+        post_id = db.add_post('Old Title', 'Body.')
+    assert client.get(f'/post/{post_id}').headers['X-Cache'] == 'MISS'
+    assert client.get(f'/post/{post_id}').headers['X-Cache'] == 'HIT'
+
+    other_worker = sqlite3.connect(flask_app.config['DATABASE']) # No content_changed signal from here
+    other_worker.execute("UPDATE posts SET title = 'New Title' WHERE id = ?", (post_id,))
+    other_worker.commit()
+    other_worker.close()
+    response = client.get(f'/post/{post_id}')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert b'New Title' in response.data and b'Old Title' not in response.data
+    assert client.get(f'/post/{post_id}').headers['X-Cache'] == 'HIT'
+
+
+def test_conditional_validators_match_the_body(client):
+    """After another process's write, a revalidation gets the new body with the new ETag, never the old body."""
+    import sqlite3
+    with flask_app.app_context():
+        post_id = db.add_post('Old Title', 'Body.')
+    old_etag = client.get(f'/post/{post_id}').headers['ETag']
+    assert client.get(f'/post/{post_id}').headers['X-Cache'] == 'HIT'
+
+    other_worker = sqlite3.connect(flask_app.config['DATABASE'])
+    other_worker.execute("UPDATE posts SET title = 'New Title' WHERE id = ?", (post_id,))
+    other_worker.commit()
+    other_worker.close()
+    response = client.get(f'/post/{post_id}', headers={'If-None-Match': old_etag})
+    assert response.status_code == 200
+    assert b'New Title' in response.data and response.headers['ETag'] != old_etag
+    new_etag = response.headers['ETag']
+
+    assert client.get(f'/post/{post_id}', headers={'If-None-Match': new_etag}).status_code == 304
+    response = client.get(f'/post/{post_id}')
+    assert response.headers['X-Cache'] == 'HIT' and response.headers['ETag'] == new_etag
+    assert b'New Title' in response.data
+
+    # A cached body from another version is never sent with this version's validators
+    store = page_cache.get_store(flask_app)
+    with flask_app.test_request_context(f'/post/{post_id}'):
+        key = page_cache.make_key({'post_id': post_id})
+    assert store.get(key) is not None
+    store.set(key, b'Stale page', 'text/html; charset=utf-8', frozenset(), 60, version='post:stale')
+    response = client.get(f'/post/{post_id}')
+    assert b'Stale page' not in response.data and response.headers['ETag'] == new_etag
+
+
+def test_page_cache_file_store(client, monkeypatch, tmp_path):
+    """With PAGE_CACHE_DIR set, pages are cached on disk and evicted the same way."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_DIR', str(tmp_path))
+    monkeypatch.delitem(flask_app.extensions, 'page_cache', raising=False)
+    with flask_app.app_context():
+        post_id = db.add_post('On Disk', 'Cached as a file.', tags=['disk'])
+
+    client.get(f'/post/{post_id}')
+    assert len(list(tmp_path.glob('*.page'))) == 1
+    assert client.get(f'/post/{post_id}').headers['X-Cache'] == 'HIT'
+
+    with flask_app.app_context():
+        db.set_post_tags(post_id, ['disk', 'more'])
+    assert list(tmp_path.glob('*.page')) == []
+    assert list(tmp_path.glob('deps/*')) == [] # Markers and their folders go with the pages
+    assert b'more' in client.get(f'/post/{post_id}').data
+
+
+def test_page_cache_file_store_is_bounded(client, monkeypatch, tmp_path):
+    """The file store prunes expired pages, then the soonest to expire, and the markers of both."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_DIR', str(tmp_path))
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_MAX_ENTRIES', 3) # Prunes on every write
+    monkeypatch.setattr(FileStore, 'MARKER_GRACE', 0)
+    monkeypatch.delitem(flask_app.extensions, 'page_cache', raising=False)
+    with flask_app.app_context():
+        post_ids = [db.add_post(f"Post {n}", 'Body.') for n in range(5)]
+
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_TTL', -1)
+    client.get(f'/post/{post_ids[0]}') # Already expired: removed by the next prune
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_TTL', 300)
+    for post_id in post_ids[1:]:
+        client.get(f'/post/{post_id}')
+    assert len(list(tmp_path.glob('*.page'))) == 3
+    assert len(list(tmp_path.glob('deps/*/*'))) == 3
+    assert client.get(f'/post/{post_ids[1]}').headers['X-Cache'] == 'MISS' # Evicted, closest to expiry
+    assert client.get(f'/post/{post_ids[4]}').headers['X-Cache'] == 'HIT'
+
+
+def test_post_page_conditional_get(client, query_log):
+    """An unchanged post page is answered with 304 after a single indexed lookup."""
+    with flask_app.app_context():
+        post_id = db.add_post('Stamped Post', 'Body.', tags=['stamps'])
+        conn = db.get_db() # Last changed a while ago (Last-Modified is only sent for past seconds)
+        conn.execute("UPDATE posts SET updated_at = '2024-05-01 12:00:00.250' WHERE id = ?", (post_id,))
+        conn.commit()
+
+    response = client.get(f'/post/{post_id}')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert response.status_code == 200 and etag.startswith('W/')
+    assert last_modified == 'Wed, 01 May 2024 12:00:01 GMT' # Rounded up to the end of its second
+
+    query_log.clear()
+    response = client.get(f'/post/{post_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert query_log == [f"SELECT updated_at FROM posts WHERE id = {post_id}"]
+    assert client.get(f'/post/{post_id}', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # A new comment changes the post page's stamp, but not the list pages'
+    index_etag = client.get('/').headers['ETag']
+    with flask_app.app_context():
+        db.add_comment(post_id, 'Reader', 'First!')
+    response = client.get(f'/post/{post_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and b'First!' in response.data
+    assert client.get('/', headers={'If-None-Match': index_etag}).status_code == 304
+
+    # Tag changes move both
+    with flask_app.app_context():
+        db.set_post_tags(post_id, ['stamps', 'fresh'])
+    assert client.get('/', headers={'If-None-Match': index_etag}).status_code == 200
+    assert client.get('/post/999999', headers={'If-None-Match': etag}).status_code == 404
+
+
+def test_if_modified_since_sees_changes_in_the_same_second(client):
+    """A client revalidating by date only never gets a 304 for a change made in the second it cached."""
+    from werkzeug.http import http_date, parse_date
+    import datetime
+    with flask_app.app_context():
+        post_id = db.add_post('Feed Post', 'Body.')
+    response = client.get(f'/post/{post_id}')
+    this_second = http_date(datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0))
+    if 'Last-Modified' in response.headers: # Only once the stamp's second is over
+        assert parse_date(response.headers['Last-Modified']) <= parse_date(this_second)
+
+    # A feed reader holding a copy dated this second, then a comment and a post in that second
+    with flask_app.app_context():
+        db.add_comment(post_id, 'Reader', 'Same second.')
+        db.add_post('Also New', 'Body.')
+    response = client.get(f'/post/{post_id}', headers={'If-Modified-Since': this_second})
+    assert response.status_code == 200 and b'Same second.' in response.data
+    response = client.get('/', headers={'If-Modified-Since': this_second})
+    assert response.status_code == 200 and b'Also New' in response.data
+
+
+def test_api_lists_posts_with_selected_fields(client, query_log):
+    """/api/v1/posts pages with cursors, returns only the requested fields and reads only their columns."""
+    with flask_app.app_context():
+        for i in range(3):
+            db.add_post(f"API Post {i}", f"Body {i} " * 50, tags=['api', f'n{i}'])
+
+    query_log.clear()
+    response = client.get('/api/v1/posts?limit=2&fields=id,title')
+    assert response.status_code == 200 and response.is_json
+    data = response.get_json()
+    assert [post['title'] for post in data['posts']] == ['API Post 2', 'API Post 1']
+    assert set(data['posts'][0]) == {'id', 'title'}
+    assert data['prev_cursor'] is None and data['next_cursor']
+    assert len(query_log) == 1 # No tag query when tags weren't asked for
+    assert 'content' not in query_log[0] and 'excerpt' not in query_log[0]
+
+    data = client.get(f"/api/v1/posts?limit=2&before={data['next_cursor']}").get_json()
+    assert [(post['title'], post['tags']) for post in data['posts']] == [('API Post 0', ['api', 'n0'])]
+    assert data['next_cursor'] is None
+
+    data = client.get('/api/v1/tags/n1/posts').get_json()
+    assert [post['title'] for post in data['posts']] == ['API Post 1']
+    tags = client.get('/api/v1/tags').get_json()['tags']
+    assert {'name': 'api', 'post_count': 3} in tags
+
+
+def test_api_post_detail_embeds_tags_and_comments(client):
+    """A single post comes with its tags and comments; errors are JSON."""
+    with flask_app.app_context():
+        post_id = db.add_post('Detailed', 'Full body.', tags=['detail'])
+        db.add_comment(post_id, 'Ann', 'Great read.')
+
+    data = client.get(f'/api/v1/posts/{post_id}').get_json()
+    assert data['content'] == 'Full body.'
+    assert data['tags'] == ['detail']
+    assert [(c['author'], c['content']) for c in data['comments']] == [('Ann', 'Great read.')]
+    assert client.get(f'/api/v1/posts/{post_id}?fields=title,updated_at').get_json().keys() == {'title', 'updated_at'}
+
+    response = client.get('/api/v1/posts/999999')
+    assert response.status_code == 404 and response.get_json()['status'] == 404
+    response = client.get('/api/v1/posts?fields=title,password')
+    assert response.status_code == 400 and 'password' in response.get_json()['error']
+    assert client.get('/api/v1/posts?before=garbage').status_code == 400
+
+
+def test_api_compresses_when_accepted(client):
+    """Streamed listings are gzipped for clients that accept it, and left alone otherwise."""
+    import gzip
+    import json
+    with flask_app.app_context():
+        for i in range(20):
+            db.add_post(f"Compressible {i}", "Lorem ipsum dolor sit amet. " * 20, tags=['zip'])
+
+    plain = client.get('/api/v1/posts?limit=20&fields=id,title,excerpt')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    zipped = client.get('/api/v1/posts?limit=20&fields=id,title,excerpt', headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert len(zipped.data) < len(plain.data)
+    assert json.loads(gzip.decompress(zipped.data)) == plain.get_json()
+
+
+def test_export_import_round_trip(app, tmp_path):
+    """export-db / import-db move all data as NDJSON, keeping ids, indexes, triggers and search."""
+    with app.app_context():
+        first = db.add_post('Exported Post', 'Travels through <b>fjords</b>.', image_filename='uploads/images/x.jpg',
+                            tags=['travel', 'norway'])
+        second = db.add_post('Second Export', 'Another body.', image_filename='uploads/images/x.jpg', tags=['norway'])
+        db.add_comment(first, 'Kari', 'Lovely!')
+        db.delete_post(db.add_post('Gap', 'Leaves a hole in the ids.'))
+        objects = lambda: db.get_db().execute(
+            "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name").fetchall()
+        schema_objects = [tuple(row) for row in objects()]
+
+    runner = app.test_cli_runner()
+    export_path = tmp_path / 'blog.ndjson'
+    result = runner.invoke(args=['export-db', str(export_path)])
+    assert result.exit_code == 0, result.output
+    lines = export_path.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 1 + 2 + 2 + 3 + 1 + 1 # meta, tags, posts, links, comment, image
+
+    result = runner.invoke(args=['import-db', str(export_path)])
+    assert result.exit_code != 0 and 'not empty' in result.output
+    result = runner.invoke(args=['import-db', '--replace', '--batch-size', '2', str(export_path)])
+    assert result.exit_code == 0, result.output
+    assert 'Imported 2 tags, 2 posts, 3 post_tags, 1 comments, 1 images.' in result.output
+
+    with app.app_context():
+        assert [tuple(row) for row in objects()] == schema_objects
+        assert db.get_post_by_id(first)['title'] == 'Exported Post'
+        assert [tag['name'] for tag in db.get_tags_for_post(first)] == ['norway', 'travel']
+        assert [c['author'] for c in db.get_comments_for_post(first)] == ['Kari']
+        assert db.get_image_ref_count('uploads/images/x.jpg') == 2
+        assert [row['id'] for row in db.search_posts('fjords')['results']] == [first]
+        assert db.get_post_stamp(second) is not None
+        # New posts continue after the highest imported id
+        assert db.add_post('After Import', 'x') > second + 1
+
+
+def test_interrupted_bulk_load_is_finished_by_migrate_db(app):
+    """Indexes and triggers dropped by a bulk load that never finished are recreated by migrate-db."""
+    import bulk
+    objects = lambda: db.get_db().execute(
+        "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name").fetchall()
+    with app.app_context():
+        schema_objects = [tuple(row) for row in objects()]
+        conn = db.get_db()
+        interrupted = bulk.deferred_indexes_and_triggers(conn)
+        interrupted.__enter__()
+        with db.write_transaction(conn):
+            conn.execute("INSERT INTO posts (id, title, content) VALUES (1, 'Loaded', 'Searchable fjords.')")
+        # The process dies here: nothing recreates the objects, but the record of them is committed
+        assert not [row for row in objects() if row['type'] == 'trigger']
+        deferred = conn.execute("SELECT COUNT(*) FROM deferred_objects").fetchone()[0]
+        assert deferred == len(schema_objects) - len(objects())
+
+        result = app.test_cli_runner().invoke(args=['migrate-db'])
+        assert result.exit_code == 0, result.output
+        assert f"Recreated {deferred} indexes and triggers" in result.output
+        assert [tuple(row) for row in objects()] == schema_objects
+        assert conn.execute("SELECT COUNT(*) FROM deferred_objects").fetchone()[0] == 0
+        assert [row['id'] for row in db.search_posts('fjords')['results']] == [1]
+        assert db.get_post_stamp(1) is not None
+        interrupted.gen.close() # Only unwinds the generator; there is nothing left to restore
+
+
+def test_seed_db_synthetic_is_reproducible(app):
+    """seed-db --synthetic generates posts, Zipf-distributed tags and comments, the same for the same seed."""
+    def snapshot():
+        with app.app_context():
+            conn = db.get_db()
+            return (
+                conn.execute("SELECT id, title, excerpt, published_date FROM posts ORDER BY id").fetchall(),
+                conn.execute("SELECT post_id, tag_id FROM post_tags ORDER BY post_id, tag_id").fetchall(),
+                conn.execute("SELECT post_id, author, published_date FROM comments ORDER BY id").fetchall(),
+            )
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['seed-db', '--synthetic', '60', '--seed', '7', '--batch-size', '25', '--tags', '30'])
+    assert result.exit_code == 0, result.output
+    posts, links, comments = first_run = snapshot()
+    assert len(posts) == 60 and links and comments
+    # Ids follow publication order, and the most popular tag is far ahead of the median one
+    assert [row['published_date'] for row in posts] == sorted(row['published_date'] for row in posts)
+    from collections import Counter
+    tag_counts = sorted(Counter(row['tag_id'] for row in links).values(), reverse=True)
+    assert tag_counts[0] >= 3 * tag_counts[len(tag_counts) // 2]
+
+    with app.app_context():
+        # Derived data was rebuilt after the bulk load
+        assert posts[0]['id'] in [row['id'] for row in db.search_posts(posts[0]['title'], per_page=50)['results']]
+        assert db.get_post_stamp(posts[0]['id']) is not None
+        db.init_db_logic()
+    result = runner.invoke(args=['seed-db', '--synthetic', '60', '--seed', '7', '--batch-size', '25',
+                                 '--tags', '30', '--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert [list(map(tuple, rows)) for rows in snapshot()] == [list(map(tuple, rows)) for rows in first_run]
+
+
+def test_seed_db_synthetic_keeps_triggers_for_existing_posts(app, monkeypatch):
+    """Seeding a database that already has posts inserts with its indexes and triggers in place."""
+    import bulk
+    with app.app_context():
+        existing = db.add_post('Existing Post', 'Served while seeding.', tags=['kept'])
+    def no_deferring(conn):
+        raise AssertionError('indexes and triggers dropped under existing posts')
+    monkeypatch.setattr(bulk, 'deferred_indexes_and_triggers', no_deferring)
+
+    result = app.test_cli_runner().invoke(args=['seed-db', '--synthetic', '10', '--seed', '7', '--tags', '5'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        conn = db.get_db()
+        assert conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0] == 11
+        assert conn.execute("SELECT COUNT(*) FROM posts WHERE updated_at IS NULL").fetchone()[0] == 0
+        assert [row['id'] for row in db.search_posts('Existing')['results']] == [existing]
+        new_post = conn.execute("SELECT id, title FROM posts WHERE id > ? LIMIT 1", (existing,)).fetchone()
+        assert new_post['id'] in [row['id'] for row in db.search_posts(new_post['title'], per_page=50)['results']]
+
+
+def test_requests_report_query_stats(client, monkeypatch, caplog):
+    """Each request sends Server-Timing with its statement count and logs a JSON summary."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_ENABLED', False)
+    with flask_app.app_context():
+        db.add_post('Timed Post', 'Counted.', tags=['timed'])
+    client.get('/') # Puts the new tag in the tag cache
+
+    with caplog.at_level('INFO', logger=flask_app.logger.name):
+        response = client.get('/')
+    timing = response.headers['Server-Timing']
+    assert timing.startswith('db;dur=') and 'desc="3 queries"' in timing and 'app;dur=' in timing
+    summaries = [json.loads(record.getMessage()) for record in caplog.records
+                 if record.getMessage().startswith('{"event": "request_queries"')]
+    assert len(summaries) == 1
+    assert summaries[0]['endpoint'] == 'index' and summaries[0]['queries'] == 3
+
+    monkeypatch.setitem(flask_app.config, 'QUERY_STATS_ENABLED', False)
+    assert 'Server-Timing' not in client.get('/').headers
+
+
+def test_slow_queries_are_logged_with_plan(client, monkeypatch, caplog):
+    """Statements slower than SLOW_QUERY_MS are logged with their EXPLAIN QUERY PLAN."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_ENABLED', False)
+    monkeypatch.setitem(flask_app.config, 'SLOW_QUERY_MS', 0) # Everything counts as slow
+    with flask_app.app_context():
+        post_id = db.add_post('Slow Post', 'Explained.')
+
+    with caplog.at_level('WARNING', logger=flask_app.logger.name):
+        client.get(f'/post/{post_id}')
+    slow = [json.loads(record.getMessage()) for record in caplog.records
+            if record.getMessage().startswith('{"event": "slow_query"')]
+    post_query = next(entry for entry in slow if entry['sql'].startswith('SELECT p.id, p.title, p.content'))
+    assert post_query['endpoint'] == 'post' and post_query['ms'] >= 0
+    assert any('SEARCH p USING INTEGER PRIMARY KEY' in detail for detail in post_query['plan'])
+
+
+def test_metrics_endpoint_aggregates_workers(client, monkeypatch):
+    """/metrics reports latency histograms, sizes, DB time and cache hits summed over all worker files."""
+    import metrics
+    with flask_app.app_context():
+        post_id = db.add_post('Measured Post', 'Observed.')
+    client.get('/')
+    client.get('/') # Page cache hit
+    client.get(f'/post/{post_id}')
+    client.get('/no-such-page')
+
+    # Another worker process's file in the same directory
+    other = metrics.MetricsFile(os.path.join(flask_app.config['METRICS_DIR'], 'metrics-999999.db'))
+    other.add('blog_http_requests_total{endpoint="index",method="GET",status="200"}', 5)
+    other.add('blog_page_cache_requests_total{result="hit"}', 5)
+    other.add('blog_upload_bytes_total', 1024)
+    other.close()
+
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            key, value = line.rsplit(' ', 1)
+            samples[key] = float(value)
+    assert samples['blog_http_requests_total{endpoint="index",method="GET",status="200"}'] == 7
+    assert samples['blog_http_requests_total{endpoint="unmatched",method="GET",status="404"}'] == 1
+    assert samples['blog_http_request_duration_seconds_count{endpoint="index"}'] == 2
+    assert samples['blog_http_request_duration_seconds_bucket{endpoint="index",le="+Inf"}'] == 2
+    assert samples['blog_http_response_size_bytes_sum{endpoint="post"}'] > 0
+    assert samples['blog_db_queries_total{endpoint="post"}'] >= 1
+    assert samples['blog_page_cache_hit_ratio'] == 6 / 8 # 1 + 5 hits, 2 misses
+    assert samples['blog_upload_bytes_total'] == 1024
+
+    monkeypatch.setitem(flask_app.config, 'METRICS_ENABLED', False)
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_fold_files_of_exited_workers(app):
+    """Files of exited workers are merged into one and removed; live workers' files are left alone."""
+    import metrics
+    import subprocess
+    directory = app.config['METRICS_DIR']
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    for pid, amount in ((exited.pid, 2), (os.getppid(), 3)):
+        worker_file = metrics.MetricsFile(os.path.join(directory, f'metrics-{pid}.db'))
+        worker_file.add('blog_upload_bytes_total', amount)
+        worker_file.close()
+    recycled = metrics.MetricsFile(os.path.join(directory, 'metrics-424242.db'))
+    recycled.add('blog_upload_bytes_total', 4)
+    recycled.close()
+    assert metrics.read_samples(directory)['blog_upload_bytes_total'] == 9
+
+    assert metrics.fold_dead_files(directory, own_pid=424242) >= 2
+    assert sorted(os.listdir(directory)) == sorted(['metrics.lock', metrics.MERGED_FILE, f'metrics-{os.getppid()}.db'])
+    assert metrics.read_samples(directory)['blog_upload_bytes_total'] == 9
+    # A new process with the recycled pid starts from zero
+    fresh = metrics.MetricsFile(os.path.join(directory, 'metrics-424242.db'))
+    fresh.add('blog_upload_bytes_total', 1)
+    fresh.close()
+    assert metrics.read_samples(directory)['blog_upload_bytes_total'] == 10
+
+
+def test_comment_and_post_counts_follow_writes(client):
+    """comment_count and post_count are kept by triggers, including ON DELETE CASCADE, and `recount` repairs them."""
+    def counts(conn):
+        posts = {row['title']: row['comment_count'] for row in conn.execute("SELECT title, comment_count FROM posts")}
+        tags = {row['name']: row['post_count'] for row in conn.execute("SELECT name, post_count FROM tags")}
+        return posts, tags
+
+    with flask_app.app_context():
+        first = db.add_post('Counted A', 'Body.', tags=['shared', 'only-a'])
+        second = db.add_post('Counted B', 'Body.', tags=['shared'])
+        for author in ('Ann', 'Bob'):
+            db.add_comment(first, author, 'Hi.')
+        db.add_comment(second, 'Cy', 'Hello.')
+        conn = db.get_db()
+        assert counts(conn) == ({'Counted A': 2, 'Counted B': 1}, {'shared': 2, 'only-a': 1})
+
+        db.set_post_tags(second, ['only-b'])
+        db.delete_post(first) # Its comments and tag links go by ON DELETE CASCADE
+        assert counts(conn) == ({'Counted B': 1}, {'shared': 0, 'only-a': 0, 'only-b': 1})
+
+        conn.execute("UPDATE posts SET comment_count = 40")
+        conn.execute("UPDATE tags SET post_count = 7")
+        conn.commit()
+    result = flask_app.test_cli_runner().invoke(args=['recount'])
+    assert result.exit_code == 0, result.output
+    assert 'on 1 posts and post counts on 3 tags' in result.output
+    with flask_app.app_context():
+        assert counts(db.get_db()) == ({'Counted B': 1}, {'shared': 0, 'only-a': 0, 'only-b': 1})
+
+    response = client.get('/tags')
+    assert response.status_code == 200
+    assert b'only-b' in response.data and b'shared' not in response.data # Unused tags are left out
+    assert client.get('/api/v1/posts?fields=title,comment_count').get_json()['posts'] == [
+        {'title': 'Counted B', 'comment_count': 1}]
+
+
+def test_write_behind_comments_batch_and_read_your_writes(client, monkeypatch):
+    """Queued comments are written in batches, and the redirect back to the post already shows them."""
+    import comment_queue
+    monkeypatch.setitem(flask_app.config, 'COMMENT_WRITE_BEHIND', True)
+    monkeypatch.setitem(flask_app.config, 'COMMENT_FLUSH_MS', 200) # Long enough for a burst to share a batch
+    with flask_app.app_context():
+        post_id = db.add_post('Busy Post', 'Lots of comments.')
+    try:
+        response = client.post(f'/post/{post_id}', data={'author': 'Queued', 'content': 'Written behind.'},
+                               follow_redirects=True)
+        assert b'Written behind.' in response.data # Read-your-writes on the redirect
+        assert b'Comment received' in response.data and b'added successfully' not in response.data
+
+        writer = comment_queue.get_writer(flask_app)
+        before = writer.stats()
+        seqs = [writer.submit(post_id, f'Reader {i}', 'Burst.') for i in range(10)]
+        assert writer.wait_for(seqs[-1], timeout=5)
+        stats = writer.stats()
+        assert stats['written'] == before['written'] + 10
+        assert stats['batches'] == before['batches'] + 1 # One transaction for the whole burst
+        with flask_app.app_context():
+            assert db.get_post_by_id(post_id, columns=('comment_count',))['comment_count'] == 11
+    finally:
+        flask_app.extensions.pop('comment_writer').close()
+
+
+def test_write_behind_queue_applies_backpressure_and_flushes_on_close(app, monkeypatch):
+    """A full queue rejects submits after the timeout; close() writes whatever is still queued."""
+    import threading
+    import comment_queue
+    with app.app_context():
+        post_id = db.add_post('Backpressure', 'Slow disk.')
+    unblock = threading.Event()
+    original_add_comments = db.add_comments
+    def slow_add_comments(comments):
+        unblock.wait(5)
+        return original_add_comments(comments)
+    monkeypatch.setattr(db, 'add_comments', slow_add_comments)
+
+    writer = comment_queue.CommentWriter(app, max_size=2, batch_size=1, flush_interval=0, submit_timeout=0.05)
+    accepted = 0
+    with pytest.raises(comment_queue.QueueFull):
+        for i in range(5):
+            writer.submit(post_id, f'Author {i}', 'Waiting.')
+            accepted += 1
+    assert 2 <= accepted <= 3 # The queue, plus the batch the writer is stuck on
+    unblock.set()
+    writer.close()
+    assert writer.stats()['written'] == accepted
+    with app.app_context():
+        assert len(db.get_comments_for_post(post_id)) == accepted
+
+
+def test_write_behind_close_gives_up_on_a_stuck_writer(app, monkeypatch):
+    """close() returns after its timeout even when the writer is stuck and the queue is full."""
+    import threading
+    import time
+    import comment_queue
+    unblock = threading.Event()
+    monkeypatch.setattr(db, 'add_comments', lambda comments: unblock.wait(5) and 0)
+    writer = comment_queue.CommentWriter(app, max_size=1, batch_size=1, flush_interval=0, submit_timeout=0.05)
+    with pytest.raises(comment_queue.QueueFull):
+        for i in range(3):
+            writer.submit(1, f'Author {i}', 'Stuck.')
+
+    started = time.monotonic()
+    assert writer.close(timeout=0.2) is False
+    assert time.monotonic() - started < 2
+    unblock.set()
+
+
+def test_template_cache_dir_is_created_on_first_write(app, tmp_path):
+    """The bytecode cache follows TEMPLATE_CACHE_DIR as configured now, and creates it only when writing."""
+    cache_dir = tmp_path / 'jinja-cache'
+    app.config['TEMPLATE_CACHE_DIR'] = str(cache_dir)
+    assert app.jinja_env.bytecode_cache.directory == str(cache_dir)
+    app.jinja_env.bytecode_cache.clear()
+    assert not cache_dir.exists()
+    app.jinja_env.cache.clear()
+    app.jinja_env.get_template('index.html')
+    assert list(cache_dir.glob('__jinja2_*.cache'))
+
+
+def test_precompile_templates_fills_bytecode_cache(app, monkeypatch, tmp_path):
+    """precompile-templates compiles every template into the bytecode cache that new workers load from."""
+    from jinja2 import FileSystemBytecodeCache
+    monkeypatch.setattr(app.jinja_env, 'bytecode_cache', FileSystemBytecodeCache(str(tmp_path)))
+    result = app.test_cli_runner().invoke(args=['precompile-templates'])
+    assert result.exit_code == 0, result.output
+    templates = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    assert f"Compiled {len(templates)} templates into {tmp_path}" in result.output
+    assert len(list(tmp_path.glob('__jinja2_*.cache'))) == len(templates)
+
+    # A fresh environment (as in a new worker) loads the compiled code instead of compiling
+    compiled = []
+    monkeypatch.setattr(app.jinja_env, 'compile', lambda *args, **kwargs: compiled.append(args))
+    app.jinja_env.cache.clear()
+    app.jinja_env.get_template('index.html')
+    assert compiled == []
+
+
+def test_post_comments_are_paginated(client):
+    """The post page renders the first page of comments; the rest follow ?after= cursors (HTML and JSON)."""
+    import re
+    import html
+    with flask_app.app_context():
+        post_id = db.add_post('Viral Post', 'Everyone has an opinion.')
+        # Written in one statement, so most share a published_date and order falls back to id
+        db.add_comments((post_id, f'Reader {i:03}', f'Opinion {i}.') for i in range(120))
+    def authors(body):
+        return re.findall(r'<strong>(Reader \d+)</strong>', body)
+    def next_link(body):
+        match = re.search(r'href="([^"]+)"\s*>Load more comments', body)
+        return html.unescape(match.group(1)) if match else None
+
+    body = client.get(f'/post/{post_id}').get_data(as_text=True)
+    seen = authors(body)
+    assert len(seen) == db.COMMENT_PAGE_SIZE and 'Comments (120)' in body
+    link = next_link(body)
+    while link:
+        fragment = client.get(link).get_data(as_text=True)
+        assert '<html' not in fragment
+        seen += authors(fragment)
+        link = next_link(fragment)
+    assert seen == [f'Reader {i:03}' for i in range(120)]
+
+    detail = client.get(f'/api/v1/posts/{post_id}').get_json()
+    assert len(detail['comments']) == db.COMMENT_PAGE_SIZE
+    data = client.get(f"/api/v1/posts/{post_id}/comments?limit=100&after={detail['comments_next_cursor']}").get_json()
+    assert [c['author'] for c in data['comments']] == [f'Reader {i:03}' for i in range(50, 120)]
+    assert data['next_cursor'] is None
+
+    assert client.get(f'/post/{post_id}/comments?after=garbage').status_code == 400
+    assert client.get('/post/999999/comments').status_code == 404
+    assert client.get('/api/v1/posts/999999/comments').status_code == 404
+
+
+def test_post_pages_load_in_one_statement(client, monkeypatch, query_log):
+    """The post and edit pages read the post, its tags and comments as one bundle, in one statement."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_ENABLED', False)
+    with flask_app.app_context():
+        post_id = db.add_post('Bundled Post', 'All at once.', tags=['zeta', 'alpha'])
+        db.add_comments((post_id, f'Reader {i}', f'Comment {i}.') for i in range(3))
+        bundle = db.load_post_bundle(post_id, comment_limit=2)
+        assert bundle.post['title'] == 'Bundled Post' and bundle.post['comment_count'] == 3
+        assert [tag['name'] for tag in bundle.tags] == ['alpha', 'zeta']
+        assert [comment['author'] for comment in bundle.comments] == ['Reader 0', 'Reader 1']
+        assert bundle.comments[0]['published_date'].year >= 2000
+        assert bundle.next_cursor == db.encode_cursor(bundle.comments[-1])
+        with pytest.raises(AttributeError):
+            bundle.tags = ()
+        bare = db.load_post_bundle(post_id, with_tags=False, with_comments=False)
+        assert bare.tags is None and bare.comments is None and bare.next_cursor is None
+        assert db.load_post_bundle(999999) is None
+
+    def data_statements():
+        # The conditional-GET stamp lookup is the only other statement
+        return [sql for sql in query_log if not sql.startswith('SELECT updated_at FROM posts')]
+
+    query_log.clear()
+    body = client.get(f'/post/{post_id}').get_data(as_text=True)
+    assert 'Reader 2' in body and 'alpha' in body
+    assert len(data_statements()) == 1
+
+    query_log.clear()
+    assert b'alpha, zeta' in client.get(f'/post/{post_id}/edit').data
+    assert len(data_statements()) == 1
+
+    query_log.clear() # A failed validation re-renders from the same bundle
+    response = client.post(f'/post/{post_id}/edit', data={'title': '', 'content': 'x', 'tags': ''})
+    assert response.status_code == 200 and b'required' in response.data
+    assert len(data_statements()) == 1
+
+
+def test_loaders_return_slotted_models(client):
+    """Listings are Post/Tag/Comment objects with __slots__, readable by attribute or by name."""
+    import models
+    with flask_app.app_context():
+        first = db.add_post('Model Post', 'Body.', tags=['shared', 'one'])
+        second = db.add_post('Other Post', 'Body.', tags=['shared'])
+        db.add_comment(first, 'Reader', 'Slotted!')
+        posts = db.get_posts_with_tags()
+        post = next(post for post in posts if post.id == first)
+        assert isinstance(post, models.Post) and not hasattr(post, '__dict__')
+        assert post.title == post['title'] == 'Model Post'
+        assert [tag.name for tag in post.tags] == ['one', 'shared']
+        assert 'content' not in post.keys() # Listings load the summary columns only
+        with pytest.raises(KeyError):
+            post['content']
+        assert dict(post)['excerpt'] == 'Body.'
+        # A tag on several posts is built once per listing
+        other = next(post for post in posts if post.id == second)
+        assert other.tags[0] is post.tags[1]
+
+        assert isinstance(db.get_post_by_id(first), models.Post)
+        comment = db.get_comments_for_post(first)[0]
+        assert isinstance(comment, models.Comment) and comment.author == 'Reader'
+        assert comment.published_date.year >= 2000 # TIMESTAMP columns are still converted
+        assert db.get_tags_for_post(first) == [models.Tag(id=post.tags[0].id, name='one'),
+                                               models.Tag(id=post.tags[1].id, name='shared')]
+
+    body = client.get('/').get_data(as_text=True)
+    assert 'Model Post' in body and 'shared' in body
+
+
+def test_tag_cache_skips_tags_table(client, monkeypatch, query_log):
+    """Known tags are resolved from the in-process cache: tag pages and tag writes don't read tags."""
+    monkeypatch.setitem(flask_app.config, 'PAGE_CACHE_ENABLED', False)
+    monkeypatch.setitem(flask_app.config, 'TAG_CACHE_CHECK_INTERVAL', 3600)
+    with flask_app.app_context():
+        post_id = db.add_post('Cached Tags', 'Body.', tags=['hot', 'cold'])
+        tag_id = db.add_or_get_tag('hot')
+        db.get_tag_cache(force_check=True) # Reloads after the tags this process just created
+
+    def reads_tags():
+        return [sql for sql in query_log if 'tags t' in sql or 'FROM tags' in sql]
+
+    query_log.clear()
+    body = client.get('/tag/hot').get_data(as_text=True)
+    assert 'Cached Tags' in body and 'cold' in body
+    with flask_app.app_context():
+        assert db.add_or_get_tag('hot') == tag_id
+        assert db.set_post_tags(post_id, ['cold', 'hot'])
+        assert [post.title for post in db.get_posts_by_tag('cold')] == ['Cached Tags']
+        assert db.get_posts_page(tag_name='no-such-tag')['posts'] == []
+    assert reads_tags() == [f"SELECT id, name FROM tags WHERE name IN (SELECT value FROM json_each('[\"no-such-tag\"]'))"]
+    assert any('change_counters' in sql for sql in query_log) # The write checked the counter
+
+
+def test_tag_cache_is_warmed_before_first_request(client):
+    """A new process loads its tag cache before serving, even for pages that don't use tags."""
+    with flask_app.app_context():
+        db.add_post('Warm Post', 'Body.', tags=['warm', 'cold'])
+    flask_app.extensions.pop('tag_cache', None) # As in a freshly started worker
+    assert client.get('/post/new').status_code == 200
+    cache = flask_app.extensions['tag_cache']
+    assert set(cache.cached_names(['warm', 'cold'])) == {'warm', 'cold'}
+    assert cache.stats()['loads'] == 1
+    client.get('/post/new')
+    assert cache.stats()['loads'] == 1
+
+
+def test_tag_cache_follows_other_processes(client, monkeypatch):
+    """Tag inserts, renames and deletes by another process bump the 'tags' counter and reload the cache."""
+    import sqlite3
+    monkeypatch.setitem(flask_app.config, 'TAG_CACHE_CHECK_INTERVAL', 0)
+    with flask_app.app_context():
+        post_id = db.add_post('Shared Post', 'Body.', tags=['before'])
+        cache = db.get_tag_cache()
+        loads = cache.stats()['loads']
+        assert cache.cached_names(['before'])
+
+        other = sqlite3.connect(flask_app.config['DATABASE']) # Another worker, bypassing this process
+        with other:
+            other.execute("UPDATE tags SET name = 'after' WHERE name = 'before'")
+        other.close()
+        assert [tag.name for tag in db.get_tags_for_posts([post_id])[post_id]] == ['after']
+        assert db.get_posts_page(tag_name='before')['posts'] == []
+        assert [post.id for post in db.get_posts_page(tag_name='after')['posts']] == [post_id]
+        assert cache.stats()['loads'] == loads + 1
+
+        # A re-initialized database empties it at once, whatever the interval
+        monkeypatch.setitem(flask_app.config, 'TAG_CACHE_CHECK_INTERVAL', 3600)
+        db.init_db_logic()
+        assert db.add_or_get_tag('after') == 1
+
+
+def test_tag_cache_is_bounded(client, monkeypatch):
+    """The cache keeps at most TAG_CACHE_SIZE tags, evicting the least recently used."""
+    monkeypatch.setitem(flask_app.config, 'TAG_CACHE_SIZE', 2)
+    with flask_app.app_context():
+        flask_app.extensions.pop('tag_cache', None) # Rebuilt with the new size
+        post_id = db.add_post('Many Tags', 'Body.', tags=['a', 'b', 'c', 'd'])
+        client.get('/')
+        assert [tag.name for tag in db.get_tags_for_posts([post_id])[post_id]] == ['a', 'b', 'c', 'd']
+        cache = db.get_tag_cache()
+        assert cache.stats()['size'] == 2
+        assert db.add_or_get_tag('a') and db.add_or_get_tag('b')
+        assert set(cache.cached_names(['a', 'b', 'c', 'd'])) == {'a', 'b'}
+    flask_app.extensions.pop('tag_cache', None)
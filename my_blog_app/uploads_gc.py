@@ -0,0 +1,354 @@
+# uploads_gc.py
+
+import os
+import time
+import json
+import fcntl
+import bisect
+import sqlite3
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import db
+import images
+
+# --- Orphaned upload collection ---
+# Files in the upload folder that no post references pile up over time: a
+# failed cleanup after a rejected post, a crash between saving an upload and
+# writing its post, or files from before uploads were reference-counted.
+# `flask gc-uploads` streams the folder (and its derivatives subfolder)
+# with os.scandir and checks each file against the set of referenced
+# images, read once from the images table (whose ref_count triggers on
+# posts maintain). It reports orphans, or removes them in batches with
+# --delete, along with a histogram of file sizes and the bytes reclaimed.
+#
+# Safety: files modified within UPLOAD_GC_MIN_AGE seconds are never
+# touched (an upload may be waiting for its post to be written, and
+# save_image refreshes the mtime of a file it reuses). Before each batch is
+# removed its files are looked up again in the images table, in the same
+# transaction that drops their rows.
+#
+# Background mode: with UPLOAD_GC_INTERVAL > 0 each process starts a daemon
+# thread that runs a collection on that schedule, reporting to the app log,
+# and removing orphans only if UPLOAD_GC_DELETE is on. Only one process
+# collects: the threads take a non-blocking flock on UPLOAD_GC_LOCK_FILE
+# before each run and skip it if another process holds the lock. The holder
+# keeps it until it exits, and another worker then takes over.
+
+# Defaults, overridable through app.config
+UPLOAD_GC_DEFAULTS = {
+    'UPLOAD_GC_BATCH_SIZE': 500,     # Orphans removed per transaction
+    'UPLOAD_GC_MIN_AGE': 3600,       # Seconds a file must be unmodified to be collected
+    'UPLOAD_GC_INTERVAL': 0,         # Seconds between background runs (0 = off)
+    'UPLOAD_GC_DELETE': False,       # Whether background runs remove orphans or only report them
+    'UPLOAD_GC_LOCK_FILE': None,     # Held by the collecting process; defaults to <instance path>/upload-gc.lock
+}
+
+# Upper bounds of the size histogram buckets (the last bucket is open-ended)
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+
+def format_bytes(size):
+    """Formats a byte count for humans, e.g. 1536 -> '1.5 KiB'."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f"{size} B" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def _bucket_labels():
+    bounds = [0, *SIZE_BUCKETS]
+    labels = [f"{format_bytes(low)} - {format_bytes(high)}" for low, high in zip(bounds, SIZE_BUCKETS)]
+    return labels + [f">= {format_bytes(SIZE_BUCKETS[-1])}"]
+
+
+def referenced_images(conn):
+    """Returns the set of image paths (relative to static/) used by at least one post."""
+    return {row[0] for row in conn.execute("SELECT filename FROM images WHERE ref_count > 0")}
+
+def _original_stem(name, derived):
+    """The stem of the original an upload folder entry belongs to.
+
+    Originals are <stem>.<ext>; derivatives are <stem>-<width>.<ext> and the
+    manifest <stem>.json. Interrupted writes leave a '.tmp' suffix on either.
+    """
+    if name.endswith('.tmp'):
+        name = name[:-len('.tmp')]
+    stem = os.path.splitext(name)[0]
+    if derived and not name.endswith('.json'):
+        base, _, width = stem.rpartition('-')
+        if base and width.isdigit():
+            stem = base
+    return stem
+
+def iter_upload_files(static_folder, upload_folder):
+    """Yields (relative path, original stem, is derivative, os.stat_result) for every upload file.
+
+    Streams the upload folder and its derivatives subfolder with os.scandir;
+    other subfolders and dotfiles are left alone.
+    """
+    folders = ((upload_folder, False), (f"{upload_folder}/{images.DERIVED_FOLDER_NAME}", True))
+    for relative_folder, derived in folders:
+        try:
+            entries = os.scandir(os.path.join(static_folder, relative_folder))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue # Removed while scanning
+                yield f"{relative_folder}/{entry.name}", _original_stem(entry.name, derived), derived, stat
+
+
+class GcReport:
+    """What a collection found: file counts, sizes and the size histogram."""
+
+    def __init__(self):
+        self.scanned = 0
+        self.scanned_bytes = 0
+        self.orphans = 0
+        self.orphan_bytes = 0
+        self.recent = 0          # Orphan candidates skipped as too new
+        self.removed = 0
+        self.reclaimed_bytes = 0
+        self.failed = 0
+        self.missing = []        # Referenced originals not found on disk
+        self.orphan_paths = []   # Filled only when asked for (collect(..., keep_paths=True))
+        # Per size bucket: [files, bytes, orphans, orphan bytes]
+        self.histogram = [[0, 0, 0, 0] for _ in range(len(SIZE_BUCKETS) + 1)]
+
+    def add_file(self, size, orphan):
+        bucket = self.histogram[bisect.bisect_right(SIZE_BUCKETS, size)]
+        bucket[0] += 1
+        bucket[1] += size
+        self.scanned += 1
+        self.scanned_bytes += size
+        if orphan:
+            bucket[2] += 1
+            bucket[3] += size
+            self.orphans += 1
+            self.orphan_bytes += size
+
+    def summary(self):
+        return (f"Scanned {self.scanned} files ({format_bytes(self.scanned_bytes)}): "
+                f"{self.orphans} orphaned ({format_bytes(self.orphan_bytes)}), "
+                f"{self.removed} removed, {format_bytes(self.reclaimed_bytes)} reclaimed, "
+                f"{self.recent} too recent to collect, {len(self.missing)} referenced but missing.")
+
+    def histogram_lines(self):
+        lines = [f"{'size':<24}{'files':>8}{'bytes':>12}{'orphans':>9}{'orphan bytes':>14}"]
+        for label, (files, size, orphans, orphan_size) in zip(_bucket_labels(), self.histogram):
+            if files:
+                lines.append(f"{label:<24}{files:>8}{format_bytes(size):>12}"
+                             f"{orphans:>9}{format_bytes(orphan_size):>14}")
+        return lines
+
+
+def _remove_batch(conn, static_folder, batch, min_age, report):
+    """Removes a batch of orphan candidates that are still unreferenced and old enough.
+
+    `batch` holds (path, original key, is derivative, size) tuples, the key
+    being the original's path without its extension. Runs in one
+    transaction: the references are checked again and the images rows of
+    removed originals are dropped while the write lock is held, so a post
+    can't start using a file between the check and its removal. A removal
+    that fails is counted and its row kept.
+    """
+    cutoff = time.time() - min_age
+    try:
+        with db.write_transaction(conn):
+            # Any referenced '<key>.<ext>': a range on the images primary key ('/' follows '.')
+            still_referenced = {row[0] for row in conn.execute("""
+                SELECT j.value FROM json_each(?) j WHERE EXISTS (
+                    SELECT 1 FROM images i
+                    WHERE i.filename >= j.value || '.' AND i.filename < j.value || '/' AND i.ref_count > 0
+                )
+            """, (json.dumps(list({key for _, key, _, _ in batch})),))}
+            removed_originals = []
+            for path, key, derived, size in batch:
+                if key in still_referenced:
+                    continue
+                full_path = os.path.join(static_folder, path)
+                try:
+                    if os.stat(full_path).st_mtime > cutoff:
+                        report.recent += 1 # Reused or rewritten since the scan
+                        continue
+                    os.remove(full_path)
+                except FileNotFoundError:
+                    continue # Already gone (e.g. removed by another worker)
+                except OSError as e:
+                    report.failed += 1
+                    current_app.logger.warning(f"Could not remove orphaned upload {path}: {e}")
+                    continue
+                report.removed += 1
+                report.reclaimed_bytes += size
+                if not derived:
+                    removed_originals.append(path)
+            if removed_originals:
+                conn.execute(
+                    "DELETE FROM images WHERE filename IN (SELECT value FROM json_each(?)) AND ref_count <= 0",
+                    (json.dumps(removed_originals),)
+                )
+    except sqlite3.Error as e:
+        current_app.logger.error(f"DB error while removing orphaned uploads: {e}")
+        report.failed += len(batch)
+
+def collect(delete=False, batch_size=None, min_age=None, keep_paths=False):
+    """Finds orphaned uploads, and removes them in batches if `delete`.
+
+    Must run within an app context. An upload is an orphan if it is an
+    original no post references, or a derivative (or manifest) of one.
+
+    Returns:
+        A GcReport.
+    """
+    config = current_app.config
+    batch_size = max(1, int(config['UPLOAD_GC_BATCH_SIZE'] if batch_size is None else batch_size))
+    min_age = float(config['UPLOAD_GC_MIN_AGE'] if min_age is None else min_age)
+    static_folder = current_app.static_folder
+    conn = db.get_db()
+    referenced = referenced_images(conn)
+    referenced_stems = {os.path.splitext(os.path.basename(path))[0] for path in referenced}
+    cutoff = time.time() - min_age
+
+    report = GcReport()
+    seen = set()
+    batch = []
+    for path, stem, derived, stat in iter_upload_files(static_folder, db.IMAGE_UPLOAD_FOLDER):
+        if derived:
+            orphan = stem not in referenced_stems
+        else:
+            orphan = path not in referenced
+            if not orphan:
+                seen.add(path)
+        report.add_file(stat.st_size, orphan)
+        if not orphan:
+            continue
+        if stat.st_mtime > cutoff:
+            report.recent += 1
+            continue
+        if keep_paths:
+            report.orphan_paths.append(path)
+        if delete:
+            batch.append((path, f"{db.IMAGE_UPLOAD_FOLDER}/{stem}", derived, stat.st_size))
+            if len(batch) >= batch_size:
+                _remove_batch(conn, static_folder, batch, min_age, report)
+                batch = []
+    if batch:
+        _remove_batch(conn, static_folder, batch, min_age, report)
+    if report.removed:
+        images._manifest_cache.clear()
+    report.missing = sorted(path for path in referenced
+                            if path.startswith(f"{db.IMAGE_UPLOAD_FOLDER}/") and path not in seen)
+    return report
+
+
+@click.command('gc-uploads')
+@click.option('--delete', is_flag=True, help='Remove the orphans (default: only report them).')
+@click.option('--batch-size', default=None, type=int, help='Orphans removed per transaction (default: UPLOAD_GC_BATCH_SIZE).')
+@click.option('--min-age', default=None, type=float, help='Skip files modified in the last N seconds (default: UPLOAD_GC_MIN_AGE).')
+@click.option('--list', 'list_paths', is_flag=True, help='Print the path of every orphan found.')
+@with_appcontext
+def gc_uploads_command(delete, batch_size, min_age, list_paths):
+    """Report (or --delete) uploaded images and derivatives that no post uses."""
+    if db.get_schema_version() != db.SCHEMA_VERSION:
+        raise click.ClickException('Database schema is out of date; run `flask migrate-db` first.')
+    report = collect(delete=delete, batch_size=batch_size, min_age=min_age, keep_paths=list_paths)
+    for path in report.orphan_paths:
+        click.echo(f"  orphan: {path}")
+    for path in report.missing:
+        click.echo(f"  missing: {path}", err=True)
+    if report.scanned:
+        for line in report.histogram_lines():
+            click.echo(line)
+    click.echo(report.summary())
+    if report.orphans and not delete:
+        click.echo('Run with --delete to remove the orphans.')
+    if report.failed:
+        raise click.ClickException(f"{report.failed} orphans could not be removed; see the log.")
+
+
+class UploadCollector:
+    """A daemon thread running collect() every `interval` seconds, while it holds the lock at `lock_path`."""
+
+    def __init__(self, app, interval, delete, lock_path):
+        self.app = app
+        self.interval = interval
+        self.delete = delete
+        self.lock_path = lock_path
+        self.pid = os.getpid() # The thread doesn't survive a fork
+        self.runs = 0
+        self.skipped = 0 # Runs left to the process holding the lock
+        self.last_report = None
+        self._lock_file = None
+        self._locked = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='upload-gc', daemon=True)
+        self._thread.start()
+
+    def _acquire(self):
+        """Takes the lock shared by all processes' collectors, if no other process holds it."""
+        if self._lock_file is None:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            self._lock_file = open(self.lock_path, 'ab')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._locked = True
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self._locked and not self._acquire():
+                    self.skipped += 1
+                    continue
+            except OSError:
+                self.app.logger.exception('Could not open the upload collector lock file')
+                continue
+            try:
+                with self.app.app_context():
+                    report = collect(delete=self.delete)
+            except Exception: # Never let the thread die; try again next interval
+                self.app.logger.exception('Background upload collection failed')
+                continue
+            self.runs += 1
+            self.last_report = report
+            if report.orphans or report.missing:
+                self.app.logger.info(f"Upload GC: {report.summary()}")
+
+    def close(self, timeout=10.0):
+        """Stops the thread, waiting up to `timeout` seconds for a running collection to finish."""
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._lock_file is not None and not self._thread.is_alive():
+            self._lock_file.close() # Releases the lock for another process's collector
+
+
+def _start_collector():
+    """Starts this process's background collector on its first request, if UPLOAD_GC_INTERVAL is set.
+
+    Checked per request rather than in init_app, which runs before the
+    app's configuration is loaded.
+    """
+    app = current_app._get_current_object()
+    if float(app.config['UPLOAD_GC_INTERVAL']) <= 0:
+        return
+    collector = app.extensions.get('upload_collector')
+    if collector is None or collector.pid != os.getpid():
+        app.extensions['upload_collector'] = UploadCollector(
+            app, float(app.config['UPLOAD_GC_INTERVAL']), bool(app.config['UPLOAD_GC_DELETE']),
+            app.config['UPLOAD_GC_LOCK_FILE'] or os.path.join(app.instance_path, 'upload-gc.lock'))
+
+
+def init_app(app):
+    """Register the gc-uploads command (and the background collector, if enabled) with the Flask app."""
+    for key, default in UPLOAD_GC_DEFAULTS.items():
+        app.config.setdefault(key, default)
+    app.before_request(_start_collector)
+    app.cli.add_command(gc_uploads_command)